@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+# Нагрузочный стенд: seed заполняет БД, run гоняет смешанную нагрузку по настоящим маршрутам,
+# compare сравнивает сохраненные результаты.
+#   python bench.py seed --reset
+#   python bench.py run --start-server --duration 60 --output before.json
+#   python bench.py compare before.json after.json
+
+SERVER_TIMING = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+BENCH_PASSWORD = "bench"
+# Каждому номеру — брони подряд через STAY_STEP дней по 1–3 ночи, пересечений нет
+STAY_STEP = 4
+DEFAULT_MIX = "login=2,create_booking=10,list_bookings=20,get_booking=10,list_payments=15,list_rooms=10," \
+              "available_rooms=8,reference=20,calendar=5"
+
+def start_pgserver(path: str):
+    # Встроенный Postgres (пакет pgserver) вместо внешнего сервера; DATABASE_URL выставляется для server.py
+    import pgserver
+    srv = pgserver.get_server(path, cleanup_mode=None)
+    if not srv.psql("SELECT 1 FROM pg_database WHERE datname = 'Hotel'").strip().endswith("1 row)"):
+        srv.psql('CREATE DATABASE "Hotel"')
+    os.environ["DATABASE_URL"] = f"postgresql://postgres:@/Hotel?host={srv.pgdata}"
+    print("DATABASE_URL=" + os.environ["DATABASE_URL"])
+    return srv
+
+def insert_batches(engine, label: str, total: int, batch: int, statements: list[str], params: dict):
+    from sqlalchemy import text
+    started = time.perf_counter()
+    for lo in range(1, total + 1, batch):
+        hi = min(lo + batch - 1, total)
+        with engine.begin() as conn:
+            for statement in statements:
+                conn.execute(text(statement), {**params, "lo": lo, "hi": hi})
+        print(f"\r{label}: {hi}/{total}", end="", flush=True)
+    print(f"\r{label}: {total} за {time.perf_counter() - started:.1f} с")
+
+def seed(args):
+    if args.pgserver:
+        start_pgserver(args.pgserver)
+    # Массовые вставки заведомо долгие, лог медленных запросов для них не нужен
+    os.environ["SLOW_QUERY_MS"] = "0"
+    import server
+    from sqlalchemy import text
+
+    server.migrate()
+    engine = server.get_engine()
+    with engine.begin() as conn:
+        if conn.execute(text('SELECT EXISTS (SELECT 1 FROM "Bookings")')).scalar() and not args.reset:
+            sys.exit("В базе уже есть брони, для очистки запустите с --reset")
+        conn.execute(text(
+            'TRUNCATE "Position", "Users", "Clients", "Category", "Rooms", "Cleaning", "BookingStatus", "Bookings", '
+            '"BookingRooms", "PaymentMethod", "Payments", "AdditionalServices", "Service_Usage", "Documents", '
+            '"SalesAnalysis", "TableVersions" RESTART IDENTITY CASCADE'
+        ))
+        conn.execute(text("""INSERT INTO "Position" (position_name) VALUES ('Админ'), ('Администратор')"""))
+        conn.execute(text("""INSERT INTO "Category" (category_name, description)
+                             VALUES ('Эконом', ''), ('Стандарт', ''), ('Комфорт', ''), ('Полулюкс', ''), ('Люкс', '')"""))
+        conn.execute(text("""INSERT INTO "BookingStatus" (status_name) VALUES ('Новое'), ('Подтверждено'), ('Завершено')"""))
+        conn.execute(text("""INSERT INTO "PaymentMethod" (method_name) VALUES ('Наличные'), ('Карта'), ('Перевод')"""))
+        conn.execute(text(
+            """
+            INSERT INTO "AdditionalServices" (service_name, price, description)
+            SELECT 'Услуга ' || i, 100 + i * 50, '' FROM generate_series(1, 20) AS i
+            """
+        ))
+        # Хеш один на всех: вход проверяет argon2 так же, как для настоящих пользователей
+        conn.execute(text(
+            """
+            INSERT INTO "Users" (first_name, last_name, phone, email, user_login, user_password, position_id,
+                                 failed_attempts, block)
+            SELECT 'Bench', 'User', '+7000' || lpad(i::text, 7, '0'), 'bench' || i || '@example.com', 'bench' || i,
+                   :password, 2, 0, 0
+            FROM generate_series(1, :users) AS i
+            """
+        ), {"users": args.users, "password": server.password_hasher.hash(BENCH_PASSWORD)})
+        conn.execute(text(
+            """
+            INSERT INTO "Rooms" (room_id, room_number, floor, capacity, category_id)
+            SELECT i, i::text, 1 + (i - 1) / 50, 1 + i % 4, 1 + i % 5 FROM generate_series(1, :rooms) AS i
+            """
+        ), {"rooms": args.rooms})
+
+    insert_batches(engine, "Clients", args.clients, args.batch, [
+        """
+        INSERT INTO "Clients" (client_id, first_name, last_name, phone, email, registered_at)
+        SELECT i, 'Иван', 'Петров', '+7900' || lpad(i::text, 7, '0'), 'client' || i || '@example.com',
+               now() - (i % 3650) * interval '1 day'
+        FROM generate_series(:lo, :hi) AS i
+        """
+    ], {})
+
+    # Последний год броней — в будущем, чтобы создание брони в нагрузке давало и успехи, и конфликты
+    per_room = -(-args.bookings // args.rooms)
+    start = date.today() - timedelta(days=per_room * STAY_STEP - 365)
+    insert_batches(engine, "Bookings", args.bookings, args.batch, [
+        """
+        INSERT INTO "Bookings" (booking_id, client_id, booking_date, arrival_date, departure_date,
+                                booking_status_id, total_cost)
+        SELECT i, 1 + i % :clients, (s.arrival - (i % 60))::timestamp, s.arrival, s.arrival + 1 + i % 3,
+               1 + i % 3, (1 + i % 3) * (2000 + (i % 5) * 500)
+        FROM generate_series(:lo, :hi) AS i,
+             LATERAL (SELECT CAST(:start AS date) + ((i - 1) / :rooms) * :step AS arrival) AS s
+        """,
+        # stay задается сразу, чтобы триггер booking_rooms_fill_stay не искал бронь для каждой строки
+        """
+        INSERT INTO "BookingRooms" (booking_id, room_id, stay)
+        SELECT i, 1 + (i - 1) % :rooms, daterange(s.arrival, s.arrival + 1 + i % 3, '[)')
+        FROM generate_series(:lo, :hi) AS i,
+             LATERAL (SELECT CAST(:start AS date) + ((i - 1) / :rooms) * :step AS arrival) AS s
+        """,
+    ], {"clients": args.clients, "rooms": args.rooms, "start": start, "step": STAY_STEP})
+
+    insert_batches(engine, "Payments", args.payments, args.batch, [
+        """
+        INSERT INTO "Payments" (booking_id, payment_date, amount, payment_method_id)
+        SELECT b.booking_id, b.arrival_date - (i % 10) + interval '12 hours', b.total_cost / 2, 1 + i % 3
+        FROM generate_series(:lo, :hi) AS i
+        JOIN "Bookings" b ON b.booking_id = 1 + (i - 1) % :bookings
+        """
+    ], {"bookings": args.bookings})
+
+    insert_batches(engine, "Service_Usage", args.usage, args.batch, [
+        """
+        INSERT INTO "Service_Usage" (client_id, service_id, booking_id, usage_date, quantity, cost)
+        SELECT b.client_id, 1 + i % 20, b.booking_id, b.arrival_date + interval '18 hours', 1 + i % 2,
+               (1 + i % 2) * (150 + (i % 20) * 50)
+        FROM generate_series(:lo, :hi) AS i
+        JOIN "Bookings" b ON b.booking_id = 1 + (i - 1) % :bookings
+        """
+    ], {"bookings": args.bookings})
+
+    with engine.begin() as conn:
+        for table, column in (("Rooms", "room_id"), ("Clients", "client_id"), ("Bookings", "booking_id")):
+            conn.execute(text(
+                f"""SELECT setval(pg_get_serial_sequence('"{table}"', '{column}'), (SELECT max({column}) FROM "{table}"))"""
+            ))
+        # Данные залиты мимо сессий приложения: закэшированные клиентами ETag должны устареть
+        conn.execute(server.BUMP_TABLE_VERSIONS_SQL, {"tables": server.versioned(server.VERSIONED_TABLES)})
+    print("SalesAnalysis:", server.backfill_sales(batch_days=365), "дней")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM ANALYZE"))
+
+class Workload:
+    def __init__(self, args, rng: random.Random):
+        self.args = args
+        self.rng = rng
+        self.today = date.today()
+
+    def future_stay(self):
+        # Первый год занят сидом почти целиком, дальше свободно: примерно пополам конфликтов и успехов
+        arrival = self.today + timedelta(days=self.rng.randrange(730))
+        return arrival, arrival + timedelta(days=self.rng.randint(1, 3))
+
+    def login(self, client):
+        return client.post("/login", json={"user_login": f"bench{self.rng.randint(1, self.args.users)}",
+                                           "user_password": BENCH_PASSWORD})
+
+    def create_booking(self, client):
+        # Случайный номер и даты в заселенном будущем: часть попыток упирается в занятые даты (400)
+        arrival, departure = self.future_stay()
+        return client.post("/bookings", json={
+            "client_id": self.rng.randint(1, self.args.clients),
+            "arrival_date": arrival.isoformat(),
+            "departure_date": departure.isoformat(),
+            "booking_status_id": 1,
+            "total_cost": 5000,
+            "room_ids": [self.rng.randint(1, self.args.rooms)],
+        })
+
+    def list_bookings(self, client):
+        return client.get("/bookings", params={"limit": 100, "after": self.rng.randrange(self.args.bookings)})
+
+    def get_booking(self, client):
+        return client.get(f"/bookings/{self.rng.randint(1, self.args.bookings)}")
+
+    def list_payments(self, client):
+        return client.get("/payments", params={"booking_id": self.rng.randint(1, self.args.bookings)})
+
+    def list_rooms(self, client):
+        return client.get("/rooms", params={"category_id": self.rng.randint(1, 5)})
+
+    def available_rooms(self, client):
+        arrival, departure = self.future_stay()
+        return client.get("/rooms/available", params={"arrival_date": arrival.isoformat(),
+                                                       "departure_date": departure.isoformat()})
+
+    def reference(self, client):
+        return client.get(self.rng.choice(["/categories", "/services", "/booking-statuses", "/positions"]))
+
+    def calendar(self, client):
+        return client.get("/calendar", params={"date_from": self.future_stay()[0].isoformat(), "days": 31,
+                                               "floor": self.rng.randint(1, max(1, self.args.rooms // 50))})
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if not hasattr(Workload, name.strip()):
+            sys.exit(f"Неизвестная операция: {name}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+def start_server(args):
+    env = {**os.environ, "WEB_CONCURRENCY": str(args.workers)}
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+                                "serve", "--bind", args.url.split("://", 1)[-1]], env=env)
+    import httpx
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(args.url + "/internal/pool", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    process.terminate()
+    sys.exit("Сервер не запустился за 60 с")
+
+async def drive(args) -> dict:
+    import httpx
+    rng = random.Random(args.seed)
+    workload = Workload(args, rng)
+    weights = parse_mix(args.mix)
+    names, probabilities = list(weights), list(weights.values())
+    samples = {name: [] for name in names}
+    deadline = time.perf_counter() + args.warmup + args.duration
+    measure_from = time.perf_counter() + args.warmup
+
+    async def worker(client):
+        while (now := time.perf_counter()) < deadline:
+            name = rng.choices(names, probabilities)[0]
+            started = time.perf_counter()
+            try:
+                response = await getattr(workload, name)(client)
+                status = response.status_code
+                timing = SERVER_TIMING.search(response.headers.get("server-timing", ""))
+            except httpx.HTTPError as e:
+                # Вместо кода ответа — тип ошибки (таймаут, разрыв соединения)
+                status, timing = type(e).__name__, None
+            if now >= measure_from:
+                samples[name].append((time.perf_counter() - started, status,
+                                      int(timing.group(2)) if timing else -1,
+                                      float(timing.group(1)) if timing else -1.0))
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+    return summarize(samples, args)
+
+def latency_stats(rows: list) -> dict:
+    latencies = np.array([row[0] for row in rows]) * 1000
+    queries = [row[2] for row in rows if row[2] >= 0]
+    db_time = [row[3] for row in rows if row[3] >= 0]
+    statuses = {}
+    for row in rows:
+        statuses[str(row[1])] = statuses.get(str(row[1]), 0) + 1
+    return {
+        "requests": len(rows),
+        "statuses": statuses,
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2) if len(rows) else None,
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2) if len(rows) else None,
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2) if len(rows) else None,
+        "max_ms": round(float(latencies.max()), 2) if len(rows) else None,
+        "queries_per_request": round(float(np.mean(queries)), 2) if queries else None,
+        "db_ms_per_request": round(float(np.mean(db_time)), 2) if db_time else None,
+    }
+
+def summarize(samples: dict, args) -> dict:
+    everything = [row for rows in samples.values() for row in rows]
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "config": {key: getattr(args, key) for key in ("url", "duration", "warmup", "concurrency", "mix", "seed",
+                                                        "rooms", "bookings", "clients", "users")},
+        "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "throughput_rps": round(len(everything) / args.duration, 1),
+        "total": latency_stats(everything),
+        "operations": {name: latency_stats(rows) for name, rows in samples.items()},
+    }
+
+def print_report(result: dict):
+    print(f'{"операция":<16}{"запросов":>9}{"p50 мс":>9}{"p95 мс":>9}{"p99 мс":>9}{"запр/отв":>9}  статусы')
+    for name, stats in [*result["operations"].items(), ("ВСЕГО", result["total"])]:
+        if not stats["requests"]:
+            continue
+        print(f'{name:<16}{stats["requests"]:>9}{stats["p50_ms"]:>9}{stats["p95_ms"]:>9}{stats["p99_ms"]:>9}'
+              f'{stats["queries_per_request"] if stats["queries_per_request"] is not None else "-":>9}  {stats["statuses"]}')
+    print(f'пропускная способность: {result["throughput_rps"]} запр/с')
+
+def run(args):
+    process = start_server(args) if args.start_server else None
+    try:
+        result = asyncio.run(drive(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print(f'{"операция":<16}{"p50":>18}{"p95":>18}{"p99":>18}')
+    names = [*before["operations"], "ВСЕГО"]
+    for name in names:
+        old = before["total"] if name == "ВСЕГО" else before["operations"].get(name)
+        new = after["total"] if name == "ВСЕГО" else after["operations"].get(name)
+        if not old or not new or not old["requests"] or not new["requests"]:
+            continue
+        cells = [f'{old[key]:>7}→{new[key]:<7}{(new[key] - old[key]) / old[key] * 100:+4.0f}%'
+                 for key in ("p50_ms", "p95_ms", "p99_ms")]
+        print(f'{name:<16}' + "".join(f"{cell:>18}" for cell in cells))
+    print(f'запр/с: {before["throughput_rps"]} → {after["throughput_rps"]}')
+
+def add_volume_arguments(parser):
+    parser.add_argument("--rooms", type=int, default=500)
+    parser.add_argument("--bookings", type=int, default=1_000_000)
+    parser.add_argument("--clients", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=50)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="заполнить БД (DATABASE_URL или --pgserver)")
+    add_volume_arguments(seed_parser)
+    seed_parser.add_argument("--payments", type=int, default=2_000_000)
+    seed_parser.add_argument("--usage", type=int, default=3_000_000)
+    seed_parser.add_argument("--batch", type=int, default=200_000)
+    seed_parser.add_argument("--reset", action="store_true", help="очистить все таблицы перед заполнением")
+    seed_parser.add_argument("--pgserver", metavar="DIR", help="поднять встроенный Postgres в каталоге DIR")
+
+    run_parser = commands.add_parser("run", help="смешанная нагрузка по маршрутам API")
+    add_volume_arguments(run_parser)
+    run_parser.add_argument("--url", default="http://127.0.0.1:8000")
+    run_parser.add_argument("--duration", type=float, default=30)
+    run_parser.add_argument("--warmup", type=float, default=5)
+    run_parser.add_argument("--concurrency", type=int, default=32)
+    run_parser.add_argument("--timeout", type=float, default=30)
+    run_parser.add_argument("--mix", default=DEFAULT_MIX, help="операция=вес через запятую")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--output", help="сохранить результат в JSON")
+    run_parser.add_argument("--start-server", action="store_true", help="запустить server.py serve на время прогона")
+    run_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+
+    compare_parser = commands.add_parser("compare", help="сравнить два JSON с результатами")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args()
+    {"seed": seed, "run": run, "compare": compare}[args.command](args)
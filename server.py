@@ -1,23 +1,242 @@
+import asyncio
+import base64
+import contextvars
+import csv
+import functools
+import hashlib
+import hmac
+import inspect
+import io
+import json
+import logging
 import os
-from datetime import datetime, date
-from fastapi import FastAPI, HTTPException, Depends
+import re
+import select
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
+from bisect import bisect_left, insort
+from datetime import datetime, date, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+from typing import Annotated, Any, Optional, get_args
+from urllib.parse import urlencode
+import numpy as np
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.dependencies.utils import solve_dependencies
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr, constr
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.routing import APIRoute, APIRouter
+from pydantic import BaseModel, ConfigDict, EmailStr, TypeAdapter, ValidationError, constr, create_model, model_validator
+from starlette.routing import Match
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, Date, DECIMAL, Text, ForeignKey, func, CheckConstraint
+    create_engine, Column, Integer, BigInteger, String, DateTime, Date, DECIMAL, Float, Numeric, Text, ForeignKey, func,
+    CheckConstraint, event, text, bindparam, cast, literal_column, select as sa_select
 )
+from sqlalchemy.dialects.postgresql import DATERANGE, aggregate_order_by
+from sqlalchemy.engine import Engine, URL, make_url
+from sqlalchemy.exc import DBAPIError, IntegrityError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker, Session, relationship, joinedload, load_only, selectinload
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.util import await_only
 
 DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "1")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME", "Hotel")
-SQLALCHEMY_DATABASE_URL = f"postgresql://postgres:1@localhost:5432/Hotel"
+# Размер пула считается на процесс: pool_size + max_overflow на каждый воркер должны помещаться в max_connections
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0") == "1"
+# Реплика только для чтения: списки и отчеты читаются с нее, пока отставание не больше DB_REPLICA_MAX_LAG секунд.
+# Отставание проверяется раз в DB_REPLICA_CHECK_INTERVAL секунд; после записи клиент DB_REPLICA_STICKY секунд
+# читает с основной БД, чтобы видеть свои изменения
+DB_REPLICA_URL = os.getenv("DB_REPLICA_URL", "")
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "1"))
+DB_REPLICA_STICKY = float(os.getenv("DB_REPLICA_STICKY", str(DB_REPLICA_MAX_LAG + DB_REPLICA_CHECK_INTERVAL)))
+# Без limit= списки по-прежнему отдаются целиком; PAGE_DEFAULT_LIMIT > 0 включает страницу по умолчанию.
+# Это ломает клиентов, которые не читают X-Next-After: они молча получат только первую страницу
+PAGE_DEFAULT_LIMIT = int(os.getenv("PAGE_DEFAULT_LIMIT", "0"))
+PAGE_MAX_LIMIT = int(os.getenv("PAGE_MAX_LIMIT", "1000"))
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+# sync — psycopg2 и синхронные обработчики в пуле потоков, async — asyncpg и обработчики в цикле событий
+DB_MODE = os.getenv("DB_MODE", "sync")
+ASYNC_DB = DB_MODE == "async"
+REFERENCE_CACHE_TTL = float(os.getenv("REFERENCE_CACHE_TTL", "300"))
+REFERENCE_CACHE_SIZE = int(os.getenv("REFERENCE_CACHE_SIZE", "256"))
+# local — сброс кэша только в своем процессе, notify — еще и в остальных воркерах через LISTEN/NOTIFY
+CACHE_INVALIDATION = os.getenv("CACHE_INVALIDATION", "local")
+AVAILABILITY_INDEX_TTL = int(os.getenv("AVAILABILITY_INDEX_TTL", "60"))
+AVAILABILITY_INDEX_DAYS_BACK = int(os.getenv("AVAILABILITY_INDEX_DAYS_BACK", "7"))
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "600"))
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", "64"))
+# Секрет подписи токенов должен совпадать у всех воркеров; без него токены живут до перезапуска процесса
+TOKEN_SECRET = os.getenv("TOKEN_SECRET", "")
+ACCESS_TOKEN_TTL = int(os.getenv("ACCESS_TOKEN_TTL", "900"))
+REFRESH_TOKEN_TTL = int(os.getenv("REFRESH_TOKEN_TTL", str(14 * 24 * 3600)))
+# Режим serve (gunicorn + uvicorn-воркеры)
+BIND = os.getenv("BIND", "0.0.0.0:8000")
+# Отдельный адрес для мониторинга: /internal/* и /metrics на нем доступны без токена, на основном — только админу
+INTERNAL_BIND = os.getenv("INTERNAL_BIND", "")
+ADMIN_POSITION = os.getenv("ADMIN_POSITION", "Админ")
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+BACKLOG = int(os.getenv("BACKLOG", "2048"))
+# Воркер перезапускается после MAX_REQUESTS ± MAX_REQUESTS_JITTER запросов, чтобы не перезапускались все разом
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", "10000"))
+MAX_REQUESTS_JITTER = int(os.getenv("MAX_REQUESTS_JITTER", "1000"))
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT", "60"))
+KEEPALIVE = int(os.getenv("KEEPALIVE", "5"))
+# Одновременных вычислений argon2; каждое занимает ~64 МБ памяти и ядро процессора
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Запросы дольше SLOW_QUERY_MS пишутся в лог (0 — выключено), дольше SLOW_QUERY_EXPLAIN_MS — еще и с планом
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_EXPLAIN_MS = float(os.getenv("SLOW_QUERY_EXPLAIN_MS", "1000"))
+SLOW_QUERY_BUFFER = int(os.getenv("SLOW_QUERY_BUFFER", "100"))
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "50"))
+# Предельный размер файла импорта (/clients/import и др.), тело целиком держится в памяти воркера
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+# Лента изменений GET /changes: сколько последних событий хранит воркер для возобновления,
+# очередь одного подписчика и интервал пустых комментариев, чтобы прокси не закрывали соединение
+CHANGE_FEED_BUFFER = int(os.getenv("CHANGE_FEED_BUFFER", "10000"))
+CHANGE_FEED_QUEUE = int(os.getenv("CHANGE_FEED_QUEUE", "1000"))
+CHANGE_FEED_PING = float(os.getenv("CHANGE_FEED_PING", "15"))
+logger = logging.getLogger("hotel")
+
+SQLALCHEMY_DATABASE_URL = make_url(os.getenv("DATABASE_URL") or URL.create(
+    "postgresql", username=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=int(DB_PORT), database=DB_NAME
+))
+REPLICA_DATABASE_URL = make_url(DB_REPLICA_URL) if DB_REPLICA_URL else None
+
+class PoolStats:
+    # Время получения соединения из пула (включая открытие нового) и число отказов по pool_timeout
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+
+    def record(self, seconds: float, timed_out: bool):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            if seconds > 0.001:
+                self.waited += 1
+            if timed_out:
+                self.timeouts += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "checkouts": self.checkouts,
+                "waited": self.waited,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+def timed_pool(base):
+    stats = PoolStats()
+
+    class TimedPool(base):
+        def _do_get(self):
+            started = time.perf_counter()
+            timed_out = False
+            try:
+                return super()._do_get()
+            except PoolTimeoutError:
+                timed_out = True
+                raise
+            finally:
+                stats.record(time.perf_counter() - started, timed_out)
+
+    TimedPool.stats = stats
+    return TimedPool
+
+def pool_options(base) -> dict:
+    return {
+        "poolclass": timed_pool(base),
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+def pool_statuses() -> dict:
+    pools = {"sync": pool_status(get_engine().pool)}
+    if ASYNC_DB:
+        pools["async"] = pool_status(get_async_engine().pool)
+    if REPLICA_DATABASE_URL is not None:
+        pools["replica"] = {**pool_status((get_async_replica_engine() if ASYNC_DB else get_replica_engine()).pool),
+                            **replica_state.snapshot()}
+    return pools
+
+def pool_status(pool) -> dict:
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "timeout": DB_POOL_TIMEOUT,
+        **pool.stats.snapshot(),
+    }
+
+# Движки создаются при первом обращении к БД, а не при импорте модуля. functools.cache не сериализует
+# первый вызов: параллельные первые запросы из пула потоков создали бы по движку, и лишние пулы
+# соединений остались бы незакрытыми. Поэтому создание идет под блокировкой, дальше — кэш без нее
+def create_once(factory):
+    lock = threading.Lock()
+    created = functools.cache(factory)
+
+    @functools.cache
+    @functools.wraps(factory)
+    def get():
+        with lock:
+            return created()
+    return get
+
+@create_once
+def get_engine():
+    return create_engine(SQLALCHEMY_DATABASE_URL, **pool_options(QueuePool))
+
+@create_once
+def get_async_engine():
+    return create_async_engine(
+        SQLALCHEMY_DATABASE_URL.set(drivername="postgresql+asyncpg"), **pool_options(AsyncAdaptedQueuePool)
+    )
+
+@create_once
+def get_replica_engine():
+    return create_engine(REPLICA_DATABASE_URL, **pool_options(QueuePool))
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+@create_once
+def get_async_replica_engine():
+    return create_async_engine(
+        REPLICA_DATABASE_URL.set(drivername="postgresql+asyncpg"), **pool_options(AsyncAdaptedQueuePool)
+    )
+
+# Фабрики без привязки к движку: bind передается при создании сессии
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+# Ответ сериализуется уже после выхода из сессии, ленивые загрузки там невозможны
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 class Position(Base):
@@ -86,11 +305,29 @@ class Booking(Base):
     departure_date = Column(Date, nullable=False)
     booking_status_id = Column(Integer, ForeignKey("BookingStatus.booking_status_id"), nullable=True)
     total_cost = Column(DECIMAL(10,2), nullable=False)
+    # Только для чтения: связи пишутся SQL-запросами в create_booking/update_booking
+    room_links = relationship("BookingRoom", viewonly=True, order_by="BookingRoom.room_id")
+    # Для include= в GET /bookings; загружаются только явно, через options()
+    client = relationship("Client", viewonly=True)
+    status = relationship("BookingStatus", viewonly=True)
+    rooms = relationship("Room", secondary="BookingRooms", viewonly=True, order_by="Room.room_id")
+    payments = relationship("Payment", viewonly=True, order_by="Payment.payment_id")
+
+    @property
+    def room_ids(self):
+        return [link.room_id for link in self.room_links]
+
+    @property
+    def room_id(self):
+        return self.room_links[0].room_id if self.room_links else None
 
 class BookingRoom(Base):
     __tablename__ = "BookingRooms"
     booking_id = Column(Integer, ForeignKey("Bookings.booking_id", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
     room_id = Column(Integer, ForeignKey("Rooms.room_id", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    # Ночи брони [arrival_date, departure_date) для ограничения booking_rooms_no_overlap: день выезда
+    # свободен, и в него можно заселить следующего гостя
+    stay = Column(DATERANGE)
 
 class PaymentMethod(Base):
     __tablename__ = "PaymentMethod"
@@ -143,7 +380,114 @@ class SalesAnalysis(Base):
         CheckConstraint("additional_services_revenue >= 0", name="check_services_revenue_nonnegative"),
     )
 
-Base.metadata.create_all(bind=engine)
+# Счетчик изменений таблицы для ETag, увеличивается один раз за транзакцию, изменившую таблицу (bump_table_versions)
+class TableVersion(Base):
+    __tablename__ = "TableVersions"
+    table_name = Column(String(100), primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=func.now())
+
+VERSIONED_TABLES = ["Rooms", "Bookings", "BookingRooms", "Cleaning", "Payments", "Service_Usage", "Clients", "BookingStatus"]
+# Удаление строки меняет и таблицы, ссылающиеся на нее с ON DELETE CASCADE / SET NULL
+VERSION_CASCADES = defaultdict(set)
+for _table in Base.metadata.tables.values():
+    for _fk in _table.foreign_keys:
+        if _fk.ondelete in ("CASCADE", "SET NULL"):
+            VERSION_CASCADES[_fk.column.table.name].add(_table.name)
+
+# То, что create_all не умеет: новые столбцы в существующих таблицах, триггеры и ограничения.
+# Все команды идемпотентны.
+SCHEMA_DDL = [
+    'ALTER TABLE "BookingRooms" ADD COLUMN IF NOT EXISTS stay daterange',
+    """
+    UPDATE "BookingRooms" br
+    SET stay = daterange(b.arrival_date, b.departure_date, '[)')
+    FROM "Bookings" b
+    WHERE br.booking_id = b.booking_id AND br.stay IS NULL
+    """,
+    # Прежние версии схемы хранили stay с днем выезда включительно — переводим на полуоткрытый интервал
+    """
+    UPDATE "BookingRooms" br
+    SET stay = daterange(b.arrival_date, b.departure_date, '[)')
+    FROM "Bookings" b
+    WHERE br.booking_id = b.booking_id AND br.stay = daterange(b.arrival_date, b.departure_date, '[]')
+    """,
+    """
+    CREATE OR REPLACE FUNCTION booking_rooms_fill_stay() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.stay IS NULL THEN
+            SELECT daterange(arrival_date, departure_date, '[)') INTO NEW.stay
+            FROM "Bookings" WHERE booking_id = NEW.booking_id;
+        END IF;
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql
+    """,
+    'DROP TRIGGER IF EXISTS booking_rooms_fill_stay ON "BookingRooms"',
+    """
+    CREATE TRIGGER booking_rooms_fill_stay BEFORE INSERT OR UPDATE ON "BookingRooms"
+    FOR EACH ROW EXECUTE FUNCTION booking_rooms_fill_stay()
+    """,
+    """
+    CREATE OR REPLACE FUNCTION bookings_sync_stay() RETURNS trigger AS $$
+    BEGIN
+        UPDATE "BookingRooms" SET stay = daterange(NEW.arrival_date, NEW.departure_date, '[)')
+        WHERE booking_id = NEW.booking_id;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    'DROP TRIGGER IF EXISTS bookings_sync_stay ON "Bookings"',
+    """
+    CREATE TRIGGER bookings_sync_stay AFTER UPDATE OF arrival_date, departure_date ON "Bookings"
+    FOR EACH ROW EXECUTE FUNCTION bookings_sync_stay()
+    """,
+    # int4range вместо room_id WITH = — не нужен btree_gist
+    """
+    DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'booking_rooms_no_overlap') THEN
+            ALTER TABLE "BookingRooms" ADD CONSTRAINT booking_rooms_no_overlap
+                EXCLUDE USING gist (int4range(room_id, room_id, '[]') WITH &&, stay WITH &&);
+        END IF;
+    END $$
+    """,
+    # Одна строка SalesAnalysis на день. Введенные вручную дубли migrate не удаляет — их убирает dedupe-sales
+    """
+    DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'sales_analysis_date_key') THEN
+            IF EXISTS (SELECT 1 FROM "SalesAnalysis" GROUP BY analysis_date HAVING count(*) > 1) THEN
+                RAISE EXCEPTION 'В SalesAnalysis несколько строк на один день, сначала выполните: python server.py dedupe-sales --apply';
+            END IF;
+            CREATE UNIQUE INDEX sales_analysis_date_key ON "SalesAnalysis" (analysis_date);
+        END IF;
+    END $$
+    """,
+    'CREATE INDEX IF NOT EXISTS payments_payment_date_idx ON "Payments" (payment_date)',
+    'CREATE INDEX IF NOT EXISTS service_usage_usage_date_idx ON "Service_Usage" (usage_date)',
+    'CREATE INDEX IF NOT EXISTS bookings_booking_date_idx ON "Bookings" (booking_date)',
+    # Номера событий ленты изменений, общие для всех воркеров
+    "CREATE SEQUENCE IF NOT EXISTS change_feed_seq",
+    # Поиск гостей по началу имени, фамилии, email и цифр телефона (GET /clients/search).
+    # COLLATE "C": такой индекс подходит и для LIKE 'префикс%', и для ORDER BY по тому же выражению
+    'CREATE INDEX IF NOT EXISTS clients_last_name_prefix_idx ON "Clients" ((lower(last_name) COLLATE "C"))',
+    'CREATE INDEX IF NOT EXISTS clients_first_name_prefix_idx ON "Clients" ((lower(first_name) COLLATE "C"))',
+    'CREATE INDEX IF NOT EXISTS clients_email_prefix_idx ON "Clients" ((lower(email) COLLATE "C"))',
+    # Телефон — только цифры, российский номер с 8 приводится к 7
+    r'''
+    CREATE INDEX IF NOT EXISTS clients_phone_digits_idx ON "Clients"
+    ((regexp_replace(regexp_replace(phone, '\D', '', 'g'), '^8(\d{10})$', '7\1') COLLATE "C"))
+    ''',
+]
+# Триггеры версий из прежних версий схемы: каждый оператор блокировал строку TableVersions до commit
+SCHEMA_DDL += [f'DROP TRIGGER IF EXISTS bump_table_version ON "{table}"' for table in VERSIONED_TABLES]
+SCHEMA_DDL.append("DROP FUNCTION IF EXISTS bump_table_version()")
+
+# Создание таблиц и SCHEMA_DDL — отдельной командой `python server.py migrate`, а не при импорте
+def migrate():
+    with get_engine().begin() as conn:
+        # Два одновременных запуска migrate не должны выполнять DDL параллельно
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('hotel_schema'))"))
+        Base.metadata.create_all(bind=conn)
+        for ddl in SCHEMA_DDL:
+            conn.execute(text(ddl))
 
 LETTER_REGEX = r"^[A-Za-zА-Яа-яЁё]+$"
 
@@ -159,6 +503,19 @@ class UserOut(BaseModel):
     class Config:
         orm_mode = True
 
+class TokenOut(BaseModel):
+    access_token: str
+    refresh_token: str
+    token_type: str = "bearer"
+    # Время жизни access_token в секундах
+    expires_in: int
+
+class LoginOut(UserOut, TokenOut):
+    pass
+
+class RefreshData(BaseModel):
+    refresh_token: str
+
 class ClientCreate(BaseModel):
     first_name: constr(pattern=LETTER_REGEX, strip_whitespace=True)
     last_name: constr(pattern=LETTER_REGEX, strip_whitespace=True)
@@ -199,15 +556,90 @@ class CategoryOut(CategoryCreate):
     class Config:
         orm_mode = True
 
-class BookingCreate(BaseModel):
+class CleaningOut(BaseModel):
+    cleaning_id: int
+    room_id: int
+    cleaning_date: datetime
+    cleaning_status: str
+    user_id: Optional[int] = None
+    class Config:
+        orm_mode = True
+
+class BookingStatusOut(BaseModel):
+    booking_status_id: int
+    status_name: str
+    class Config:
+        orm_mode = True
+
+class AvailabilityQuery(BaseModel):
+    arrival_date: date
+    departure_date: date
+    category_id: Optional[int] = None
+    min_capacity: Optional[int] = None
+    room_ids: Optional[list[int]] = None
+
+class AvailabilityOut(AvailabilityQuery):
+    rooms: list[RoomOut]
+
+class CalendarRoomOut(BaseModel):
+    room_id: int
+    room_number: str
+    category_id: int
+    # Run-length кодирование по дням: [[booking_id или 0, число дней], ...]
+    bookings: list[list[int]]
+    # [[код статуса уборки или 0, число дней], ...], коды — индексы cleaning_statuses начиная с 1
+    cleaning: list[list[int]]
+
+class CalendarOut(BaseModel):
+    date_from: date
+    days: int
+    cleaning_statuses: list[str]
+    rooms: list[CalendarRoomOut]
+    occupancy_by_day: list[float]
+    occupancy_by_category: dict[int, float]
+
+class AnalyticsRow(BaseModel):
+    # Начало периода (день, понедельник недели или первое число месяца)
+    period: date
+    # category_id или floor; None — без группировки или платежи/услуги без номера
+    group: Optional[int] = None
+    rooms_available: int
+    rooms_sold: int
+    occupancy: float
+    room_revenue: float
+    adr: float
+    revpar: float
+    service_revenue: float
+    payments: float
+
+class AnalyticsOut(BaseModel):
+    date_from: date
+    date_to: date
+    bucket: str
+    group_by: Optional[str] = None
+    rows: list[AnalyticsRow]
+
+class BookingBase(BaseModel):
     client_id: int
     arrival_date: date
     departure_date: date
     booking_status_id: int
     total_cost: float
-    room_id: int
-
-class BookingOut(BookingCreate):
+    room_id: Optional[int] = None
+    room_ids: list[int] = []
+
+class BookingCreate(BookingBase):
+    # room_id оставлен для старых клиентов, он добавляется первым в room_ids
+    @model_validator(mode="after")
+    def collect_room_ids(self):
+        room_ids = list(dict.fromkeys(([self.room_id] if self.room_id is not None else []) + self.room_ids))
+        if not room_ids:
+            raise ValueError("Нужно указать room_id или room_ids")
+        self.room_ids = room_ids
+        self.room_id = room_ids[0]
+        return self
+
+class BookingOut(BookingBase):
     booking_id: int
     booking_date: datetime
     class Config:
@@ -277,61 +709,1728 @@ class SalesAnalysisOut(SalesAnalysisCreate):
     class Config:
         orm_mode = True
 
+class ClientImport(ClientCreate):
+    registered_at: Optional[datetime] = None
+
+class PaymentImport(PaymentCreate):
+    payment_date: Optional[datetime] = None
+
+class ServiceUsageImport(ServiceUsageCreate):
+    usage_date: Optional[datetime] = None
+
+class ImportRowError(BaseModel):
+    row: int
+    error: str
+
+class ImportResult(BaseModel):
+    total: int
+    inserted: int
+    errors: list[ImportRowError]
+
+class BatchOperation(BaseModel):
+    method: constr(pattern="^(GET|POST|PUT|PATCH|DELETE)$")
+    # В path, query и body строка "$N.поле" заменяется полем из ответа N-й операции (с нуля)
+    path: str
+    query: dict[str, Any] = {}
+    body: Any = None
+
+class BatchData(BaseModel):
+    operations: list[BatchOperation]
+
+class BatchResult(BaseModel):
+    status: int
+    body: Any
+
+class BatchOut(BaseModel):
+    results: list[BatchResult]
+
+
+def run_sync_endpoint(endpoint):
+    if inspect.iscoroutinefunction(endpoint) or "db" not in inspect.signature(endpoint).parameters:
+        return endpoint
+
+    @functools.wraps(endpoint)
+    async def wrapper(**kwargs):
+        db = kwargs.pop("db")
+        return await db.run_sync(lambda session: endpoint(db=session, **kwargs))
+    return wrapper
+
+async def run_db(db, fn, *args):
+    # Работа с сессией из асинхронного обработчика: fn(session, *args) в пуле потоков Starlette
+    # в режиме sync и через AsyncSession.run_sync в режиме async
+    if ASYNC_DB:
+        return await db.run_sync(fn, *args)
+    return await run_in_threadpool(fn, db, *args)
+
+class DBRoute(APIRoute):
+    # В режиме async синхронные обработчики выполняются через AsyncSession.run_sync:
+    # запросы идут через asyncpg в цикле событий, поток из пула Starlette не занимается.
+    # Весь код обработчика, проверка входных данных и сериализация ответа pydantic тоже идут в цикле событий,
+    # поэтому тяжелые вычисления выносятся в пул потоков через run_cpu_task
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, run_sync_endpoint(endpoint) if ASYNC_DB else endpoint, **kwargs)
+
+def run_cpu_task(fn, *args):
+    # В режиме async цикл событий ждет результата через await_only, а не считает сам;
+    # в режиме sync обработчик и так выполняется в потоке Starlette
+    if ASYNC_DB:
+        return await_only(asyncio.get_running_loop().run_in_executor(None, fn, *args))
+    return fn(*args)
+
+password_hasher = PasswordHasher()
+password_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password")
+
+async def run_password_task(fn, *args):
+    # Хеширование в отдельном ограниченном пуле; обработчики входа и смены пароля асинхронные,
+    # поэтому на время хеширования не занят ни цикл событий, ни поток из пула Starlette
+    return await asyncio.get_running_loop().run_in_executor(password_pool, fn, *args)
+
+async def hash_password(password: str) -> str:
+    return await run_password_task(password_hasher.hash, password)
+
+def _check_password(stored: str, password: str) -> tuple[bool, Optional[str]]:
+    if not stored.startswith("$argon2"):
+        # Старые записи с паролем открытым текстом перехешируются при первом успешном входе
+        if hmac.compare_digest(stored.encode(), password.encode()):
+            return True, password_hasher.hash(password)
+        return False, None
+    try:
+        password_hasher.verify(stored, password)
+    except (VerificationError, InvalidHashError):
+        return False, None
+    return True, password_hasher.hash(password) if password_hasher.check_needs_rehash(stored) else None
+
+# (пароль верный, новый хеш для записи или None)
+async def check_password(stored: str, password: str) -> tuple[bool, Optional[str]]:
+    return await run_password_task(_check_password, stored, password)
+
+if not TOKEN_SECRET:
+    logger.warning("TOKEN_SECRET не задан, токены подписываются случайным ключом процесса")
+token_key = TOKEN_SECRET.encode() or os.urandom(32)
+
+class RevokedUsers:
+    # user_id -> время отзыва: токены, выданные раньше, не принимаются. Запись нужна только
+    # пока живы выданные до отзыва access-токены; refresh-токены дополнительно проверяются по БД
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = {}
+
+    def revoke(self, user_id: int, revoked_at: float):
+        with self.lock:
+            self.items[user_id] = max(revoked_at, self.items.get(user_id, 0))
+            expired = time.time() - self.ttl
+            for key in [key for key, value in self.items.items() if value < expired]:
+                del self.items[key]
+
+    def is_revoked(self, user_id: int, issued_at: float) -> bool:
+        revoked_at = self.items.get(user_id)
+        return revoked_at is not None and issued_at < revoked_at
+
+revoked_users = RevokedUsers(ACCESS_TOKEN_TTL)
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def token_signature(body: str) -> str:
+    return b64encode(hmac.new(token_key, body.encode(), hashlib.sha256).digest())
+
+def issue_token(user_id: int, kind: str, ttl: int, **claims) -> str:
+    now = time.time()
+    body = b64encode(json.dumps({"sub": user_id, "typ": kind, "iat": now, "exp": now + ttl, **claims},
+                                separators=(",", ":")).encode())
+    return body + "." + token_signature(body)
+
+def token_error(detail: str) -> HTTPException:
+    return HTTPException(status_code=401, detail=detail, headers={"WWW-Authenticate": "Bearer"})
+
+def read_token(token: str, kind: str) -> dict:
+    body, _, signature = token.partition(".")
+    if not hmac.compare_digest(signature.encode(), token_signature(body).encode()):
+        raise token_error("Недействительный токен")
+    payload = json.loads(b64decode(body))
+    if payload.get("typ") != kind:
+        raise token_error("Недействительный токен")
+    if payload["exp"] < time.time():
+        raise token_error("Срок действия токена истек")
+    if revoked_users.is_revoked(payload["sub"], payload["iat"]):
+        raise token_error("Токен отозван")
+    return payload
+
+def password_fingerprint(user) -> str:
+    # Refresh-токен перестает действовать после смены пароля, даже если процесс перезапускался
+    return hashlib.sha256(user.user_password.encode()).hexdigest()[:16]
+
+def is_admin(db: Session, user) -> bool:
+    return user.position_id is not None and db.query(Position.position_name).filter(
+        Position.position_id == user.position_id).scalar() == ADMIN_POSITION
+
+def issue_tokens(user, admin: bool = False) -> dict:
+    # Признак админа в access-токене: служебные маршруты проверяют его без запроса к БД
+    access_claims = {"adm": True} if admin else {}
+    return {
+        "access_token": issue_token(user.user_id, "access", ACCESS_TOKEN_TTL, **access_claims),
+        "refresh_token": issue_token(user.user_id, "refresh", REFRESH_TOKEN_TTL, pwd=password_fingerprint(user)),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_TTL,
+    }
+
+def revoke_tokens(db: Session, user_id: int):
+    # Отзыв рассылается всем воркерам независимо от CACHE_INVALIDATION: иначе в остальных процессах
+    # отозванный access-токен действовал бы до истечения срока
+    revoked_at = time.time()
+    db.execute(text("SELECT pg_notify('token_revoked', :payload)"), {"payload": f"{user_id}:{revoked_at}"})
+    after_commit(db, lambda: revoked_users.revoke(user_id, revoked_at))
+
+def on_token_revoked(payload: str):
+    user_id, revoked_at = payload.split(":")
+    revoked_users.revoke(int(user_id), float(revoked_at))
+
+# Проверка access-токена без запроса к БД; возвращает user_id
+def access_payload(authorization: Optional[str]) -> dict:
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise token_error("Требуется авторизация")
+    try:
+        return read_token(token.strip(), "access")
+    except (ValueError, KeyError, TypeError):
+        raise token_error("Недействительный токен")
+
+async def current_user(authorization: Optional[str] = Header(None)) -> int:
+    return access_payload(authorization)["sub"]
+
+def bind_port(bind: str) -> Optional[int]:
+    host, _, port = bind.rpartition(":")
+    return int(port) if host and port.isdigit() else None
+
+INTERNAL_PORT = bind_port(INTERNAL_BIND)
+
+# Служебные маршруты: запросы, пришедшие на INTERNAL_BIND, или access-токен админа.
+# Токен проверяется без БД, поэтому /internal/pool отвечает и при исчерпанном пуле
+async def internal_access(request: Request, authorization: Optional[str] = Header(None)):
+    server = request.scope.get("server") or (None, None)
+    if INTERNAL_PORT is not None and server[1] == INTERNAL_PORT:
+        return
+    if not access_payload(authorization).get("adm"):
+        raise HTTPException(status_code=403, detail="Недостаточно прав")
+
+class TTLCache:
+    # LRU с ограничением по размеру и времени жизни. Ключ — кортеж, первый элемент — имя таблицы;
+    # поколение таблицы не дает записать в кэш результат запроса, начатого до сброса
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.generations = {}
+
+    def generation(self, table: str) -> int:
+        with self.lock:
+            return self.generations.get(table, 0)
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value, generation: int):
+        with self.lock:
+            if self.generations.get(key[0], 0) != generation:
+                return
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def invalidate(self, table: Optional[str] = None):
+        with self.lock:
+            tables = [table] if table else list({key[0] for key in self.items} | set(self.generations))
+            for name in tables:
+                self.generations[name] = self.generations.get(name, 0) + 1
+            for key in [key for key in self.items if key[0] in tables]:
+                del self.items[key]
+
+reference_cache = TTLCache(REFERENCE_CACHE_TTL, REFERENCE_CACHE_SIZE)
+# Ключ содержит версии таблиц из TableVersions, поэтому явный сброс не нужен
+analytics_cache = TTLCache(ANALYTICS_CACHE_TTL, ANALYTICS_CACHE_SIZE)
+
+class PgListener(threading.Thread):
+    # LISTEN на отдельном соединении вне пула; обработчики вызываются в этом потоке.
+    # После переподключения вызываются on_reconnect — уведомления за время обрыва потеряны.
+    def __init__(self):
+        super().__init__(name="pg-listener", daemon=True)
+        self.handlers = {}
+        self.on_reconnect = []
+
+    def subscribe(self, channel: str, handler):
+        self.handlers.setdefault(channel, []).append(handler)
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                logger.exception("LISTEN connection lost")
+                time.sleep(5)
+
+    def listen(self):
+        engine = get_engine()
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        conn = engine.dialect.connect(*cargs, **cparams)
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            for channel in self.handlers:
+                cursor.execute(f'LISTEN "{channel}"')
+            for callback in self.on_reconnect:
+                callback()
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    for handler in self.handlers.get(notify.channel, []):
+                        handler(notify.payload)
+        finally:
+            conn.close()
+
+class ChangeFeed:
+    # Последние события и подписчики GET /changes в этом воркере. События приходят из потока pg_listener,
+    # подписчики живут в цикле событий: на каждый цикл — один call_soon_threadsafe на событие
+    def __init__(self, size: int):
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=size)
+        self.subscribers = {}
+
+    def on_notify(self, payload: str):
+        event = json.loads(payload)
+        event["data"] = payload
+        with self.lock:
+            self.events.append(event)
+            targets = [(loop, list(subscribers)) for loop, subscribers in self.subscribers.items()]
+        for loop, subscribers in targets:
+            loop.call_soon_threadsafe(self.deliver, subscribers, event)
+
+    def reset(self):
+        # После переподключения LISTEN часть событий потеряна: подписчики перечитывают данные заново
+        with self.lock:
+            self.events.clear()
+            targets = [(loop, list(subscribers)) for loop, subscribers in self.subscribers.items()]
+        for loop, subscribers in targets:
+            loop.call_soon_threadsafe(self.deliver, subscribers, None)
+
+    @staticmethod
+    def deliver(subscribers: list, event: Optional[dict]):
+        for subscriber in subscribers:
+            subscriber.offer(event)
+
+    def subscribe(self, subscriber: "ChangeSubscriber", after: Optional[int]) -> Optional[list]:
+        # Регистрация и снимок буфера под одной блокировкой: событие попадает либо в снимок, либо в очередь.
+        # Возвращает события после after или None, если after уже нет в буфере
+        with self.lock:
+            self.subscribers.setdefault(subscriber.loop, set()).add(subscriber)
+            events = list(self.events)
+        if after is None:
+            return []
+        for index, event in enumerate(events):
+            if event["seq"] == after:
+                return [event for event in events[index + 1:] if event["topic"] in subscriber.topics]
+        return None
+
+    def unsubscribe(self, subscriber: "ChangeSubscriber"):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.loop)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[subscriber.loop]
+
+class ChangeSubscriber:
+    def __init__(self, topics: set):
+        self.loop = asyncio.get_running_loop()
+        self.topics = topics
+        self.queue = asyncio.Queue(maxsize=CHANGE_FEED_QUEUE)
+        self.lost = False
+
+    def offer(self, event: Optional[dict]):
+        # None — события потеряны (переподключение LISTEN); переполненная очередь означает то же самое.
+        # None кладется и в очередь, чтобы разбудить ожидающий поток ответа
+        if event is not None and event["topic"] not in self.topics:
+            return
+        if event is None:
+            self.lost = True
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lost = True
+
+change_feed = ChangeFeed(CHANGE_FEED_BUFFER)
+
+pg_listener = PgListener()
+pg_listener.subscribe("changes", change_feed.on_notify)
+pg_listener.on_reconnect.append(change_feed.reset)
+pg_listener.subscribe("token_revoked", on_token_revoked)
+if CACHE_INVALIDATION == "notify":
+    pg_listener.subscribe("reference_cache", reference_cache.invalidate)
+    pg_listener.on_reconnect.append(reference_cache.invalidate)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if pg_listener.handlers and not pg_listener.is_alive():
+        pg_listener.start()
+    yield
+
+class RequestStats:
+    __slots__ = ("queries", "db_time", "scope", "wrote")
+
+    def __init__(self, scope: dict):
+        self.queries = 0
+        self.db_time = 0.0
+        self.scope = scope
+        # Запрос зафиксировал изменения (отмечает _bump_table_versions)
+        self.wrote = False
+
+    @property
+    def route(self) -> str:
+        route = self.scope.get("route")
+        return f'{self.scope["method"]} {getattr(route, "path_format", self.scope["path"])}'
+
+# Счетчики текущего запроса; контекст копируется в поток пула Starlette и в greenlet run_sync
+request_stats = contextvars.ContextVar("request_stats", default=None)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats = request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS and not statement.lstrip()[:7].upper() == "EXPLAIN":
+        record_slow_query(statement, parameters, executemany, elapsed, stats.route if stats else None, conn.engine)
+
+# Последние медленные запросы для /internal/slow-queries, план дописывается, когда EXPLAIN выполнится
+slow_queries = deque(maxlen=SLOW_QUERY_BUFFER)
+explain_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+explain_slots = threading.BoundedSemaphore(2)
+explained_at = {}
+explain_tasks = set()
+
+def redact_value(value):
+    # Числа и даты помогают понять план, строки (телефоны, email, пароли) в лог не попадают
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return f"<{len(value)} значений>"
+    return f"<{type(value).__name__}>"
+
+def redact_parameters(parameters, executemany: bool):
+    if executemany:
+        return {"rows": len(parameters), "first": redact_parameters(parameters[0], False) if parameters else None}
+    if isinstance(parameters, dict):
+        return {key: redact_value(value) for key, value in parameters.items()}
+    return [redact_value(value) for value in parameters or ()]
+
+def record_slow_query(statement: str, parameters, executemany: bool, elapsed: float, route: Optional[str],
+                      engine: Engine):
+    entry = {
+        "at": datetime.now(timezone.utc).isoformat(),
+        "route": route,
+        "database": engine.url.render_as_string(hide_password=True),
+        "duration_ms": round(elapsed * 1000, 1),
+        "statement": " ".join(statement.split()),
+        "parameters": redact_parameters(parameters, executemany),
+        "plan": None,
+    }
+    logger.warning("Медленный запрос %.1f мс (%s): %s; параметры: %s",
+                   entry["duration_ms"], route, entry["statement"], entry["parameters"])
+    slow_queries.append(entry)
+    if executemany or elapsed * 1000 < SLOW_QUERY_EXPLAIN_MS:
+        return
+    # Один и тот же запрос разбирается не чаще раза в минуту и не больше двух EXPLAIN одновременно
+    now = time.monotonic()
+    if now - explained_at.get(statement, -60) < 60 or not explain_slots.acquire(blocking=False):
+        return
+    if len(explained_at) > 1000:
+        explained_at.clear()
+    explained_at[statement] = now
+    # Запрос повторяется тем же движком (основная БД или реплика) и тем же драйвером:
+    # у psycopg2 и asyncpg разный формат параметров
+    if engine.dialect.is_async:
+        task = asyncio.get_running_loop().create_task(explain_async(entry, statement, parameters, engine),
+                                                      context=contextvars.Context())
+        explain_tasks.add(task)
+        task.add_done_callback(explain_tasks.discard)
+    else:
+        explain_pool.submit(explain_sync, entry, statement, parameters, engine)
+
+def explain_prefix(statement: str) -> str:
+    # ANALYZE выполняет запрос, поэтому только для чтения; изменяющие запросы — план без выполнения
+    head = statement.lstrip().upper()
+    read_only = head.startswith(("SELECT", "WITH")) and not any(
+        word in head for word in ("INSERT ", "UPDATE", "DELETE "))
+    return "EXPLAIN (ANALYZE, BUFFERS) " if read_only else "EXPLAIN "
+
+def explain_sync(entry: dict, statement: str, parameters, engine: Engine):
+    try:
+        with engine.connect() as conn:
+            conn.exec_driver_sql("SET LOCAL statement_timeout = 30000")
+            rows = conn.exec_driver_sql(explain_prefix(statement) + statement, parameters).fetchall()
+            conn.rollback()
+        entry["plan"] = "\n".join(row[0] for row in rows)
+    except Exception as e:
+        entry["plan"] = f"EXPLAIN не выполнен: {e}"
+    finally:
+        explain_slots.release()
 
-app = FastAPI(title="Hotel Backend API")
+async def explain_async(entry: dict, statement: str, parameters, engine: Engine):
+    try:
+        # engine — синхронный движок внутри AsyncEngine, обертка использует тот же пул
+        async with AsyncEngine(engine).connect() as conn:
+            await conn.exec_driver_sql("SET LOCAL statement_timeout = 30000")
+            rows = (await conn.exec_driver_sql(explain_prefix(statement) + statement, tuple(parameters))).fetchall()
+            await conn.rollback()
+        entry["plan"] = "\n".join(row[0] for row in rows)
+    except Exception as e:
+        entry["plan"] = f"EXPLAIN не выполнен: {e}"
+    finally:
+        explain_slots.release()
+
+@event.listens_for(Engine, "handle_error")
+def _query_failed(context):
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+    def lines(self, name: str, labels: str) -> list[str]:
+        result, cumulative = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            result.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        result.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        result.append(f"{name}_sum{{{labels}}} {self.total}")
+        result.append(f"{name}_count{{{labels}}} {self.count}")
+        return result
+
+class Metrics:
+    # Метрики своего процесса: при нескольких воркерах каждый отдает свои, Prometheus суммирует по instance
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = defaultdict(int)
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.sizes = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+        self.db_time = defaultdict(float)
+
+    def observe(self, method: str, route: str, status: int, elapsed: float, size: int, stats: RequestStats):
+        key = (method, route)
+        with self.lock:
+            self.requests[key + (status,)] += 1
+            self.latency[key].observe(elapsed)
+            self.sizes[key].observe(size)
+            self.queries[key].observe(stats.queries)
+            self.db_time[key] += stats.db_time
+
+    def render(self) -> str:
+        lines = [
+            "# HELP http_requests_in_flight Requests being processed",
+            "# TYPE http_requests_in_flight gauge",
+            f"http_requests_in_flight {self.in_flight}",
+            "# HELP http_requests_total Requests by route and status",
+            "# TYPE http_requests_total counter",
+        ]
+        with self.lock:
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+            for name, help_text, histograms in (
+                ("http_request_duration_seconds", "Request latency", self.latency),
+                ("http_response_size_bytes", "Response body size", self.sizes),
+                ("db_queries_per_request", "SQL statements per request", self.queries),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for (method, route), histogram in sorted(histograms.items()):
+                    lines += histogram.lines(name, f'method="{method}",route="{route}"')
+            lines += ["# HELP db_time_seconds_total Time spent in SQL statements",
+                      "# TYPE db_time_seconds_total counter"]
+            for (method, route), value in sorted(self.db_time.items()):
+                lines.append(f'db_time_seconds_total{{method="{method}",route="{route}"}} {value}')
+        for mode, status in pool_statuses().items():
+            for key in ("checked_out", "idle", "overflow"):
+                lines.append(f'db_pool_{key}{{pool="{mode}"}} {status[key]}')
+            lines.append(f'db_pool_timeouts_total{{pool="{mode}"}} {status["timeouts"]}')
+        if REPLICA_DATABASE_URL is not None:
+            replica = replica_state.snapshot()
+            if replica["lag_seconds"] is not None:
+                lines.append(f'db_replica_lag_seconds {replica["lag_seconds"]}')
+            for target in ("replica", "primary"):
+                lines.append(f'db_reads_total{{target="{target}"}} {replica["reads_" + target]}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class MetricsMiddleware:
+    # Чистый ASGI без BaseHTTPMiddleware: тело ответа не буферизуется, стриминг не ломается
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats(scope)
+        token = request_stats.set(stats)
+        started = time.perf_counter()
+        response = {"status": 500, "size": 0}
+        metrics.in_flight += 1
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                app_time = (time.perf_counter() - started - stats.db_time) * 1000
+                timing = f'app;dur={app_time:.1f}, db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"'
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"server-timing", timing.encode())]}
+            elif message["type"] == "http.response.body":
+                response["size"] += len(message.get("body", b""))
+            await send(message)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            metrics.in_flight -= 1
+            request_stats.reset(token)
+            # Шаблон пути, а не сам путь, чтобы не плодить метки; несуществующие пути — одной меткой
+            route = getattr(scope.get("route"), "path_format", None) or "unmatched"
+            metrics.observe(scope["method"], route, response["status"], time.perf_counter() - started,
+                            response["size"], stats)
+
+class PrimaryAfterWriteMiddleware:
+    # После успешной записи клиент на DB_REPLICA_STICKY секунд закрепляется за основной БД (cookie),
+    # иначе следующий GET мог бы прочитать с отстающей реплики данные без только что сделанного изменения.
+    # Запросы, которые ничего не записали (/login, POST /rooms/available, /batch из одних GET), cookie не получают.
+    # Стоит внутри MetricsMiddleware: признак записи берется из ее RequestStats
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        stats = request_stats.get()
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS") or stats is None:
+            return await self.app(scope, receive, send)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and message["status"] < 400 and stats.wrote:
+                cookie = (f"{PRIMARY_COOKIE}={time.time() + DB_REPLICA_STICKY:.3f}; "
+                          f"Max-Age={int(DB_REPLICA_STICKY) + 1}; Path=/; HttpOnly; SameSite=Lax")
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+router = APIRouter(route_class=DBRoute)
+
+if ASYNC_DB:
+    async def get_db():
+        async with AsyncSessionLocal(bind=get_async_engine()) as db:
+            yield db
+else:
+    def get_db():
+        db = SessionLocal(bind=get_engine())
+        try:
+            yield db
+        finally:
+            db.close()
+
+# Отставание реплики: на простаивающей основной БД время последней проигранной транзакции стареет,
+# поэтому при догнавшем WAL отставание считается нулевым. Не реплика (тот же URL) — тоже ноль
+REPLICA_LAG_SQL = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() <= pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END"
 )
+PRIMARY_COOKIE = "db_primary"
+
+class ReplicaState:
+    # Последнее измеренное отставание и счетчики чтений; проверку выполняет один запрос за интервал
+    def __init__(self, max_lag: float, interval: float):
+        self.max_lag = max_lag
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.checked_at = float("-inf")
+        self.lag = None
+        self.reads = Counter()
+
+    def route(self) -> str:
+        # check — проверить отставание на сессии реплики, replica или primary — куда читать без проверки
+        with self.lock:
+            now = time.monotonic()
+            if now - self.checked_at >= self.interval:
+                self.checked_at = now
+                return "check"
+            return "replica" if self.usable() else "primary"
+
+    def usable(self) -> bool:
+        return self.lag is not None and self.lag <= self.max_lag
+
+    def record(self, lag: Optional[float]) -> bool:
+        with self.lock:
+            was_usable, self.lag = self.usable(), lag
+            if was_usable and lag is not None and lag > self.max_lag:
+                logger.warning("Реплика отстает на %s с, чтение переключено на основную БД", lag)
+            return self.usable()
+
+    def count(self, target: str):
+        with self.lock:
+            self.reads[target] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"lag_seconds": self.lag, "max_lag_seconds": self.max_lag,
+                    "reads_replica": self.reads["replica"], "reads_primary": self.reads["primary"]}
+
+replica_state = ReplicaState(DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL)
+
+def pinned_to_primary(request: Request) -> bool:
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
 
-def get_db():
-    db = SessionLocal()
+def replica_ready(db: Session, check: bool) -> bool:
+    # Соединение берется сразу: если реплика недоступна, запрос уходит на основную БД еще до обработчика
     try:
-        yield db
-    finally:
-        db.close()
+        if not check:
+            db.connection()
+            return True
+        lag = db.execute(REPLICA_LAG_SQL).scalar()
+    # asyncpg при недоступном сервере бросает OSError без обертки DBAPIError
+    except (DBAPIError, OSError) as e:
+        db.rollback()
+        logger.warning("Реплика недоступна: %s", e)
+        lag = None
+    return replica_state.record(None if lag is None else float(lag))
+
+# Сессия для списков и отчетов: реплика, если она настроена, догнала основную БД и клиент недавно ничего не писал.
+# Проверка отставания идет на соединении, которое потом обслужит сам запрос. Справочники (cached_page)
+# и /rooms/available остаются на основной БД: кэш и индекс занятости перечитываются сразу после записи,
+# и с отстающей реплики в них попали бы старые данные
+if ASYNC_DB:
+    async def get_read_db(request: Request):
+        if REPLICA_DATABASE_URL is not None and not pinned_to_primary(request):
+            route = replica_state.route()
+            if route != "primary":
+                async with AsyncSessionLocal(bind=get_async_replica_engine(), info={"replica": True}) as db:
+                    if await db.run_sync(replica_ready, route == "check"):
+                        replica_state.count("replica")
+                        yield db
+                        return
+        if REPLICA_DATABASE_URL is not None:
+            replica_state.count("primary")
+        async with AsyncSessionLocal(bind=get_async_engine()) as db:
+            yield db
+else:
+    def get_read_db(request: Request):
+        db = None
+        if REPLICA_DATABASE_URL is not None and not pinned_to_primary(request):
+            route = replica_state.route()
+            if route != "primary":
+                db = SessionLocal(bind=get_replica_engine(), info={"replica": True})
+                if not replica_ready(db, route == "check"):
+                    db.close()
+                    db = None
+        if REPLICA_DATABASE_URL is not None:
+            replica_state.count("primary" if db is None else "replica")
+        if db is None:
+            db = SessionLocal(bind=get_engine())
+        try:
+            yield db
+        finally:
+            db.close()
+
+class PageParams:
+    def __init__(
+        self,
+        limit: Optional[int] = Query(None, ge=1, le=PAGE_MAX_LIMIT),
+        after: Optional[int] = Query(None, ge=0),
+        stream: bool = False,
+        fast: bool = False,
+        # Список полей через запятую: в SELECT попадают только они, ответ собирается быстрым путем
+        fields: Optional[str] = None,
+    ):
+        # None — без ограничения: query.limit(None) ничего не добавляет, X-Next-After не выставляется
+        self.limit = limit or PAGE_DEFAULT_LIMIT or None
+        self.after = after
+        self.stream = stream
+        self.fast = fast
+        self.fields = fields
+
+def filter_dates(query, column, date_from: Optional[date], date_to: Optional[date]):
+    # Границы включительные, сравнение без func.date(), чтобы работал индекс
+    if date_from is not None:
+        query = query.filter(column >= datetime.combine(date_from, datetime.min.time()))
+    if date_to is not None:
+        query = query.filter(column < datetime.combine(date_to + timedelta(days=1), datetime.min.time()))
+    return query
+
+def stream_ndjson(query, schema, fast: Optional[tuple] = None):
+    if fast is not None:
+        def encode(rows):
+            return b"".join(orjson.dumps(item) + b"\n" for item in fast_items(rows, schema, *fast))
+    else:
+        def encode(rows):
+            return "".join(schema.model_validate(row, from_attributes=True).model_dump_json() + "\n" for row in rows)
+
+    # Отдельная сессия живет столько же, сколько поток, строки читаются серверным курсором
+    # с той же БД (основной или реплики), что и сессия запроса
+    replica = query.session.info.get("replica", False)
+    if ASYNC_DB:
+        async def generate_async():
+            async with AsyncSessionLocal(bind=get_async_replica_engine() if replica else get_async_engine()) as db:
+                execute = db.stream if fast is not None else db.stream_scalars
+                result = await execute(query.statement.execution_options(yield_per=STREAM_BATCH_SIZE))
+                async for rows in result.partitions():
+                    yield encode(rows)
+        return StreamingResponse(generate_async(), media_type="application/x-ndjson")
+
+    def generate():
+        db = SessionLocal(bind=get_replica_engine() if replica else get_engine())
+        try:
+            rows = []
+            for row in query.with_session(db).yield_per(STREAM_BATCH_SIZE):
+                rows.append(row)
+                if len(rows) >= STREAM_BATCH_SIZE:
+                    yield encode(rows)
+                    rows = []
+            if rows:
+                yield encode(rows)
+        finally:
+            db.close()
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+# Действия, которые нужно выполнить только после успешного commit (кэши, индексы в памяти)
+def after_commit(db: Session, fn):
+    db.info.setdefault("after_commit", []).append(fn)
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(session):
+    callbacks = session.info.pop("after_commit", [])
+    # В /batch commit обработчика фиксирует только точку сохранения: действия ждут общего commit
+    deferred = session.info.get("deferred_after_commit")
+    if deferred is not None:
+        deferred.extend(callbacks)
+        return
+    for fn in callbacks:
+        fn()
+
+@event.listens_for(Session, "after_rollback")
+def _drop_after_commit(session):
+    session.info.pop("after_commit", None)
+    session.info.pop("sales_delta", None)
+    session.info.pop("changes", None)
+    session.info.pop("touched_tables", None)
+
+# Версии таблиц (ETag, кэш /analytics) увеличиваются одним запросом перед commit. Изменения через ORM
+# отмечаются сами (after_flush), запросы text() — через touch_tables. Строки TableVersions блокируются
+# в порядке имен таблиц: параллельные транзакции не ждут друг друга по кругу
+BUMP_TABLE_VERSIONS_SQL = text(
+    """
+    INSERT INTO "TableVersions" (table_name, version, updated_at)
+    SELECT t, 1, now() AT TIME ZONE 'utc' FROM unnest(CAST(:tables AS text[])) AS t ORDER BY t
+    ON CONFLICT (table_name) DO UPDATE
+    SET version = "TableVersions".version + 1, updated_at = EXCLUDED.updated_at
+    RETURNING table_name, version
+    """
+)
+
+def touch_tables(db: Session, *tables: str, cascade: bool = False):
+    touched = db.info.setdefault("touched_tables", set())
+    for table in tables:
+        touched.add(table)
+        if cascade:
+            touch_tables(db, *VERSION_CASCADES[table], cascade=True)
+
+@event.listens_for(Session, "after_flush")
+def _touch_flushed_tables(session, flush_context):
+    touch_tables(session, *{obj.__table__.name for obj in session.new})
+    touch_tables(session, *{obj.__table__.name for obj in session.dirty
+                            if session.is_modified(obj, include_collections=False)})
+    touch_tables(session, *{obj.__table__.name for obj in session.deleted}, cascade=True)
+
+def versioned(tables) -> list:
+    return sorted(set(tables) & set(VERSIONED_TABLES))
+
+@event.listens_for(Session, "before_commit")
+def _bump_table_versions(session):
+    # commit сбрасывает изменения в БД уже после before_commit, поэтому flush — здесь
+    session.flush()
+    touched = session.info.pop("touched_tables", ())
+    stats = request_stats.get()
+    if touched and stats is not None:
+        stats.wrote = True
+    tables = versioned(touched)
+    # Новые версии нужны действиям after_commit (room_index); в /batch версии увеличиваются
+    # один раз перед общим commit (batch_session), и там же записываются
+    session.info["table_versions"] = {}
+    batch_tables = session.info.get("batch_tables")
+    if batch_tables is not None:
+        batch_tables.update(tables)
+    elif tables:
+        session.info["table_versions"] = dict(session.execute(BUMP_TABLE_VERSIONS_SQL, {"tables": tables}).fetchall())
+
+# События ленты изменений уходят через NOTIFY перед commit: подписчики получат их, только если транзакция
+# зафиксирована. Postgres доставляет уведомления в порядке фиксации транзакций, а seq выдается раньше,
+# до commit, поэтому у параллельных транзакций seq в ленте может идти не по возрастанию
+# (ChangeFeed.subscribe ищет after по позиции в буфере, а не сравнением seq)
+def publish(db: Session, topic: str, action: str, id: int):
+    db.info.setdefault("changes", []).append((topic, action, id))
+
+@event.listens_for(Session, "before_commit")
+def _publish_changes(session):
+    changes = session.info.pop("changes", None)
+    if not changes:
+        return
+    topics, actions, ids = zip(*changes)
+    session.execute(text(
+        """
+        SELECT pg_notify('changes', json_build_object(
+            'seq', nextval('change_feed_seq'), 'topic', c.topic, 'action', c.action, 'id', c.id)::text)
+        FROM unnest(CAST(:topics AS text[]), CAST(:actions AS text[]), CAST(:ids AS integer[]))
+             WITH ORDINALITY AS c(topic, action, id, n)
+        ORDER BY c.n
+        """
+    ), {"topics": list(topics), "actions": list(actions), "ids": list(ids)})
+
+class SalesDriftError(Exception):
+    # Итоги SalesAnalysis ушли в минус. Ошибка бизнес-логики, а не HTTP: импорт и команды CLI получают ее как есть,
+    # обработчики отвечают 409 (sales_drift_handler, /batch)
+    def __init__(self):
+        super().__init__("Итоги продаж расходятся с данными, требуется пересчет SalesAnalysis")
+
+# Изменения дневных итогов SalesAnalysis копятся в сессии и пишутся одним запросом перед commit.
+# day=None — текущая дата БД (для строк, у которых дата ставится по умолчанию now()).
+def apply_sales_delta(db: Session, day: Optional[date], revenue=0, rooms: int = 0, services=0):
+    if revenue or rooms or services:
+        db.info.setdefault("sales_delta", []).append((day, revenue, rooms, services))
+
+@event.listens_for(Session, "before_commit")
+def _write_sales_delta(session):
+    deltas = session.info.pop("sales_delta", None)
+    if not deltas:
+        return
+    days, revenue, rooms, services = zip(*deltas)
+    # Строки дней блокируются по порядку дат, чтобы параллельные транзакции не ловили deadlock.
+    # Проверки rooms_sold/additional_services_revenue >= 0 срабатывают до ON CONFLICT,
+    # поэтому существующие дни обновляются отдельно, а вставляются только новые.
+    # Дельты не обрезаются нулем: отрицательный итог значит, что SalesAnalysis разошелся с исходными таблицами.
+    try:
+        session.execute(text(
+            """
+            WITH delta AS (
+                SELECT COALESCE(d.day, CURRENT_DATE) AS day, sum(d.revenue) AS revenue,
+                       sum(d.rooms) AS rooms, sum(d.services) AS services
+                FROM unnest(CAST(:days AS date[]), CAST(:revenue AS numeric[]),
+                            CAST(:rooms AS integer[]), CAST(:services AS numeric[])) AS d(day, revenue, rooms, services)
+                GROUP BY 1
+            ), locked AS (
+                SELECT analysis_date FROM "SalesAnalysis"
+                WHERE analysis_date IN (SELECT day FROM delta)
+                ORDER BY analysis_date FOR UPDATE
+            ), updated AS (
+                UPDATE "SalesAnalysis" s
+                SET total_revenue = s.total_revenue + delta.revenue,
+                    rooms_sold = s.rooms_sold + delta.rooms,
+                    additional_services_revenue = s.additional_services_revenue + delta.services
+                FROM delta JOIN locked ON locked.analysis_date = delta.day
+                WHERE s.analysis_date = delta.day
+                RETURNING s.analysis_date
+            )
+            INSERT INTO "SalesAnalysis" (analysis_date, total_revenue, rooms_sold, additional_services_revenue)
+            SELECT day, revenue, rooms, services FROM delta
+            WHERE day NOT IN (SELECT analysis_date FROM updated)
+            ORDER BY day
+            ON CONFLICT (analysis_date) DO UPDATE
+            SET total_revenue = "SalesAnalysis".total_revenue + EXCLUDED.total_revenue,
+                rooms_sold = "SalesAnalysis".rooms_sold + EXCLUDED.rooms_sold,
+                additional_services_revenue = "SalesAnalysis".additional_services_revenue + EXCLUDED.additional_services_revenue
+            """
+        ), {"days": list(days), "revenue": list(revenue), "rooms": list(rooms), "services": list(services)})
+    except IntegrityError as e:
+        logger.error("Итоги SalesAnalysis ушли в минус, нужен backfill-sales: %s", e.orig)
+        raise SalesDriftError() from e
+
+# Суммы по дням для строк, которые удаляются каскадом: [(день, значение), ...]
+def sales_by_day(db: Session, date_column, value, *criteria) -> list:
+    day = func.date(date_column)
+    return db.query(day, value).filter(date_column.isnot(None), *criteria).group_by(day).all()
+
+# Пересчет SalesAnalysis по исходным таблицам окнами по batch_days дней, каждое окно — своя транзакция
+def backfill_sales(date_from: Optional[date] = None, date_to: Optional[date] = None, batch_days: int = 31):
+    with get_engine().connect() as conn:
+        bounds = conn.execute(text(
+            """
+            SELECT least(min(payment_date)::date, (SELECT min(usage_date)::date FROM "Service_Usage"),
+                         (SELECT min(booking_date)::date FROM "Bookings"),
+                         (SELECT min(analysis_date) FROM "SalesAnalysis")),
+                   greatest(max(payment_date)::date, (SELECT max(usage_date)::date FROM "Service_Usage"),
+                            (SELECT max(booking_date)::date FROM "Bookings"),
+                            (SELECT max(analysis_date) FROM "SalesAnalysis"))
+            FROM "Payments"
+            """
+        )).one()
+    date_from = date_from or bounds[0]
+    date_to = date_to or bounds[1]
+    if date_from is None or date_to is None:
+        return 0
+    days = 0
+    start = date_from
+    while start <= date_to:
+        end = min(start + timedelta(days=batch_days - 1), date_to)
+        params = {"start": datetime.combine(start, datetime.min.time()),
+                  "stop": datetime.combine(end + timedelta(days=1), datetime.min.time())}
+        with get_engine().begin() as conn:
+            conn.execute(text(
+                'DELETE FROM "SalesAnalysis" WHERE analysis_date >= CAST(:start AS date) AND analysis_date < CAST(:stop AS date)'
+            ), params)
+            days += conn.execute(text(
+                """
+                INSERT INTO "SalesAnalysis" (analysis_date, total_revenue, rooms_sold, additional_services_revenue)
+                SELECT day, sum(revenue), sum(rooms), sum(services) FROM (
+                    SELECT payment_date::date AS day, amount AS revenue, 0 AS rooms, 0 AS services
+                    FROM "Payments" WHERE payment_date >= :start AND payment_date < :stop
+                    UNION ALL
+                    SELECT usage_date::date, 0, 0, cost
+                    FROM "Service_Usage" WHERE usage_date >= :start AND usage_date < :stop
+                    UNION ALL
+                    SELECT b.booking_date::date, 0, count(*), 0
+                    FROM "Bookings" b JOIN "BookingRooms" br ON br.booking_id = b.booking_id
+                    WHERE b.booking_date >= :start AND b.booking_date < :stop
+                    GROUP BY b.booking_id
+                ) AS totals
+                GROUP BY day ORDER BY day
+                ON CONFLICT (analysis_date) DO UPDATE
+                SET total_revenue = EXCLUDED.total_revenue, rooms_sold = EXCLUDED.rooms_sold,
+                    additional_services_revenue = EXCLUDED.additional_services_revenue
+                """
+            ), params).rowcount
+        logger.info("SalesAnalysis пересчитан за %s — %s", start, end)
+        start = end + timedelta(days=1)
+    return days
+
+# Разовая чистка дублей SalesAnalysis перед созданием sales_analysis_date_key: из строк одного дня
+# остается последняя введенная. Без apply только показывает, что будет удалено.
+def dedupe_sales(apply: bool = False) -> int:
+    with get_engine().begin() as conn:
+        rows = conn.execute(text(
+            """
+            SELECT analysis_date, max(analysis_id) AS kept,
+                   (array_agg(analysis_id ORDER BY analysis_id))[1:count(*) - 1] AS removed
+            FROM "SalesAnalysis"
+            GROUP BY analysis_date HAVING count(*) > 1
+            ORDER BY analysis_date
+            """
+        )).fetchall()
+        for row in rows:
+            logger.info("%s: остается %s, %s %s", row.analysis_date, row.kept,
+                        "удалены" if apply else "будут удалены", row.removed)
+        removed = [analysis_id for row in rows for analysis_id in row.removed]
+        if apply and removed:
+            conn.execute(text('DELETE FROM "SalesAnalysis" WHERE analysis_id IN :ids')
+                         .bindparams(bindparam("ids", expanding=True)), {"ids": removed})
+    return len(removed)
+
+ROOM_INDEX_TABLES = ("BookingRooms", "Bookings")
+
+class RoomIntervalIndex:
+    # Для каждого номера — отсортированный список интервалов занятости (start, end, booking_id)
+    # в ординалах дат, end не включается. Бронь занимает ночи [arrival_date, departure_date),
+    # то же правило, что у ограничения booking_rooms_no_overlap.
+    def __init__(self, ttl: int, days_back: int):
+        self.ttl = ttl
+        self.days_back = days_back
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        self.versions = None
+        self.local_writes = 0
+        self.horizon = None
+        self.rooms = {}
+        self.bookings = {}
+        self.max_len = {}
+
+    def load(self, db: Session, versions: Optional[dict] = None):
+        horizon = date.today().toordinal() - self.days_back
+        with self.lock:
+            local_writes = self.local_writes
+        if versions is None:
+            versions = self.read_versions(db)
+        rows = db.execute(text(
+            """
+            SELECT br.room_id, b.booking_id, b.arrival_date, b.departure_date
+            FROM "BookingRooms" br
+            JOIN "Bookings" b ON br.booking_id = b.booking_id
+            WHERE b.departure_date >= :horizon
+            """
+        ), {"horizon": date.fromordinal(horizon)}).fetchall()
+        rooms, bookings, max_len = {}, {}, {}
+        for room_id, booking_id, arrival, departure in rows:
+            start, end = arrival.toordinal(), departure.toordinal()
+            rooms.setdefault(room_id, []).append((start, end, booking_id))
+            room_ids, _, _ = bookings.setdefault(booking_id, ([], start, end))
+            room_ids.append(room_id)
+            max_len[room_id] = max(max_len.get(room_id, 0), end - start)
+        for items in rooms.values():
+            items.sort()
+        with self.lock:
+            self.rooms, self.bookings, self.max_len = rooms, bookings, max_len
+            # add()/remove() во время чтения применились к старым спискам: версии не запоминаются,
+            # и следующий запрос перечитает индекс
+            self.versions = versions if local_writes == self.local_writes else None
+            self.horizon = horizon
+            self.loaded_at = time.monotonic()
+
+    def read_versions(self, db: Session) -> dict:
+        return {row.table_name: row.version for row in read_table_versions(db, ROOM_INDEX_TABLES)}
+
+    def ensure_loaded(self, db: Session):
+        # Другие воркеры меняют брони мимо этого процесса: перед ответом сверяем версии таблиц и перечитываем
+        # индекс, если они изменились. Свои записи сдвигают версии индекса сами (apply), поэтому
+        # перечитывание вызывают только чужие изменения. По TTL индекс перечитывается ради горизонта.
+        versions = self.read_versions(db)
+        if (self.loaded_at is None or versions != self.versions
+                or time.monotonic() - self.loaded_at > self.ttl):
+            self.load(db, versions)
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+            self.versions = None
+
+    def apply(self, fn, bumped: dict):
+        # Своя запись после commit: изменение вносится на месте, а версии индекса принимают значения,
+        # выданные этим commit, — если до него индекс видел все изменения (версия была ровно на 1 меньше)
+        fn()
+        changed = {table: version for table, version in bumped.items() if table in ROOM_INDEX_TABLES}
+        with self.lock:
+            if self.versions is None or not changed:
+                return
+            if all(self.versions.get(table, 0) == version - 1 for table, version in changed.items()):
+                self.versions = {**self.versions, **changed}
+
+    def add(self, booking_id: int, room_ids: list[int], arrival: date, departure: date):
+        start, end = arrival.toordinal(), departure.toordinal()
+        with self.lock:
+            self.local_writes += 1
+            self._remove(booking_id)
+            self.bookings[booking_id] = (list(room_ids), start, end)
+            for room_id in room_ids:
+                insort(self.rooms.setdefault(room_id, []), (start, end, booking_id))
+                self.max_len[room_id] = max(self.max_len.get(room_id, 0), end - start)
+
+    def remove(self, booking_id: int):
+        with self.lock:
+            self.local_writes += 1
+            self._remove(booking_id)
+
+    def remove_room(self, room_id: int):
+        with self.lock:
+            self.local_writes += 1
+            for _, _, booking_id in self.rooms.pop(room_id, []):
+                entry = self.bookings.get(booking_id)
+                if entry is not None and room_id in entry[0]:
+                    entry[0].remove(room_id)
+            self.max_len.pop(room_id, None)
+
+    def _remove(self, booking_id: int):
+        entry = self.bookings.pop(booking_id, None)
+        if entry is None:
+            return
+        room_ids, start, end = entry
+        for room_id in room_ids:
+            items = self.rooms.get(room_id, [])
+            i = bisect_left(items, (start, end, booking_id))
+            if i < len(items) and items[i] == (start, end, booking_id):
+                del items[i]
+
+    def covers(self, arrival: date) -> bool:
+        return self.horizon is not None and arrival.toordinal() >= self.horizon
+
+    def free_rooms(self, room_ids: list[int], arrival: date, departure: date) -> list[int]:
+        start, end = arrival.toordinal(), departure.toordinal()
+        with self.lock:
+            return [room_id for room_id in room_ids if self._is_free(room_id, start, end)]
+
+    def _is_free(self, room_id: int, start: int, end: int) -> bool:
+        items = self.rooms.get(room_id)
+        if not items:
+            return True
+        # Кандидаты — интервалы, начавшиеся до конца запроса; дальше max_len назад искать бессмысленно
+        i = bisect_left(items, (end,))
+        lowest = start - self.max_len[room_id]
+        while i > 0:
+            i -= 1
+            item_start, item_end, _ = items[i]
+            if item_start <= lowest:
+                break
+            if item_end > start:
+                return False
+        return True
+
+room_index = RoomIntervalIndex(AVAILABILITY_INDEX_TTL, AVAILABILITY_INDEX_DAYS_BACK)
+
+def update_room_index(db: Session, fn):
+    # Версии таблиц этого commit кладет в db.info хук _bump_table_versions (в /batch — batch_session)
+    after_commit(db, lambda: room_index.apply(fn, db.info.get("table_versions", {})))
+
+def busy_rooms_sql(db: Session, room_ids: list[int], arrival: date, departure: date,
+                   exclude_booking_id: Optional[int] = None) -> set[int]:
+    rows = db.execute(text(
+        """
+        SELECT DISTINCT room_id
+        FROM "BookingRooms"
+        WHERE room_id IN :room_ids
+          AND stay && daterange(:arrival_date, :departure_date, '[)')
+          AND booking_id IS DISTINCT FROM :exclude_booking_id
+        """
+    ).bindparams(bindparam("room_ids", expanding=True)),
+        {"room_ids": room_ids, "arrival_date": arrival, "departure_date": departure,
+         "exclude_booking_id": exclude_booking_id}).fetchall()
+    return {row[0] for row in rows}
 
-@app.post("/login", response_model=UserOut)
-def login(data: LoginData, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.user_login == data.user_login).first()
+def find_available_rooms(db: Session, rooms: list[Room], query: AvailabilityQuery) -> list[Room]:
+    if query.departure_date <= query.arrival_date:
+        raise HTTPException(status_code=400, detail="Дата выезда должна быть позже даты заезда")
+    candidates = [
+        room for room in rooms
+        if (query.category_id is None or room.category_id == query.category_id)
+        and (query.min_capacity is None or room.capacity >= query.min_capacity)
+        and (query.room_ids is None or room.room_id in query.room_ids)
+    ]
+    if not candidates:
+        return []
+    room_ids = [room.room_id for room in candidates]
+    if room_index.covers(query.arrival_date):
+        free = set(room_index.free_rooms(room_ids, query.arrival_date, query.departure_date))
+    else:
+        # Даты раньше горизонта индекса — проверяем запросом к БД
+        free = set(room_ids) - busy_rooms_sql(db, room_ids, query.arrival_date, query.departure_date)
+    return [room for room in candidates if room.room_id in free]
+
+def expand_ranges(starts: np.ndarray, ends: np.ndarray):
+    # Разворачивает интервалы [start, end) в плоские массивы (индекс интервала, позиция) без цикла по Python
+    lengths = np.maximum(ends - starts, 0)
+    owners = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return owners, starts[owners] + offsets
+
+ANALYTICS_TABLES = ("Rooms", "Bookings", "BookingRooms", "Payments", "Service_Usage")
+
+def load_analytics_columns(db: Session, date_from: date, date_to: date) -> dict:
+    # Все нужные столбцы одним запросом, каждый — массивом; дни — смещения от date_from.
+    # rate — выручка за одну ночь одного номера: стоимость брони делится на ночи и номера.
+    row = db.execute(text(
+        """
+        WITH stays AS (
+            SELECT br.room_id, b.arrival_date - CAST(:date_from AS date) AS start,
+                   b.departure_date - CAST(:date_from AS date) AS stop,
+                   b.total_cost::float8 / (GREATEST(b.departure_date - b.arrival_date, 1)
+                                           * count(*) OVER (PARTITION BY b.booking_id)) AS rate
+            FROM "Bookings" b JOIN "BookingRooms" br ON br.booking_id = b.booking_id
+            WHERE b.arrival_date <= CAST(:date_to AS date) AND b.departure_date > CAST(:date_from AS date)
+        ), payments AS (
+            SELECT COALESCE(booking_id, 0) AS booking_id, payment_date::date - CAST(:date_from AS date) AS day,
+                   amount::float8 AS amount
+            FROM "Payments" WHERE payment_date >= :start AND payment_date < :stop
+        ), usage AS (
+            SELECT COALESCE(booking_id, 0) AS booking_id, usage_date::date - CAST(:date_from AS date) AS day,
+                   cost::float8 AS amount
+            FROM "Service_Usage" WHERE usage_date >= :start AND usage_date < :stop
+        )
+        SELECT * FROM
+            (SELECT array_agg(room_id ORDER BY room_id) AS room_ids,
+                    array_agg(category_id ORDER BY room_id) AS categories,
+                    array_agg(floor ORDER BY room_id) AS floors FROM "Rooms") r,
+            (SELECT array_agg(room_id) AS stay_rooms, array_agg(start) AS stay_starts,
+                    array_agg(stop) AS stay_stops, array_agg(rate) AS stay_rates FROM stays) s,
+            (SELECT array_agg(booking_id) AS payment_bookings, array_agg(day) AS payment_days,
+                    array_agg(amount) AS payment_amounts FROM payments) p,
+            (SELECT array_agg(booking_id) AS usage_bookings, array_agg(day) AS usage_days,
+                    array_agg(amount) AS usage_amounts FROM usage) u,
+            (SELECT array_agg(booking_id ORDER BY booking_id) AS link_bookings,
+                    array_agg(room_id ORDER BY booking_id) AS link_rooms FROM "BookingRooms"
+             WHERE booking_id IN (SELECT booking_id FROM payments UNION SELECT booking_id FROM usage)) l
+        """
+    ), {"date_from": date_from, "date_to": date_to,
+        "start": datetime.combine(date_from, datetime.min.time()),
+        "stop": datetime.combine(date_to + timedelta(days=1), datetime.min.time())}).one()
+    return {key: np.array(value or [], dtype=np.float64 if key.endswith(("rates", "amounts")) else np.int64)
+            for key, value in row._mapping.items()}
+
+def analytics_periods(date_from: date, days: int, bucket: str):
+    # Для каждого дня окна — индекс периода; периоды — начала дней, недель (с понедельника) или месяцев
+    day_dates = np.datetime64(date_from, "D") + np.arange(days)
+    if bucket == "week":
+        # 1970-01-01 — четверг
+        starts = day_dates - (day_dates.astype(np.int64) + 3) % 7
+    elif bucket == "month":
+        starts = day_dates.astype("datetime64[M]").astype("datetime64[D]")
+    else:
+        starts = day_dates
+    return np.unique(starts, return_inverse=True)
+
+def aggregate_analytics(columns: dict, date_from: date, date_to: date, bucket: str, group_by: Optional[str]) -> list[dict]:
+    days = (date_to - date_from).days + 1
+    periods, period_of_day = analytics_periods(date_from, days, bucket)
+    room_ids = columns["room_ids"]
+    if group_by:
+        groups, room_group = np.unique(columns["categories" if group_by == "category" else "floors"], return_inverse=True)
+        labels = [int(group) for group in groups] + [None]
+    else:
+        room_group = np.zeros(len(room_ids), dtype=np.int64)
+        labels = [None]
+    # Последняя группа — платежи и услуги, которые не удалось отнести к номеру
+    width = len(labels)
+    cells = len(periods) * width
+
+    def total(day_index, group_index, weights=None):
+        return np.bincount(period_of_day[day_index] * width + group_index, weights=weights, minlength=cells).reshape(-1, width)
+
+    available = np.outer(np.bincount(period_of_day), np.bincount(room_group, minlength=width))
+
+    # Ночи броней, обрезанные окном, разворачиваются в (номер, день) без цикла по Python
+    stay_groups = room_group[np.searchsorted(room_ids, columns["stay_rooms"])]
+    owners, nights = expand_ranges(np.clip(columns["stay_starts"], 0, days), np.clip(columns["stay_stops"], 0, days))
+    sold = total(nights, stay_groups[owners])
+    room_revenue = total(nights, stay_groups[owners], columns["stay_rates"][owners])
+
+    def spread(prefix):
+        # Сумма делится поровну между номерами брони, каждая доля попадает в группу своего номера
+        bookings, amounts = columns[prefix + "_bookings"], columns[prefix + "_amounts"]
+        if not group_by:
+            return total(columns[prefix + "_days"], np.zeros(len(amounts), dtype=np.int64), amounts)
+        lo = np.searchsorted(columns["link_bookings"], bookings, side="left")
+        hi = np.searchsorted(columns["link_bookings"], bookings, side="right")
+        owners, links = expand_ranges(lo, hi)
+        link_groups = room_group[np.searchsorted(room_ids, columns["link_rooms"][links])]
+        orphans = np.flatnonzero(hi == lo)
+        return (total(columns[prefix + "_days"][owners], link_groups, amounts[owners] / (hi - lo)[owners])
+                + total(columns[prefix + "_days"][orphans], np.full(len(orphans), width - 1), amounts[orphans]))
+
+    service_revenue = spread("usage")
+    payments = spread("payment")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        occupancy = np.nan_to_num(sold / available)
+        adr = np.nan_to_num(room_revenue / sold)
+        revpar = np.nan_to_num(room_revenue / available)
+    rows = []
+    for period_index, period in enumerate(periods.astype(date)):
+        for group_index, label in enumerate(labels):
+            if group_by and label is None and not (service_revenue[period_index, group_index]
+                                                   or payments[period_index, group_index]):
+                continue
+            rows.append({
+                "period": period,
+                "group": label,
+                "rooms_available": int(available[period_index, group_index]),
+                "rooms_sold": int(sold[period_index, group_index]),
+                "occupancy": round(float(occupancy[period_index, group_index]), 4),
+                "room_revenue": round(float(room_revenue[period_index, group_index]), 2),
+                "adr": round(float(adr[period_index, group_index]), 2),
+                "revpar": round(float(revpar[period_index, group_index]), 2),
+                "service_revenue": round(float(service_revenue[period_index, group_index]), 2),
+                "payments": round(float(payments[period_index, group_index]), 2),
+            })
+    return rows
+
+def run_lengths(matrix: np.ndarray) -> list[list[list[int]]]:
+    result = []
+    for row in matrix:
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(row)) + 1, [len(row)]))
+        result.append(np.column_stack((row[bounds[:-1]], np.diff(bounds))).tolist())
+    return result
+
+def read_table_versions(db: Session, tables: tuple) -> list:
+    return db.execute(text(
+        'SELECT table_name, version, updated_at FROM "TableVersions" WHERE table_name IN :tables ORDER BY table_name'
+    ).bindparams(bindparam("tables", expanding=True)), {"tables": list(tables)}).fetchall()
+
+def check_not_modified(request: Request, response: Response, versions: list):
+    # Версия читается до основного запроса: если запись успеет зафиксироваться между ними,
+    # клиент получит новые данные со старым ETag и просто перезапросит их позже
+    key = request.url.path + "?" + request.url.query + "|" + ",".join(f"{v.table_name}:{v.version}" for v in versions)
+    etag = '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+    headers = {"ETag": etag}
+    updated = max((v.updated_at for v in versions), default=None)
+    if updated is not None:
+        updated = updated.replace(tzinfo=timezone.utc, microsecond=0)
+        headers["Last-Modified"] = format_datetime(updated, usegmt=True)
+    # If-Modified-Since не учитывается: у Last-Modified точность в секунду, и запись в ту же секунду дала бы ложный 304
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if etag in tags or "*" in tags:
+            raise HTTPException(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+# Зависимость для GET: 304 без основного запроса и сериализации, если таблицы не менялись
+# includes: {имя в include=: таблица} — связанные таблицы, запрошенные через include=, тоже входят в ETag.
+# replica=True — версии читаются той же сессией, что и данные обработчика на get_read_db, иначе ETag
+# с основной БД достался бы устаревшим данным с реплики
+def conditional_get(*tables, includes: Optional[dict] = None, replica: bool = False):
+    get_session = get_read_db if replica else get_db
+
+    def request_tables(request: Request) -> tuple:
+        names = [name.strip() for name in request.query_params.get("include", "").split(",")]
+        return tables + tuple(includes[name] for name in names if name in (includes or {}))
+
+    if ASYNC_DB:
+        async def dependency(request: Request, response: Response, db: Session = Depends(get_session)):
+            versioned = request_tables(request)
+            check_not_modified(request, response,
+                               await db.run_sync(lambda session: read_table_versions(session, versioned)))
+    else:
+        def dependency(request: Request, response: Response, db: Session = Depends(get_session)):
+            check_not_modified(request, response, read_table_versions(db, request_tables(request)))
+    return Depends(dependency)
+
+async def read_import_body(request: Request, format: Optional[str] = Query(None, pattern="^(csv|ndjson)$")):
+    # Тело читается в цикле событий, разбор и загрузка — уже в обработчике
+    if format is None:
+        format = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    too_large = HTTPException(status_code=413, detail=f"Файл импорта больше {IMPORT_MAX_BYTES} байт")
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > IMPORT_MAX_BYTES:
+        raise too_large
+    # Content-Length может отсутствовать (chunked), поэтому предел проверяется и по мере чтения
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > IMPORT_MAX_BYTES:
+            raise too_large
+        chunks.append(chunk)
+    return format, b"".join(chunks)
+
+def parse_import(format: str, data: bytes):
+    # (номер строки, запись или None, ошибка разбора); номер — строка файла с данными, начиная с 1
+    text_data = data.decode("utf-8-sig")
+    if format == "csv":
+        for row_no, record in enumerate(csv.DictReader(io.StringIO(text_data)), start=1):
+            yield row_no, {key: value for key, value in record.items() if value != ""}, None
+        return
+    for row_no, line in enumerate(text_data.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield row_no, None, f"Неверный JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield row_no, None, "Строка должна быть JSON-объектом"
+            continue
+        yield row_no, record, None
+
+def validate_import(upload, schema):
+    rows, errors, total = [], [], 0
+    for row_no, record, error in parse_import(*upload):
+        total += 1
+        if error is None:
+            try:
+                rows.append((row_no, schema.model_validate(record)))
+                continue
+            except ValidationError as e:
+                error = "; ".join(f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors())
+        errors.append({"row": row_no, "error": error})
+    return total, rows, errors
+
+def copy_rows(db: Session, table: str, columns: list[str], rows: list[tuple]):
+    # COPY в таблицу; первый столбец — номер строки, остальные передаются текстом, типы приводит SQL слияния
+    raw = db.connection().connection
+    rows = [(row[0],) + tuple(None if value is None else str(value) for value in row[1:]) for row in rows]
+    if ASYNC_DB:
+        await_only(raw.driver_connection.copy_records_to_table(table, records=rows, columns=columns))
+        return
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = raw.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+
+def stage_rows(db: Session, table: str, columns: list[str], rows: list[tuple]):
+    db.execute(text(
+        f"CREATE TEMP TABLE {table} (row_no integer, {', '.join(column + ' text' for column in columns)}) ON COMMIT DROP"
+    ))
+    copy_rows(db, table, ["row_no"] + columns, rows)
+
+def import_errors(db: Session, sql: str) -> list[dict]:
+    return [{"row": row.row_no, "error": row.error} for row in db.execute(text(sql))]
+
+@functools.lru_cache(maxsize=None)
+def list_adapter(schema) -> TypeAdapter:
+    return TypeAdapter(list[schema])
+
+# Поля Out-моделей, которых нет среди колонок таблицы: для fast=1 они считаются в том же SELECT
+computed_columns = {
+    Booking: {
+        "room_id": sa_select(func.min(BookingRoom.room_id))
+        .where(BookingRoom.booking_id == Booking.booking_id).scalar_subquery(),
+        "room_ids": func.coalesce(
+            sa_select(func.array_agg(aggregate_order_by(BookingRoom.room_id, BookingRoom.room_id)))
+            .where(BookingRoom.booking_id == Booking.booking_id).scalar_subquery(),
+            literal_column("'{}'::integer[]"),
+        ),
+    },
+}
+
+PLAIN_FIELD_TYPES = {int, str, float, date, datetime, Optional[int], Optional[str], list[int]}
+
+def parse_fields(schema, fields: Optional[str]) -> Optional[tuple]:
+    names = [name.strip() for name in (fields or "").split(",") if name.strip()]
+    if not names:
+        return None
+    unknown = [name for name in names if name not in schema.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail="Неизвестные поля: " + ", ".join(unknown))
+    # Порядок — как в схеме, чтобы ответ не зависел от порядка в запросе
+    return tuple(name for name in schema.model_fields if name in names)
+
+@functools.lru_cache(maxsize=None)
+def fast_plan(model, schema, fields: Optional[tuple] = None):
+    # Колонки в порядке полей схемы; DECIMAL приводится к float8 в самом запросе, как pydantic приводит его к float.
+    # Поля с ограничениями (constr, EmailStr) могут менять значение при проверке — их проверяет pydantic, по одному полю.
+    # required — поля, где схема не допускает null, а колонка допускает
+    columns, validators, required = [], {}, []
+    for name, field in schema.model_fields.items():
+        if fields is not None and name not in fields:
+            continue
+        column = computed_columns.get(model, {}).get(name)
+        if column is None:
+            column = getattr(model, name).expression
+            if column.nullable and type(None) not in get_args(field.annotation):
+                required.append(name)
+            if isinstance(column.type, Numeric) and not isinstance(column.type, Float) and field.annotation is float:
+                column = cast(column, Float)
+        if field.metadata or field.annotation not in PLAIN_FIELD_TYPES:
+            annotation = Annotated[(field.annotation, *field.metadata)] if field.metadata else field.annotation
+            validators[name] = TypeAdapter(annotation).validate_python
+        columns.append(column.label(name))
+    return columns, (tuple(column.name for column in columns), validators, tuple(required))
+
+def fast_items(rows, schema, names: tuple, validators: dict, required: tuple) -> list[dict]:
+    items = [dict(zip(names, row)) for row in rows]
+    for name, validate in validators.items():
+        for item in items:
+            item[name] = validate(item[name])
+    # null в обязательном поле — та же ошибка валидации ответа, что и на обычном пути
+    if required and any(item[name] is None for item in items for name in required):
+        list_adapter(schema).validate_python(items)
+    return items
+
+def invalidate_reference(db: Session, table: str):
+    # Вызывается до commit: NOTIFY уходит другим воркерам только если транзакция зафиксирована
+    if CACHE_INVALIDATION == "notify":
+        db.execute(text("SELECT pg_notify('reference_cache', :table)"), {"table": table})
+    after_commit(db, lambda: reference_cache.invalidate(table))
+
+# Справочники меняются редко: страница хранится уже сериализованной, повторный запрос не трогает ни БД, ни pydantic
+def cached_page(db: Session, model, pk, page: PageParams, schema, response: Response):
+    # Кэш и так отдает готовые байты, отдельный быстрый путь ему не нужен; выборка полей идет мимо кэша
+    page.fast = False
+    if page.stream or page.fields:
+        return paginate(db.query(model), pk, page, schema, response)
+    key = (model.__tablename__, page.after, page.limit)
+    cached = reference_cache.get(key)
+    if cached is None:
+        generation = reference_cache.generation(model.__tablename__)
+        rows = paginate(db.query(model), pk, page, schema, response)
+        adapter = list_adapter(schema)
+        cached = (adapter.dump_json(adapter.validate_python(rows, from_attributes=True)),
+                  response.headers.get("X-Next-After"))
+        reference_cache.set(key, cached, generation)
+    body, next_after = cached
+    return Response(content=body, media_type="application/json",
+                    headers={"X-Next-After": next_after} if next_after else None)
+
+# Keyset-пагинация по первичному ключу: следующая страница запрашивается с after=<X-Next-After>
+def paginate(query, pk, page: PageParams, schema, response: Response):
+    if page.after is not None:
+        query = query.filter(pk > page.after)
+    query = query.order_by(pk)
+    if page.fast or page.fields:
+        return fast_page(query, pk, page, schema, response)
+    if page.stream:
+        return stream_ndjson(query, schema)
+    rows = query.limit(page.limit).all()
+    if len(rows) == page.limit:
+        response.headers["X-Next-After"] = str(getattr(rows[-1], pk.key))
+    return rows
+
+# fast=1: кортежи колонок вместо ORM-объектов, без проверки каждой строки pydantic, JSON кодирует orjson.
+# Тело ответа совпадает с обычным путем байт в байт
+def fast_page(query, pk, page: PageParams, schema, response: Response):
+    columns, plan = fast_plan(query.column_descriptions[0]["entity"], schema, parse_fields(schema, page.fields))
+    # Ключ последним столбцом нужен для X-Next-After, в ответ он не попадает: zip() по именам его отбрасывает
+    query = query.with_entities(*columns, pk)
+    if page.stream:
+        return stream_ndjson(query, schema, plan)
+    rows = query.limit(page.limit).all()
+    items = fast_items(rows, schema, *plan)
+    if len(rows) == page.limit:
+        response.headers["X-Next-After"] = str(rows[-1][-1])
+    return json_response(orjson.dumps(items), response)
+
+def fast_item(query, schema, fields: str, response: Response, not_found: str):
+    columns, plan = fast_plan(query.column_descriptions[0]["entity"], schema, parse_fields(schema, fields))
+    rows = query.with_entities(*columns).limit(1).all()
+    if not rows:
+        raise HTTPException(status_code=404, detail=not_found)
+    return json_response(orjson.dumps(fast_items(rows, schema, *plan)[0]), response)
+
+def json_response(content: bytes, response: Response) -> Response:
+    result = Response(content=content, media_type="application/json")
+    # Заголовки из зависимостей (ETag, X-Next-After) FastAPI переносит только в ответы, которые собирает сам
+    result.headers.raw.extend(response.headers.raw)
+    return result
+
+@router.get("/internal/pool", dependencies=[Depends(internal_access)])
+def get_pool_status():
+    return pool_statuses()
+
+@router.get("/internal/slow-queries", dependencies=[Depends(internal_access)])
+def get_slow_queries():
+    return list(reversed(slow_queries))
+
+@router.get("/metrics", dependencies=[Depends(internal_access)])
+def get_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+def find_login_user(db: Session, user_login: str) -> User:
+    user = db.query(User).filter(User.user_login == user_login).first()
     if not user:
         raise HTTPException(status_code=400, detail="Неверный логин или пароль")
     if user.block == 1:
         raise HTTPException(status_code=403, detail="Пользователь заблокирован")
-    if data.user_password != user.user_password:
-        user.failed_attempts += 1
-        if user.failed_attempts >= 3:
-            user.block = 1
-            user.failed_attempts = 0
+    return user
+
+def finish_login(db: Session, user: User, valid: bool, new_hash: Optional[str]) -> dict:
+    if not valid:
+        # Счетчик увеличивается в самой БД, чтобы параллельные попытки не терялись
+        db.execute(text(
+            """
+            UPDATE "Users"
+            SET block = CASE WHEN COALESCE(failed_attempts, 0) + 1 >= 3 THEN 1 ELSE block END,
+                failed_attempts = CASE WHEN COALESCE(failed_attempts, 0) + 1 >= 3 THEN 0
+                                       ELSE COALESCE(failed_attempts, 0) + 1 END
+            WHERE user_id = :user_id
+            """
+        ), {"user_id": user.user_id})
         db.commit()
         raise HTTPException(status_code=400, detail="Неверный логин или пароль")
-    user.failed_attempts = 0
-    db.commit()
+    # Обычный вход только читает: запись нужна, если был сброс счетчика или перехеширование
+    if user.failed_attempts:
+        user.failed_attempts = 0
+    if new_hash:
+        user.user_password = new_hash
+    if db.dirty:
+        db.commit()
+    return {**UserOut.model_validate(user, from_attributes=True).model_dump(),
+            **issue_tokens(user, is_admin(db, user))}
+
+@router.post("/login", response_model=LoginOut)
+async def login(data: LoginData, db: Session = Depends(get_db)):
+    user = await run_db(db, find_login_user, data.user_login)
+    valid, new_hash = await check_password(user.user_password, data.user_password)
+    return await run_db(db, finish_login, user, valid, new_hash)
+
+@router.post("/token/refresh", response_model=TokenOut)
+def refresh_token(data: RefreshData, db: Session = Depends(get_db)):
+    try:
+        payload = read_token(data.refresh_token, "refresh")
+    except (ValueError, KeyError, TypeError):
+        raise token_error("Недействительный токен")
+    user = db.query(User).filter(User.user_id == payload["sub"]).first()
+    if not user or payload.get("pwd") != password_fingerprint(user):
+        raise token_error("Токен отозван")
+    if user.block == 1:
+        raise HTTPException(status_code=403, detail="Пользователь заблокирован")
+    return issue_tokens(user, is_admin(db, user))
+
+@router.get("/users/me", response_model=UserOut)
+def get_current_user(user_id: int = Depends(current_user), db: Session = Depends(get_db)):
+    user = db.query(User).filter(User.user_id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
     return user
 
-@app.put("/users/{user_id}/change-password", response_model=UserOut)
-def change_password(user_id: int, payload: dict, db: Session = Depends(get_db)):
-    current = payload.get("current_password")
-    new = payload.get("new_password")
-    repeat = payload.get("repeat_password")
+def find_user(db: Session, user_id: int) -> User:
     user = db.query(User).filter(User.user_id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
-    if current != user.user_password:
-        raise HTTPException(status_code=400, detail="Неверный текущий пароль")
-    if new != repeat:
-        raise HTTPException(status_code=400, detail="Новые пароли не совпадают")
-    user.user_password = new
+    return user
+
+def save_password(db: Session, user: User, password_hash: str) -> User:
+    user.user_password = password_hash
+    revoke_tokens(db, user.user_id)
     db.commit()
     db.refresh(user)
     return user
 
-@app.post("/users", response_model=UserOut)
-def create_user(
+def add_user(db: Session, values: dict) -> User:
+    new_user = User(**values, created_at=datetime.now(), block=0, failed_attempts=0)
+    db.add(new_user)
+    db.commit()
+    db.refresh(new_user)
+    return new_user
+
+@router.put("/users/{user_id}/change-password", response_model=UserOut)
+async def change_password(user_id: int, payload: dict, db: Session = Depends(get_db)):
+    current = payload.get("current_password")
+    new = payload.get("new_password")
+    repeat = payload.get("repeat_password")
+    user = await run_db(db, find_user, user_id)
+    if not isinstance(current, str) or not (await check_password(user.user_password, current))[0]:
+        raise HTTPException(status_code=400, detail="Неверный текущий пароль")
+    if not isinstance(new, str) or new != repeat:
+        raise HTTPException(status_code=400, detail="Новые пароли не совпадают")
+    return await run_db(db, save_password, user, await hash_password(new))
+
+@router.post("/users", response_model=UserOut)
+async def create_user(
     user_data: LoginData,
     first_name: str,
     last_name: str,
@@ -342,39 +2441,133 @@ def create_user(
 ):
     if not (first_name and last_name and phone and email and user_data.user_login):
         raise HTTPException(status_code=400, detail="Все поля обязательны")
-    new_user = User(
+    return await run_db(db, add_user, dict(
         first_name=first_name,
         last_name=last_name,
         phone=phone,
         email=email,
         user_login=user_data.user_login,
-        user_password=user_data.user_password,
+        user_password=await hash_password(user_data.user_password),
         position_id=position_id,
-        created_at=datetime.now(),
-        block=0,
-        failed_attempts=0
-    )
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    return new_user
+    ))
 
-@app.put("/users/{user_id}/block")
+@router.put("/users/{user_id}/block")
 def block_user(user_id: int, block: bool, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.user_id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     user.block = 1 if block else 0
-    if not block:
+    if block:
+        revoke_tokens(db, user_id)
+    else:
         user.failed_attempts = 0
     db.commit()
     return {"detail": "Статус обновлен"}
 
-@app.get("/clients", response_model=list[ClientOut])
-def list_clients(db: Session = Depends(get_db)):
-    return db.query(Client).order_by(Client.client_id).all()
+@router.get("/clients", response_model=list[ClientOut])
+def list_clients(
+    response: Response,
+    page: PageParams = Depends(),
+    registered_from: Optional[date] = None,
+    registered_to: Optional[date] = None,
+    db: Session = Depends(get_read_db)
+):
+    query = filter_dates(db.query(Client), Client.registered_at, registered_from, registered_to)
+    return paginate(query, Client.client_id, page, ClientOut, response)
+
+CLIENT_SEARCH_COLUMNS = {
+    "last_name": 'lower(last_name) COLLATE "C"',
+    "first_name": 'lower(first_name) COLLATE "C"',
+    "email": 'lower(email) COLLATE "C"',
+    "phone": r'''regexp_replace(regexp_replace(phone, '\D', '', 'g'), '^8(\d{10})$', '7\1') COLLATE "C"''',
+}
+
+def like_prefix(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def client_search_branches(q: str) -> list:
+    # (ранг, [(выражение, префикс), ...]); каждая ветка читает по индексу не больше limit строк
+    words = q.lower().split()
+    digits = re.sub(r"\D", "", q)
+    if "@" in q:
+        return [(1, [("email", "".join(words))])]
+    if len(digits) >= 3 and not re.sub(r"[\d\s()+\-]", "", q):
+        if len(digits) == 11 and digits.startswith("8"):
+            digits = "7" + digits[1:]
+        # Номер часто набирают без кода страны
+        return [(1, [("phone", digits)])] + ([(2, [("phone", "7" + digits)])] if len(digits) <= 10 else [])
+    if len(words) >= 2:
+        return [(1, [("last_name", words[0]), ("first_name", words[1])]),
+                (1, [("first_name", words[0]), ("last_name", words[1])])]
+    return [(1, [("last_name", words[0])]), (2, [("first_name", words[0])]), (3, [("email", words[0])])]
+
+# Поиск гостя по мере ввода: фамилия, имя, «фамилия имя» в любом порядке, начало email или цифр телефона.
+# Сначала точные совпадения, затем по рангу ветки и по алфавиту
+@router.get("/clients/search", response_model=list[ClientOut])
+def search_clients(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_read_db)
+):
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Пустой поисковый запрос")
+    params, branches, exact = {"limit": limit}, [], []
+    for index, (rank, conditions) in enumerate(client_search_branches(q.strip())):
+        where = []
+        for number, (column, value) in enumerate(conditions):
+            name = f"p{index}_{number}"
+            params[name], params[name + "_exact"] = like_prefix(value), value
+            where.append(f"{CLIENT_SEARCH_COLUMNS[column]} LIKE :{name}")
+            exact.append(f"{CLIENT_SEARCH_COLUMNS[column]} = :{name}_exact")
+        branches.append(
+            f'(SELECT client_id, {rank} AS rank FROM "Clients" WHERE {" AND ".join(where)} '
+            f'ORDER BY {CLIENT_SEARCH_COLUMNS[conditions[0][0]]} LIMIT :limit)'
+        )
+    return db.execute(text(
+        f"""
+        WITH hits AS ({" UNION ALL ".join(branches)})
+        SELECT c.* FROM (SELECT client_id, min(rank) AS rank FROM hits GROUP BY client_id) AS h
+        JOIN "Clients" c USING (client_id)
+        ORDER BY ({" OR ".join(exact)}) DESC, h.rank, lower(c.last_name), lower(c.first_name), c.client_id
+        LIMIT :limit
+        """
+    ), params).fetchall()
+
+@router.post("/clients/import", response_model=ImportResult)
+def import_clients(upload=Depends(read_import_body), db: Session = Depends(get_db)):
+    total, rows, errors = validate_import(upload, ClientImport)
+    staged, phones, emails = [], set(), set()
+    for row_no, client in rows:
+        if client.phone in phones or client.email in emails:
+            errors.append({"row": row_no, "error": "Телефон или email повторяется в файле"})
+            continue
+        phones.add(client.phone)
+        emails.add(client.email)
+        staged.append((row_no, client.first_name, client.last_name, client.phone, client.email, client.registered_at))
+    stage_rows(db, "import_clients", ["first_name", "last_name", "phone", "email", "registered_at"], staged)
+    # Конфликты по уникальным phone/email пропускаются, такие строки попадают в отчет об ошибках
+    result = db.execute(text(
+        """
+        WITH inserted AS (
+            INSERT INTO "Clients" (first_name, last_name, phone, email, registered_at)
+            SELECT first_name, last_name, phone, email, COALESCE(registered_at::timestamp, now())
+            FROM import_clients ORDER BY row_no
+            ON CONFLICT DO NOTHING
+            RETURNING phone
+        )
+        SELECT s.row_no, i.phone IS NOT NULL AS inserted
+        FROM import_clients s LEFT JOIN inserted i ON i.phone = s.phone
+        """
+    )).fetchall()
+    errors += [{"row": row.row_no, "error": "Клиент с таким телефоном или email уже существует"}
+               for row in result if not row.inserted]
+    if any(row.inserted for row in result):
+        touch_tables(db, "Clients")
+    db.commit()
+    return {"total": total, "inserted": sum(row.inserted for row in result),
+            "errors": sorted(errors, key=lambda error: error["row"])}
 
-@app.post("/clients", response_model=ClientOut)
+@router.post("/clients", response_model=ClientOut)
 def create_client(client: ClientCreate, db: Session = Depends(get_db)):
     exist = db.query(Client).filter(
         (Client.phone == client.phone) | (Client.email == client.email)
@@ -387,7 +2580,7 @@ def create_client(client: ClientCreate, db: Session = Depends(get_db)):
     db.refresh(db_client)
     return db_client
 
-@app.put("/clients/{client_id}", response_model=ClientOut)
+@router.put("/clients/{client_id}", response_model=ClientOut)
 def update_client(client_id: int, client: ClientCreate, db: Session = Depends(get_db)):
     db_client = db.query(Client).filter(Client.client_id == client_id).first()
     if not db_client:
@@ -398,7 +2591,7 @@ def update_client(client_id: int, client: ClientCreate, db: Session = Depends(ge
     db.refresh(db_client)
     return db_client
 
-@app.delete("/clients/{client_id}")
+@router.delete("/clients/{client_id}")
 def delete_client(client_id: int, db: Session = Depends(get_db)):
     db_client = db.query(Client).filter(Client.client_id == client_id).first()
     if not db_client:
@@ -407,115 +2600,193 @@ def delete_client(client_id: int, db: Session = Depends(get_db)):
     db.commit()
     return {"detail": "Клиент удален"}
 
-@app.get("/positions", response_model=list[PositionOut])
-def list_positions(db: Session = Depends(get_db)):
-    return db.query(Position).order_by(Position.position_id).all()
+@router.get("/positions", response_model=list[PositionOut])
+def list_positions(response: Response, page: PageParams = Depends(), db: Session = Depends(get_db)):
+    return cached_page(db, Position, Position.position_id, page, PositionOut, response)
 
-@app.post("/positions", response_model=PositionOut)
+@router.post("/positions", response_model=PositionOut)
 def create_position(position: PositionCreate, db: Session = Depends(get_db)):
     exist = db.query(Position).filter(Position.position_name == position.position_name).first()
     if exist:
         raise HTTPException(status_code=400, detail="Должность с таким названием уже существует")
     db_position = Position(**position.dict())
     db.add(db_position)
+    invalidate_reference(db, "Position")
     db.commit()
     db.refresh(db_position)
     return db_position
 
-@app.put("/positions/{position_id}", response_model=PositionOut)
+@router.put("/positions/{position_id}", response_model=PositionOut)
 def update_position(position_id: int, position: PositionCreate, db: Session = Depends(get_db)):
     db_position = db.query(Position).filter(Position.position_id == position_id).first()
     if not db_position:
         raise HTTPException(status_code=404, detail="Должность не найдена")
     db_position.position_name = position.position_name
+    invalidate_reference(db, "Position")
     db.commit()
     db.refresh(db_position)
     return db_position
 
-@app.delete("/positions/{position_id}")
+@router.delete("/positions/{position_id}")
 def delete_position(position_id: int, db: Session = Depends(get_db)):
     db_position = db.query(Position).filter(Position.position_id == position_id).first()
     if not db_position:
         raise HTTPException(status_code=404, detail="Должность не найдена")
     db.delete(db_position)
+    invalidate_reference(db, "Position")
     db.commit()
     return {"detail": "Должность удалена"}
 
-@app.get("/categories", response_model=list[CategoryOut])
-def list_categories(db: Session = Depends(get_db)):
-    return db.query(Category).order_by(Category.category_id).all()
+@router.get("/categories", response_model=list[CategoryOut])
+def list_categories(response: Response, page: PageParams = Depends(), db: Session = Depends(get_db)):
+    return cached_page(db, Category, Category.category_id, page, CategoryOut, response)
 
-@app.post("/categories", response_model=CategoryOut)
+@router.post("/categories", response_model=CategoryOut)
 def create_category(category: CategoryCreate, db: Session = Depends(get_db)):
     exist = db.query(Category).filter(Category.category_name == category.category_name).first()
     if exist:
         raise HTTPException(status_code=400, detail="Категория с таким названием уже существует")
     db_category = Category(**category.dict())
     db.add(db_category)
+    invalidate_reference(db, "Category")
     db.commit()
     db.refresh(db_category)
     return db_category
 
-@app.put("/categories/{category_id}", response_model=CategoryOut)
+@router.put("/categories/{category_id}", response_model=CategoryOut)
 def update_category(category_id: int, category: CategoryCreate, db: Session = Depends(get_db)):
     db_category = db.query(Category).filter(Category.category_id == category_id).first()
     if not db_category:
         raise HTTPException(status_code=404, detail="Категория не найдена")
     db_category.category_name = category.category_name
     db_category.description = category.description
+    invalidate_reference(db, "Category")
     db.commit()
     db.refresh(db_category)
     return db_category
 
-@app.delete("/categories/{category_id}")
+@router.delete("/categories/{category_id}")
 def delete_category(category_id: int, db: Session = Depends(get_db)):
     db_category = db.query(Category).filter(Category.category_id == category_id).first()
     if not db_category:
         raise HTTPException(status_code=404, detail="Категория не найдена")
     db.delete(db_category)
+    invalidate_reference(db, "Category")
     db.commit()
     return {"detail": "Категория удалена"}
 
-@app.get("/rooms", response_model=list[RoomOut])
-def list_rooms(db: Session = Depends(get_db)):
-    return db.query(Room).order_by(Room.room_id).all()
-
-@app.post("/rooms", response_model=RoomOut)
+@router.get("/rooms", response_model=list[RoomOut], dependencies=[conditional_get("Rooms", replica=True)])
+def list_rooms(
+    response: Response,
+    page: PageParams = Depends(),
+    category_id: Optional[int] = None,
+    floor: Optional[int] = None,
+    min_capacity: Optional[int] = None,
+    db: Session = Depends(get_read_db)
+):
+    query = db.query(Room)
+    if category_id is not None:
+        query = query.filter(Room.category_id == category_id)
+    if floor is not None:
+        query = query.filter(Room.floor == floor)
+    if min_capacity is not None:
+        query = query.filter(Room.capacity >= min_capacity)
+    return paginate(query, Room.room_id, page, RoomOut, response)
+
+@router.get("/rooms/available", response_model=list[RoomOut])
+def list_available_rooms(
+    arrival_date: date,
+    departure_date: date,
+    category_id: Optional[int] = None,
+    min_capacity: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    room_index.ensure_loaded(db)
+    query = AvailabilityQuery(arrival_date=arrival_date, departure_date=departure_date,
+                              category_id=category_id, min_capacity=min_capacity)
+    return find_available_rooms(db, db.query(Room).order_by(Room.room_id).all(), query)
+
+@router.post("/rooms/available", response_model=list[AvailabilityOut])
+def search_available_rooms(queries: list[AvailabilityQuery], db: Session = Depends(get_db)):
+    room_index.ensure_loaded(db)
+    rooms = db.query(Room).order_by(Room.room_id).all()
+    return [{**query.dict(), "rooms": find_available_rooms(db, rooms, query)} for query in queries]
+
+@router.post("/rooms", response_model=RoomOut)
 def create_room(room: RoomCreate, db: Session = Depends(get_db)):
     exist = db.query(Room).filter(Room.room_number == room.room_number).first()
     if exist:
         raise HTTPException(status_code=400, detail="Номер с таким номером уже существует")
     db_room = Room(**room.dict())
     db.add(db_room)
+    db.flush()
+    publish(db, "rooms", "created", db_room.room_id)
     db.commit()
     db.refresh(db_room)
     return db_room
 
-@app.put("/rooms/{room_id}", response_model=RoomOut)
+@router.get("/rooms/{room_id}", response_model=RoomOut, dependencies=[conditional_get("Rooms")])
+def get_room(room_id: int, response: Response, fields: Optional[str] = None, db: Session = Depends(get_db)):
+    if fields:
+        return fast_item(db.query(Room).filter(Room.room_id == room_id), RoomOut, fields, response, "Номер не найден")
+    db_room = db.query(Room).filter(Room.room_id == room_id).first()
+    if not db_room:
+        raise HTTPException(status_code=404, detail="Номер не найден")
+    return db_room
+
+@router.put("/rooms/{room_id}", response_model=RoomOut)
 def update_room(room_id: int, room: RoomCreate, db: Session = Depends(get_db)):
     db_room = db.query(Room).filter(Room.room_id == room_id).first()
     if not db_room:
         raise HTTPException(status_code=404, detail="Номер не найден")
     for key, value in room.dict().items():
         setattr(db_room, key, value)
+    publish(db, "rooms", "updated", room_id)
     db.commit()
     db.refresh(db_room)
     return db_room
 
-@app.delete("/rooms/{room_id}")
+@router.delete("/rooms/{room_id}")
 def delete_room(room_id: int, db: Session = Depends(get_db)):
     db_room = db.query(Room).filter(Room.room_id == room_id).first()
     if not db_room:
         raise HTTPException(status_code=404, detail="Номер не найден")
+    # Связи номера с бронями удаляются каскадом: эти брони меняются, о них тоже сообщаем в ленту
+    booking_ids = [row[0] for row in db.query(BookingRoom.booking_id)
+                   .filter(BookingRoom.room_id == room_id).order_by(BookingRoom.booking_id)]
+    for day, rooms in sales_by_day(db, Booking.booking_date, func.count(),
+                                   BookingRoom.booking_id == Booking.booking_id, BookingRoom.room_id == room_id):
+        apply_sales_delta(db, day, rooms=-rooms)
     db.delete(db_room)
+    update_room_index(db, lambda: room_index.remove_room(room_id))
+    publish(db, "rooms", "deleted", room_id)
+    for booking_id in booking_ids:
+        publish(db, "bookings", "updated", booking_id)
     db.commit()
     return {"detail": "Номер удален"}
 
-@app.get("/cleanings")
-def list_cleanings(db: Session = Depends(get_db)):
-    return db.query(Cleaning).order_by(Cleaning.cleaning_id).all()
-
-@app.post("/cleanings")
+@router.get("/cleanings", response_model=list[CleaningOut],
+            dependencies=[conditional_get("Cleaning", replica=True)])
+def list_cleanings(
+    response: Response,
+    page: PageParams = Depends(),
+    room_id: Optional[int] = None,
+    cleaning_status: Optional[str] = None,
+    user_id: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    db: Session = Depends(get_read_db)
+):
+    query = filter_dates(db.query(Cleaning), Cleaning.cleaning_date, date_from, date_to)
+    if room_id is not None:
+        query = query.filter(Cleaning.room_id == room_id)
+    if cleaning_status is not None:
+        query = query.filter(Cleaning.cleaning_status == cleaning_status)
+    if user_id is not None:
+        query = query.filter(Cleaning.user_id == user_id)
+    return paginate(query, Cleaning.cleaning_id, page, CleaningOut, response)
+
+@router.post("/cleanings")
 def create_cleaning(cleaning_data: dict, db: Session = Depends(get_db)):
     try:
         cleaning_date = datetime.fromisoformat(cleaning_data["cleaning_date"])
@@ -528,11 +2799,23 @@ def create_cleaning(cleaning_data: dict, db: Session = Depends(get_db)):
         user_id=cleaning_data.get("user_id")
     )
     db.add(db_cleaning)
+    db.flush()
+    publish(db, "cleanings", "created", db_cleaning.cleaning_id)
     db.commit()
     db.refresh(db_cleaning)
     return db_cleaning
 
-@app.put("/cleanings/{cleaning_id}")
+@router.get("/cleanings/{cleaning_id}", response_model=CleaningOut, dependencies=[conditional_get("Cleaning")])
+def get_cleaning(cleaning_id: int, response: Response, fields: Optional[str] = None, db: Session = Depends(get_db)):
+    if fields:
+        return fast_item(db.query(Cleaning).filter(Cleaning.cleaning_id == cleaning_id), CleaningOut, fields, response,
+                         "Запись очистки не найдена")
+    db_cleaning = db.query(Cleaning).filter(Cleaning.cleaning_id == cleaning_id).first()
+    if not db_cleaning:
+        raise HTTPException(status_code=404, detail="Запись очистки не найдена")
+    return db_cleaning
+
+@router.put("/cleanings/{cleaning_id}")
 def update_cleaning(cleaning_id: int, cleaning_data: dict, db: Session = Depends(get_db)):
     db_cleaning = db.query(Cleaning).filter(Cleaning.cleaning_id == cleaning_id).first()
     if not db_cleaning:
@@ -548,24 +2831,128 @@ def update_cleaning(cleaning_id: int, cleaning_data: dict, db: Session = Depends
         db_cleaning.cleaning_status = cleaning_data["cleaning_status"]
     if "user_id" in cleaning_data:
         db_cleaning.user_id = cleaning_data["user_id"]
+    publish(db, "cleanings", "updated", cleaning_id)
     db.commit()
     db.refresh(db_cleaning)
     return db_cleaning
 
-@app.delete("/cleanings/{cleaning_id}")
+@router.delete("/cleanings/{cleaning_id}")
 def delete_cleaning(cleaning_id: int, db: Session = Depends(get_db)):
     db_cleaning = db.query(Cleaning).filter(Cleaning.cleaning_id == cleaning_id).first()
     if not db_cleaning:
         raise HTTPException(status_code=404, detail="Запись очистки не найдена")
     db.delete(db_cleaning)
+    publish(db, "cleanings", "deleted", cleaning_id)
     db.commit()
     return {"detail": "Запись очистки удалена"}
 
-@app.get("/booking-statuses")
-def list_booking_statuses(db: Session = Depends(get_db)):
-    return db.query(BookingStatus).order_by(BookingStatus.booking_status_id).all()
-
-@app.post("/booking-statuses")
+@router.get("/calendar", response_model=CalendarOut,
+         dependencies=[conditional_get("Rooms", "Bookings", "BookingRooms", "Cleaning", replica=True)])
+def get_calendar(
+    date_from: date,
+    days: int = Query(31, ge=1, le=366),
+    category_id: Optional[int] = None,
+    floor: Optional[int] = None,
+    db: Session = Depends(get_read_db)
+):
+    date_to = date_from + timedelta(days=days)
+    rooms_query = db.query(Room.room_id, Room.room_number, Room.category_id)
+    if category_id is not None:
+        rooms_query = rooms_query.filter(Room.category_id == category_id)
+    if floor is not None:
+        rooms_query = rooms_query.filter(Room.floor == floor)
+    rooms = rooms_query.order_by(Room.room_id).all()
+
+    # Все брони, пересекающиеся с окном, одним запросом; ночь занята с arrival_date до departure_date
+    stays = db.execute(text(
+        """
+        SELECT br.room_id, b.booking_id, b.arrival_date, b.departure_date
+        FROM "BookingRooms" br
+        JOIN "Bookings" b ON br.booking_id = b.booking_id
+        WHERE b.arrival_date < :date_to AND b.departure_date > :date_from
+        """
+    ), {"date_from": date_from, "date_to": date_to}).fetchall()
+    cleanings = db.query(Cleaning.room_id, Cleaning.cleaning_date, Cleaning.cleaning_status).filter(
+        Cleaning.cleaning_date >= datetime.combine(date_from, datetime.min.time()),
+        Cleaning.cleaning_date < datetime.combine(date_to, datetime.min.time())
+    ).order_by(Cleaning.cleaning_date).all()
+    return run_cpu_task(build_calendar, rooms, stays, cleanings, date_from, days)
+
+def build_calendar(rooms: list, stays: list, cleanings: list, date_from: date, days: int) -> dict:
+    room_ids = np.array([room.room_id for room in rooms], dtype=np.int64)
+    origin = date_from.toordinal()
+    occupancy = np.zeros((len(rooms), days), dtype=np.int64)
+    if stays and len(rooms):
+        stay_rooms = np.array([row[0] for row in stays], dtype=np.int64)
+        rows = np.searchsorted(room_ids, stay_rooms)
+        known = (rows < len(room_ids)) & (room_ids[np.minimum(rows, len(room_ids) - 1)] == stay_rooms)
+        booking_ids = np.array([row[1] for row in stays], dtype=np.int64)[known]
+        starts = np.clip(np.array([row[2].toordinal() for row in stays], dtype=np.int64) - origin, 0, days)[known]
+        ends = np.clip(np.array([row[3].toordinal() for row in stays], dtype=np.int64) - origin, 0, days)[known]
+        owners, columns = expand_ranges(starts, ends)
+        occupancy[rows[known][owners], columns] = booking_ids[owners]
+
+    statuses = sorted({row.cleaning_status for row in cleanings})
+    cleaning = np.zeros((len(rooms), days), dtype=np.int64)
+    if cleanings and len(rooms):
+        clean_rooms = np.array([row.room_id for row in cleanings], dtype=np.int64)
+        rows = np.searchsorted(room_ids, clean_rooms)
+        known = (rows < len(room_ids)) & (room_ids[np.minimum(rows, len(room_ids) - 1)] == clean_rooms)
+        columns = np.array([row.cleaning_date.toordinal() - origin for row in cleanings], dtype=np.int64)
+        codes = np.searchsorted(statuses, [row.cleaning_status for row in cleanings]) + 1
+        cleaning[rows[known], columns[known]] = codes[known]
+
+    occupied = occupancy > 0
+    by_day = occupied.mean(axis=0) if len(rooms) else np.zeros(days)
+    by_category = {}
+    if len(rooms):
+        categories, groups = np.unique([room.category_id for room in rooms], return_inverse=True)
+        nights = np.bincount(groups, weights=occupied.sum(axis=1))
+        capacity = np.bincount(groups) * days
+        by_category = {int(c): round(float(v), 4) for c, v in zip(categories, nights / capacity)}
+
+    return {
+        "date_from": date_from,
+        "days": days,
+        "cleaning_statuses": statuses,
+        "rooms": [
+            {"room_id": room.room_id, "room_number": room.room_number, "category_id": room.category_id,
+             "bookings": booking_runs, "cleaning": cleaning_runs}
+            for room, booking_runs, cleaning_runs in zip(rooms, run_lengths(occupancy), run_lengths(cleaning))
+        ],
+        "occupancy_by_day": np.round(by_day, 4).tolist(),
+        "occupancy_by_category": by_category,
+    }
+
+@router.get("/analytics", response_model=AnalyticsOut)
+def get_analytics(
+    request: Request,
+    response: Response,
+    date_from: date,
+    date_to: date,
+    bucket: str = Query("month", pattern="^(day|week|month)$"),
+    group_by: Optional[str] = Query(None, pattern="^(category|floor)$"),
+    db: Session = Depends(get_read_db)
+):
+    if date_to < date_from:
+        raise HTTPException(status_code=400, detail="Дата окончания раньше даты начала")
+    if (date_to - date_from).days > 3660:
+        raise HTTPException(status_code=400, detail="Период не может быть больше 10 лет")
+    versions = read_table_versions(db, ANALYTICS_TABLES)
+    check_not_modified(request, response, versions)
+    key = ("analytics", tuple((v.table_name, v.version) for v in versions), date_from, date_to, bucket, group_by)
+    rows = analytics_cache.get(key)
+    if rows is None:
+        rows = run_cpu_task(aggregate_analytics, load_analytics_columns(db, date_from, date_to),
+                            date_from, date_to, bucket, group_by)
+        analytics_cache.set(key, rows, 0)
+    return {"date_from": date_from, "date_to": date_to, "bucket": bucket, "group_by": group_by, "rows": rows}
+
+@router.get("/booking-statuses", response_model=list[BookingStatusOut])
+def list_booking_statuses(response: Response, page: PageParams = Depends(), db: Session = Depends(get_db)):
+    return cached_page(db, BookingStatus, BookingStatus.booking_status_id, page, BookingStatusOut, response)
+
+@router.post("/booking-statuses")
 def create_booking_status(status_data: dict, db: Session = Depends(get_db)):
     status = status_data.get("status_name")
     if not status:
@@ -575,212 +2962,487 @@ def create_booking_status(status_data: dict, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Статус бронирования с таким именем уже существует")
     db_status = BookingStatus(status_name=status)
     db.add(db_status)
+    invalidate_reference(db, "BookingStatus")
     db.commit()
     db.refresh(db_status)
     return db_status
 
-@app.put("/booking-statuses/{status_id}")
+@router.put("/booking-statuses/{status_id}")
 def update_booking_status(status_id: int, status_data: dict, db: Session = Depends(get_db)):
     db_status = db.query(BookingStatus).filter(BookingStatus.booking_status_id == status_id).first()
     if not db_status:
         raise HTTPException(status_code=404, detail="Статус бронирования не найден")
     if "status_name" in status_data:
         db_status.status_name = status_data["status_name"]
+    invalidate_reference(db, "BookingStatus")
     db.commit()
     db.refresh(db_status)
     return db_status
 
-@app.delete("/booking-statuses/{status_id}")
+@router.delete("/booking-statuses/{status_id}")
 def delete_booking_status(status_id: int, db: Session = Depends(get_db)):
     db_status = db.query(BookingStatus).filter(BookingStatus.booking_status_id == status_id).first()
     if not db_status:
         raise HTTPException(status_code=404, detail="Статус бронирования не найден")
     db.delete(db_status)
+    invalidate_reference(db, "BookingStatus")
     db.commit()
     return {"detail": "Статус бронирования удален"}
 
-@app.get("/bookings", response_model=list[BookingOut])
-def list_bookings(db: Session = Depends(get_db)):
-    return db.query(Booking).order_by(Booking.booking_id).all()
-
-@app.post("/bookings", response_model=BookingOut)
+# include= для бронирований: связь, схема, способ загрузки и таблица, версия которой входит в ETag.
+# Многие-к-одному — JOIN в основном запросе, списки — по одному запросу на всю страницу
+BOOKING_INCLUDES = {
+    "client": (Booking.client, ClientOut, joinedload, "Clients"),
+    "status": (Booking.status, BookingStatusOut, joinedload, "BookingStatus"),
+    "rooms": (Booking.rooms, RoomOut, selectinload, "Rooms"),
+    "payments": (Booking.payments, PaymentOut, selectinload, "Payments"),
+}
+BOOKING_INCLUDE_TABLES = {name: include[3] for name, include in BOOKING_INCLUDES.items()}
+
+def parse_includes(include: Optional[str]) -> tuple:
+    names = list(dict.fromkeys(name.strip() for name in (include or "").split(",") if name.strip()))
+    unknown = [name for name in names if name not in BOOKING_INCLUDES]
+    if unknown:
+        raise HTTPException(status_code=400, detail="Неизвестные связи: " + ", ".join(unknown))
+    return tuple(names)
+
+@functools.lru_cache(maxsize=None)
+def projection_model(schema, fields: tuple):
+    return create_model(schema.__name__ + "Fields", __config__=ConfigDict(from_attributes=True),
+                        **{name: (schema.model_fields[name].annotation, schema.model_fields[name]) for name in fields})
+
+def with_includes(query, fields: tuple, includes: tuple):
+    # Из Bookings читаются только запрошенные столбцы; room_id/room_ids — через room_links
+    columns = [getattr(Booking, name) for name in fields if name in Booking.__table__.c]
+    options = [load_only(Booking.booking_id, *columns)]
+    if "room_id" in fields or "room_ids" in fields:
+        options.append(selectinload(Booking.room_links))
+    for name in includes:
+        relation, _, loader, _ = BOOKING_INCLUDES[name]
+        options.append(loader(relation))
+    return query.options(*options)
+
+def booking_with_includes(booking: Booking, model, includes: tuple) -> dict:
+    item = model.model_validate(booking).model_dump()
+    for name in includes:
+        schema = BOOKING_INCLUDES[name][1]
+        value = getattr(booking, name)
+        if isinstance(value, list):
+            item[name] = [schema.model_validate(row, from_attributes=True).model_dump() for row in value]
+        else:
+            item[name] = None if value is None else schema.model_validate(value, from_attributes=True).model_dump()
+    return item
+
+def booking_page(query, page: PageParams, include: str, response: Response):
+    if page.stream:
+        raise HTTPException(status_code=400, detail="include нельзя использовать вместе со stream")
+    fields = parse_fields(BookingOut, page.fields) or tuple(BookingOut.model_fields)
+    includes = parse_includes(include)
+    if page.after is not None:
+        query = query.filter(Booking.booking_id > page.after)
+    bookings = with_includes(query, fields, includes).order_by(Booking.booking_id).limit(page.limit).all()
+    if len(bookings) == page.limit:
+        response.headers["X-Next-After"] = str(bookings[-1].booking_id)
+    model = projection_model(BookingOut, fields)
+    return json_response(orjson.dumps([booking_with_includes(booking, model, includes) for booking in bookings]),
+                         response)
+
+@router.get("/bookings", response_model=list[BookingOut],
+            dependencies=[conditional_get("Bookings", "BookingRooms", includes=BOOKING_INCLUDE_TABLES,
+                                          replica=True)])
+def list_bookings(
+    response: Response,
+    page: PageParams = Depends(),
+    include: Optional[str] = None,
+    client_id: Optional[int] = None,
+    booking_status_id: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    db: Session = Depends(get_read_db)
+):
+    query = db.query(Booking)
+    if client_id is not None:
+        query = query.filter(Booking.client_id == client_id)
+    if booking_status_id is not None:
+        query = query.filter(Booking.booking_status_id == booking_status_id)
+    # Бронирования, пересекающиеся с периодом проживания
+    if date_from is not None:
+        query = query.filter(Booking.departure_date >= date_from)
+    if date_to is not None:
+        query = query.filter(Booking.arrival_date <= date_to)
+    if include:
+        return booking_page(query, page, include, response)
+    return paginate(query.options(selectinload(Booking.room_links)), Booking.booking_id, page, BookingOut, response)
+
+def booking_write_error(db: Session, e: IntegrityError, booking: BookingCreate,
+                        booking_id: Optional[int] = None) -> HTTPException:
+    db.rollback()
+    code = getattr(e.orig, "pgcode", None) or getattr(e.orig, "sqlstate", None)
+    if code == "23P01":
+        # Какие именно номера заняты — одним запросом по всем номерам брони
+        busy = busy_rooms_sql(db, booking.room_ids, booking.arrival_date, booking.departure_date, booking_id)
+        if len(booking.room_ids) > 1 and busy:
+            return HTTPException(status_code=400, detail="Выбранные номера заняты на эти даты: "
+                                 + ", ".join(str(room_id) for room_id in sorted(busy)))
+        return HTTPException(status_code=400, detail="Выбранный номер занят на эти даты")
+    if code == "23503":
+        return HTTPException(status_code=400, detail="Клиент, статус или номер не найден")
+    raise e
+
+@router.post("/bookings", response_model=BookingOut)
 def create_booking(booking: BookingCreate, db: Session = Depends(get_db)):
     if booking.departure_date <= booking.arrival_date:
         raise HTTPException(status_code=400, detail="Дата выезда должна быть позже даты заезда")
-    conflict = db.execute(
-        """
-        SELECT b.booking_id
-        FROM BookingRooms br
-        JOIN Bookings b ON br.booking_id = b.booking_id
-        WHERE br.room_id = :room_id
-          AND NOT (:departure_date <= b.arrival_date OR :arrival_date >= (b.departure_date + INTERVAL '1 day'))
-        """,
-        {"room_id": booking.room_id, "arrival_date": booking.arrival_date, "departure_date": booking.departure_date}
-    ).fetchone()
-    if conflict:
-        raise HTTPException(status_code=400, detail="Выбранный номер занят на эти даты")
-    db_booking = Booking(
-        client_id=booking.client_id,
-        arrival_date=booking.arrival_date,
-        departure_date=booking.departure_date,
-        booking_status_id=booking.booking_status_id,
-        total_cost=booking.total_cost
-    )
-    db.add(db_booking)
-    db.commit()
-    db.refresh(db_booking)
-    db.execute(
-        "INSERT INTO BookingRooms (booking_id, room_id) VALUES (:booking_id, :room_id)",
-        {"booking_id": db_booking.booking_id, "room_id": booking.room_id}
-    )
-    db.commit()
+    # Бронь и все связи с номерами пишутся одним запросом в одной транзакции,
+    # пересечения отсекает ограничение booking_rooms_no_overlap, а не предварительный SELECT
+    try:
+        row = db.execute(text(
+            """
+            WITH new_booking AS (
+                INSERT INTO "Bookings" (client_id, booking_date, arrival_date, departure_date, booking_status_id, total_cost)
+                VALUES (:client_id, now(), :arrival_date, :departure_date, :booking_status_id, :total_cost)
+                RETURNING booking_id, booking_date
+            ), new_rooms AS (
+                INSERT INTO "BookingRooms" (booking_id, room_id, stay)
+                SELECT new_booking.booking_id, rooms.room_id, daterange(:arrival_date, :departure_date, '[)')
+                FROM new_booking, unnest(CAST(:room_ids AS integer[])) AS rooms(room_id)
+            )
+            SELECT booking_id, booking_date FROM new_booking
+            """
+        ), booking.dict()).one()
+        apply_sales_delta(db, row.booking_date.date(), rooms=len(booking.room_ids))
+        touch_tables(db, "Bookings", "BookingRooms")
+        update_room_index(db, lambda: room_index.add(
+            row.booking_id, booking.room_ids, booking.arrival_date, booking.departure_date))
+        publish(db, "bookings", "created", row.booking_id)
+        db.commit()
+    except IntegrityError as e:
+        raise booking_write_error(db, e, booking)
+    return {**booking.dict(), "booking_id": row.booking_id, "booking_date": row.booking_date}
+
+@router.get("/bookings/{booking_id}", response_model=BookingOut,
+         dependencies=[conditional_get("Bookings", "BookingRooms", includes=BOOKING_INCLUDE_TABLES)])
+def get_booking(
+    booking_id: int,
+    response: Response,
+    fields: Optional[str] = None,
+    include: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    query = db.query(Booking).filter(Booking.booking_id == booking_id)
+    if include:
+        fields = parse_fields(BookingOut, fields) or tuple(BookingOut.model_fields)
+        includes = parse_includes(include)
+        db_booking = with_includes(query, fields, includes).first()
+        if not db_booking:
+            raise HTTPException(status_code=404, detail="Бронирование не найдено")
+        return json_response(orjson.dumps(booking_with_includes(db_booking, projection_model(BookingOut, fields),
+                                                                includes)), response)
+    if fields:
+        return fast_item(query, BookingOut, fields, response, "Бронирование не найдено")
+    db_booking = query.options(selectinload(Booking.room_links)).first()
+    if not db_booking:
+        raise HTTPException(status_code=404, detail="Бронирование не найдено")
     return db_booking
 
-@app.put("/bookings/{booking_id}", response_model=BookingOut)
+@router.put("/bookings/{booking_id}", response_model=BookingOut)
 def update_booking(booking_id: int, booking: BookingCreate, db: Session = Depends(get_db)):
-    db_booking = db.query(Booking).filter(Booking.booking_id == booking_id).first()
-    if not db_booking:
-        raise HTTPException(status_code=404, detail="Бронирование не найдено")
     if booking.departure_date <= booking.arrival_date:
         raise HTTPException(status_code=400, detail="Дата выезда должна быть позже даты заезда")
-    conflict = db.execute(
-        """
-        SELECT b.booking_id
-        FROM BookingRooms br
-        JOIN Bookings b ON br.booking_id = b.booking_id
-        WHERE br.room_id = :room_id
-          AND b.booking_id <> :booking_id
-          AND NOT (:departure_date <= b.arrival_date OR :arrival_date >= (b.departure_date + INTERVAL '1 day'))
-        """,
-        {"room_id": booking.room_id, "booking_id": booking_id,
-         "arrival_date": booking.arrival_date, "departure_date": booking.departure_date}
-    ).fetchone()
-    if conflict:
-        raise HTTPException(status_code=400, detail="Выбранный номер занят на эти даты")
-    for field, value in booking.dict(exclude={"room_id"}).items():
-        setattr(db_booking, field, value)
-    db.commit()
-    db.refresh(db_booking)
-    # Обновляем связь с номером
-    db.execute("DELETE FROM BookingRooms WHERE booking_id = :booking_id", {"booking_id": booking_id})
-    db.execute("INSERT INTO BookingRooms (booking_id, room_id) VALUES (:booking_id, :room_id)",
-               {"booking_id": booking_id, "room_id": booking.room_id})
-    db.commit()
-    return db_booking
+    params = {**booking.dict(), "booking_id": booking_id}
+    try:
+        # Строка брони блокируется первой, в том же порядке, что и при создании (Bookings, затем BookingRooms):
+        # параллельные изменения одной брони идут по очереди, и следующее видит связи, записанные предыдущим
+        if db.execute(text('SELECT 1 FROM "Bookings" WHERE booking_id = :booking_id FOR UPDATE'), params).first() is None:
+            db.rollback()
+            raise HTTPException(status_code=404, detail="Бронирование не найдено")
+        # Старые связи удаляются до смены дат, чтобы триггер не переписал stay у номеров, которые уходят из брони
+        removed = db.execute(text('DELETE FROM "BookingRooms" WHERE booking_id = :booking_id'), params).rowcount
+        row = db.execute(text(
+            """
+            UPDATE "Bookings"
+            SET client_id = :client_id, arrival_date = :arrival_date, departure_date = :departure_date,
+                booking_status_id = :booking_status_id, total_cost = :total_cost
+            WHERE booking_id = :booking_id
+            RETURNING booking_id, booking_date
+            """
+        ), params).one()
+        db.execute(text(
+            """
+            INSERT INTO "BookingRooms" (booking_id, room_id, stay)
+            SELECT :booking_id, rooms.room_id, daterange(:arrival_date, :departure_date, '[)')
+            FROM unnest(CAST(:room_ids AS integer[])) AS rooms(room_id)
+            """
+        ), params)
+        if row.booking_date is not None:
+            apply_sales_delta(db, row.booking_date.date(), rooms=len(booking.room_ids) - removed)
+        touch_tables(db, "Bookings", "BookingRooms")
+        update_room_index(db, lambda: room_index.add(
+            booking_id, booking.room_ids, booking.arrival_date, booking.departure_date))
+        publish(db, "bookings", "updated", booking_id)
+        db.commit()
+    except IntegrityError as e:
+        raise booking_write_error(db, e, booking, booking_id)
+    return {**booking.dict(), "booking_id": row.booking_id, "booking_date": row.booking_date}
 
-@app.delete("/bookings/{booking_id}")
+@router.delete("/bookings/{booking_id}")
 def delete_booking(booking_id: int, db: Session = Depends(get_db)):
     db_booking = db.query(Booking).filter(Booking.booking_id == booking_id).first()
     if not db_booking:
         raise HTTPException(status_code=404, detail="Бронирование не найдено")
+    if db_booking.booking_date is not None:
+        rooms = db.query(func.count()).select_from(BookingRoom).filter(BookingRoom.booking_id == booking_id).scalar()
+        apply_sales_delta(db, db_booking.booking_date.date(), rooms=-rooms)
+    # Платежи брони удаляются каскадом, использование услуг остается (booking_id SET NULL)
+    for day, amount in sales_by_day(db, Payment.payment_date, func.sum(Payment.amount), Payment.booking_id == booking_id):
+        apply_sales_delta(db, day, revenue=-amount)
     db.delete(db_booking)
+    update_room_index(db, lambda: room_index.remove(booking_id))
+    publish(db, "bookings", "deleted", booking_id)
     db.commit()
     return {"detail": "Бронирование удалено"}
 
-@app.get("/payments", response_model=list[PaymentOut])
-def list_payments(db: Session = Depends(get_db)):
-    return db.query(Payment).order_by(Payment.payment_id).all()
+@router.get("/payments", response_model=list[PaymentOut])
+def list_payments(
+    response: Response,
+    page: PageParams = Depends(),
+    booking_id: Optional[int] = None,
+    payment_method_id: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    db: Session = Depends(get_read_db)
+):
+    query = filter_dates(db.query(Payment), Payment.payment_date, date_from, date_to)
+    if booking_id is not None:
+        query = query.filter(Payment.booking_id == booking_id)
+    if payment_method_id is not None:
+        query = query.filter(Payment.payment_method_id == payment_method_id)
+    return paginate(query, Payment.payment_id, page, PaymentOut, response)
+
+@router.post("/payments/import", response_model=ImportResult)
+def import_payments(upload=Depends(read_import_body), db: Session = Depends(get_db)):
+    total, rows, errors = validate_import(upload, PaymentImport)
+    stage_rows(db, "import_payments", ["booking_id", "amount", "payment_method_id", "payment_date"], [
+        (row_no, p.booking_id, p.amount, p.payment_method_id, p.payment_date) for row_no, p in rows
+    ])
+    errors += import_errors(db, """
+        SELECT s.row_no, CASE WHEN b.booking_id IS NULL THEN 'Бронирование не найдено'
+                              ELSE 'Способ оплаты не найден' END AS error
+        FROM import_payments s
+        LEFT JOIN "Bookings" b ON b.booking_id = s.booking_id::integer
+        LEFT JOIN "PaymentMethod" m ON m.payment_method_id = s.payment_method_id::integer
+        WHERE b.booking_id IS NULL OR m.payment_method_id IS NULL
+    """)
+    # Вставленные строки сразу сворачиваются в суммы по дням для SalesAnalysis
+    totals = db.execute(text(
+        """
+        WITH inserted AS (
+            INSERT INTO "Payments" (booking_id, amount, payment_method_id, payment_date)
+            SELECT s.booking_id::integer, s.amount::numeric, s.payment_method_id::integer,
+                   COALESCE(s.payment_date::timestamp, now())
+            FROM import_payments s
+            JOIN "Bookings" b ON b.booking_id = s.booking_id::integer
+            JOIN "PaymentMethod" m ON m.payment_method_id = s.payment_method_id::integer
+            ORDER BY s.row_no
+            RETURNING payment_date, amount
+        )
+        SELECT payment_date::date AS day, sum(amount) AS amount, count(*) AS inserted
+        FROM inserted GROUP BY 1
+        """
+    )).fetchall()
+    for row in totals:
+        apply_sales_delta(db, row.day, revenue=row.amount)
+    inserted = sum(row.inserted for row in totals)
+    if inserted:
+        touch_tables(db, "Payments")
+    db.commit()
+    return {"total": total, "inserted": inserted, "errors": sorted(errors, key=lambda error: error["row"])}
 
-@app.post("/payments", response_model=PaymentOut)
+@router.post("/payments", response_model=PaymentOut)
 def create_payment(payment: PaymentCreate, db: Session = Depends(get_db)):
     db_payment = Payment(**payment.dict())
     db.add(db_payment)
+    apply_sales_delta(db, None, revenue=payment.amount)
     db.commit()
     db.refresh(db_payment)
     return db_payment
 
-@app.put("/payments/{payment_id}", response_model=PaymentOut)
+@router.put("/payments/{payment_id}", response_model=PaymentOut)
 def update_payment(payment_id: int, payment: PaymentCreate, db: Session = Depends(get_db)):
     db_payment = db.query(Payment).filter(Payment.payment_id == payment_id).first()
     if not db_payment:
         raise HTTPException(status_code=404, detail="Платеж не найден")
+    if db_payment.payment_date is not None:
+        apply_sales_delta(db, db_payment.payment_date.date(), revenue=-db_payment.amount)
+        apply_sales_delta(db, db_payment.payment_date.date(), revenue=payment.amount)
     for key, value in payment.dict().items():
         setattr(db_payment, key, value)
     db.commit()
     db.refresh(db_payment)
     return db_payment
 
-@app.delete("/payments/{payment_id}")
+@router.delete("/payments/{payment_id}")
 def delete_payment(payment_id: int, db: Session = Depends(get_db)):
     db_payment = db.query(Payment).filter(Payment.payment_id == payment_id).first()
     if not db_payment:
         raise HTTPException(status_code=404, detail="Платеж не найден")
+    if db_payment.payment_date is not None:
+        apply_sales_delta(db, db_payment.payment_date.date(), revenue=-db_payment.amount)
     db.delete(db_payment)
     db.commit()
     return {"detail": "Платеж удален"}
 
-@app.get("/services", response_model=list[AdditionalServiceOut])
-def list_services(db: Session = Depends(get_db)):
-    return db.query(AdditionalService).order_by(AdditionalService.service_id).all()
+@router.get("/services", response_model=list[AdditionalServiceOut])
+def list_services(response: Response, page: PageParams = Depends(), db: Session = Depends(get_db)):
+    return cached_page(db, AdditionalService, AdditionalService.service_id, page, AdditionalServiceOut, response)
 
-@app.post("/services", response_model=AdditionalServiceOut)
+@router.post("/services", response_model=AdditionalServiceOut)
 def create_service(service: AdditionalServiceCreate, db: Session = Depends(get_db)):
     exist = db.query(AdditionalService).filter(AdditionalService.service_name == service.service_name).first()
     if exist:
         raise HTTPException(status_code=400, detail="Услуга с таким названием уже существует")
     db_service = AdditionalService(**service.dict())
     db.add(db_service)
+    invalidate_reference(db, "AdditionalServices")
     db.commit()
     db.refresh(db_service)
     return db_service
 
-@app.put("/services/{service_id}", response_model=AdditionalServiceOut)
+@router.put("/services/{service_id}", response_model=AdditionalServiceOut)
 def update_service(service_id: int, service: AdditionalServiceCreate, db: Session = Depends(get_db)):
     db_service = db.query(AdditionalService).filter(AdditionalService.service_id == service_id).first()
     if not db_service:
         raise HTTPException(status_code=404, detail="Услуга не найдена")
     for key, value in service.dict().items():
         setattr(db_service, key, value)
+    invalidate_reference(db, "AdditionalServices")
     db.commit()
     db.refresh(db_service)
     return db_service
 
-@app.delete("/services/{service_id}")
+@router.delete("/services/{service_id}")
 def delete_service(service_id: int, db: Session = Depends(get_db)):
     db_service = db.query(AdditionalService).filter(AdditionalService.service_id == service_id).first()
     if not db_service:
         raise HTTPException(status_code=404, detail="Услуга не найдена")
+    # Использование услуги удаляется каскадом
+    for day, cost in sales_by_day(db, ServiceUsage.usage_date, func.sum(ServiceUsage.cost), ServiceUsage.service_id == service_id):
+        apply_sales_delta(db, day, services=-cost)
     db.delete(db_service)
+    invalidate_reference(db, "AdditionalServices")
     db.commit()
     return {"detail": "Услуга удалена"}
 
-@app.get("/service-usage", response_model=list[ServiceUsageOut])
-def list_service_usage(db: Session = Depends(get_db)):
-    return db.query(ServiceUsage).order_by(ServiceUsage.service_usage_id).all()
+@router.get("/service-usage", response_model=list[ServiceUsageOut])
+def list_service_usage(
+    response: Response,
+    page: PageParams = Depends(),
+    client_id: Optional[int] = None,
+    booking_id: Optional[int] = None,
+    service_id: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    db: Session = Depends(get_read_db)
+):
+    query = filter_dates(db.query(ServiceUsage), ServiceUsage.usage_date, date_from, date_to)
+    if client_id is not None:
+        query = query.filter(ServiceUsage.client_id == client_id)
+    if booking_id is not None:
+        query = query.filter(ServiceUsage.booking_id == booking_id)
+    if service_id is not None:
+        query = query.filter(ServiceUsage.service_id == service_id)
+    return paginate(query, ServiceUsage.service_usage_id, page, ServiceUsageOut, response)
+
+@router.post("/service-usage/import", response_model=ImportResult)
+def import_service_usage(upload=Depends(read_import_body), db: Session = Depends(get_db)):
+    total, rows, errors = validate_import(upload, ServiceUsageImport)
+    errors += [{"row": row_no, "error": "quantity должно быть больше 0"} for row_no, u in rows if u.quantity <= 0]
+    stage_rows(db, "import_usage", ["client_id", "service_id", "booking_id", "quantity", "cost", "usage_date"], [
+        (row_no, u.client_id, u.service_id, u.booking_id, u.quantity, u.cost, u.usage_date)
+        for row_no, u in rows if u.quantity > 0
+    ])
+    errors += import_errors(db, """
+        SELECT s.row_no, CASE WHEN c.client_id IS NULL THEN 'Клиент не найден'
+                              WHEN a.service_id IS NULL THEN 'Услуга не найдена'
+                              ELSE 'Бронирование не найдено' END AS error
+        FROM import_usage s
+        LEFT JOIN "Clients" c ON c.client_id = s.client_id::integer
+        LEFT JOIN "AdditionalServices" a ON a.service_id = s.service_id::integer
+        LEFT JOIN "Bookings" b ON b.booking_id = s.booking_id::integer
+        WHERE c.client_id IS NULL OR a.service_id IS NULL OR b.booking_id IS NULL
+    """)
+    totals = db.execute(text(
+        """
+        WITH inserted AS (
+            INSERT INTO "Service_Usage" (client_id, service_id, booking_id, quantity, cost, usage_date)
+            SELECT s.client_id::integer, s.service_id::integer, s.booking_id::integer, s.quantity::integer,
+                   s.cost::numeric, COALESCE(s.usage_date::timestamp, now())
+            FROM import_usage s
+            JOIN "Clients" c ON c.client_id = s.client_id::integer
+            JOIN "AdditionalServices" a ON a.service_id = s.service_id::integer
+            JOIN "Bookings" b ON b.booking_id = s.booking_id::integer
+            ORDER BY s.row_no
+            RETURNING usage_date, cost
+        )
+        SELECT usage_date::date AS day, sum(cost) AS cost, count(*) AS inserted
+        FROM inserted GROUP BY 1
+        """
+    )).fetchall()
+    for row in totals:
+        apply_sales_delta(db, row.day, services=row.cost)
+    inserted = sum(row.inserted for row in totals)
+    if inserted:
+        touch_tables(db, "Service_Usage")
+    db.commit()
+    return {"total": total, "inserted": inserted, "errors": sorted(errors, key=lambda error: error["row"])}
 
-@app.post("/service-usage", response_model=ServiceUsageOut)
+@router.post("/service-usage", response_model=ServiceUsageOut)
 def create_service_usage(usage: ServiceUsageCreate, db: Session = Depends(get_db)):
     db_usage = ServiceUsage(**usage.dict())
     db.add(db_usage)
+    apply_sales_delta(db, None, services=usage.cost)
     db.commit()
     db.refresh(db_usage)
     return db_usage
 
-@app.put("/service-usage/{usage_id}", response_model=ServiceUsageOut)
+@router.put("/service-usage/{usage_id}", response_model=ServiceUsageOut)
 def update_service_usage(usage_id: int, usage: ServiceUsageCreate, db: Session = Depends(get_db)):
     db_usage = db.query(ServiceUsage).filter(ServiceUsage.service_usage_id == usage_id).first()
     if not db_usage:
         raise HTTPException(status_code=404, detail="Запись использования услуги не найдена")
+    if db_usage.usage_date is not None:
+        apply_sales_delta(db, db_usage.usage_date.date(), services=-db_usage.cost)
+        apply_sales_delta(db, db_usage.usage_date.date(), services=usage.cost)
     for key, value in usage.dict().items():
         setattr(db_usage, key, value)
     db.commit()
     db.refresh(db_usage)
     return db_usage
 
-@app.delete("/service-usage/{usage_id}")
+@router.delete("/service-usage/{usage_id}")
 def delete_service_usage(usage_id: int, db: Session = Depends(get_db)):
     db_usage = db.query(ServiceUsage).filter(ServiceUsage.service_usage_id == usage_id).first()
     if not db_usage:
         raise HTTPException(status_code=404, detail="Запись использования услуги не найдена")
+    if db_usage.usage_date is not None:
+        apply_sales_delta(db, db_usage.usage_date.date(), services=-db_usage.cost)
     db.delete(db_usage)
     db.commit()
     return {"detail": "Запись использования услуги удалена"}
 
-@app.get("/documents", response_model=list[DocumentOut])
-def list_documents(db: Session = Depends(get_db)):
-    return db.query(Document).order_by(Document.document_id).all()
+@router.get("/documents", response_model=list[DocumentOut])
+def list_documents(
+    response: Response,
+    page: PageParams = Depends(),
+    booking_id: Optional[int] = None,
+    db: Session = Depends(get_read_db)
+):
+    query = db.query(Document)
+    if booking_id is not None:
+        query = query.filter(Document.booking_id == booking_id)
+    return paginate(query, Document.document_id, page, DocumentOut, response)
 
-@app.post("/documents", response_model=DocumentOut)
+@router.post("/documents", response_model=DocumentOut)
 def create_document(document: DocumentCreate, db: Session = Depends(get_db)):
     db_doc = Document(**document.dict())
     db.add(db_doc)
@@ -788,7 +3450,7 @@ def create_document(document: DocumentCreate, db: Session = Depends(get_db)):
     db.refresh(db_doc)
     return db_doc
 
-@app.put("/documents/{document_id}", response_model=DocumentOut)
+@router.put("/documents/{document_id}", response_model=DocumentOut)
 def update_document(document_id: int, document: DocumentCreate, db: Session = Depends(get_db)):
     db_doc = db.query(Document).filter(Document.document_id == document_id).first()
     if not db_doc:
@@ -799,7 +3461,7 @@ def update_document(document_id: int, document: DocumentCreate, db: Session = De
     db.refresh(db_doc)
     return db_doc
 
-@app.delete("/documents/{document_id}")
+@router.delete("/documents/{document_id}")
 def delete_document(document_id: int, db: Session = Depends(get_db)):
     db_doc = db.query(Document).filter(Document.document_id == document_id).first()
     if not db_doc:
@@ -808,39 +3470,319 @@ def delete_document(document_id: int, db: Session = Depends(get_db)):
     db.commit()
     return {"detail": "Документ удален"}
 
-@app.get("/sales-analysis", response_model=list[SalesAnalysisOut])
-def list_sales_analysis(db: Session = Depends(get_db)):
-    return db.query(SalesAnalysis).order_by(SalesAnalysis.analysis_id).all()
-
-@app.post("/sales-analysis", response_model=SalesAnalysisOut)
-def create_sales_analysis(analysis: SalesAnalysisCreate, db: Session = Depends(get_db)):
-    db_analysis = SalesAnalysis(**analysis.dict())
-    db.add(db_analysis)
-    db.commit()
-    db.refresh(db_analysis)
-    return db_analysis
-
-@app.put("/sales-analysis/{analysis_id}", response_model=SalesAnalysisOut)
-def update_sales_analysis(analysis_id: int, analysis: SalesAnalysisCreate, db: Session = Depends(get_db)):
-    db_analysis = db.query(SalesAnalysis).filter(SalesAnalysis.analysis_id == analysis_id).first()
-    if not db_analysis:
-        raise HTTPException(status_code=404, detail="Запись анализа не найдена")
-    for key, value in analysis.dict().items():
-        setattr(db_analysis, key, value)
-    db.commit()
-    db.refresh(db_analysis)
-    return db_analysis
-
-@app.delete("/sales-analysis/{analysis_id}")
-def delete_sales_analysis(analysis_id: int, db: Session = Depends(get_db)):
-    db_analysis = db.query(SalesAnalysis).filter(SalesAnalysis.analysis_id == analysis_id).first()
-    if not db_analysis:
-        raise HTTPException(status_code=404, detail="Запись анализа не найдена")
-    db.delete(db_analysis)
-    db.commit()
-    return {"detail": "Запись анализа удалена"}
+@router.get("/sales-analysis", response_model=list[SalesAnalysisOut])
+def list_sales_analysis(
+    response: Response,
+    page: PageParams = Depends(),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    db: Session = Depends(get_read_db)
+):
+    query = db.query(SalesAnalysis)
+    if date_from is not None:
+        query = query.filter(SalesAnalysis.analysis_date >= date_from)
+    if date_to is not None:
+        query = query.filter(SalesAnalysis.analysis_date <= date_to)
+    return paginate(query, SalesAnalysis.analysis_id, page, SalesAnalysisOut, response)
+
+# Строки SalesAnalysis ведутся дельтами платежей, услуг и броней: ручная вставка, правка или удаление
+# разошлись бы с ними при следующей дельте, поэтому итоги меняет только пересчет backfill-sales
+@router.api_route("/sales-analysis", methods=["POST"], include_in_schema=False)
+@router.api_route("/sales-analysis/{analysis_id}", methods=["PUT", "DELETE"], include_in_schema=False)
+def sales_analysis_read_only():
+    raise HTTPException(status_code=405, headers={"Allow": "GET"},
+                        detail="Итоги продаж считаются автоматически, пересчет: python server.py backfill-sales")
+
+BATCH_REFERENCE = re.compile(r"\$(\d+)\.(\w+)")
+# Пакет вызывает обработчики через внутренний API FastAPI (solve_dependencies, APIRoute._embed_body_fields);
+# проверенный диапазон версий закреплен в requirements.txt, на несовместимой версии /batch отвечает 501
+BATCH_SUPPORTED = {"request", "dependant", "body", "dependency_overrides_provider", "async_exit_stack",
+                   "embed_body_fields"} <= set(inspect.signature(solve_dependencies).parameters)
+
+def batch_reference(match, results: list):
+    index, name = int(match.group(1)), match.group(2)
+    if index >= len(results) or not isinstance(results[index], dict) or name not in results[index]:
+        raise HTTPException(status_code=400, detail=f"Неверная ссылка {match.group(0)}")
+    return results[index][name]
+
+def resolve_references(value, results: list):
+    # Строка целиком из ссылки сохраняет тип значения, ссылка внутри строки подставляется текстом
+    if isinstance(value, str):
+        match = BATCH_REFERENCE.fullmatch(value)
+        if match:
+            return batch_reference(match, results)
+        return BATCH_REFERENCE.sub(lambda m: str(batch_reference(m, results)), value)
+    if isinstance(value, dict):
+        return {key: resolve_references(item, results) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_references(item, results) for item in value]
+    return value
+
+@functools.lru_cache(maxsize=None)
+def response_adapter(model) -> TypeAdapter:
+    return TypeAdapter(model)
+
+@asynccontextmanager
+async def batch_session(deferred: list):
+    # Одна транзакция на весь пакет. Обработчики работают с обычной сессией, но их commit/rollback
+    # затрагивают только точку сохранения; ошибка любой операции откатывает все
+    tables = set()
+    if ASYNC_DB:
+        async with get_async_engine().connect() as conn, conn.begin():
+            async with AsyncSessionLocal(bind=conn, join_transaction_mode="create_savepoint") as db:
+                db.info["deferred_after_commit"] = deferred
+                db.info["batch_tables"] = tables
+                yield db
+            if tables:
+                result = await conn.execute(BUMP_TABLE_VERSIONS_SQL, {"tables": versioned(tables)})
+                db.info["table_versions"] = dict(result.fetchall())
+        return
+    conn = await run_in_threadpool(get_engine().connect)
+    db = SessionLocal(bind=conn, join_transaction_mode="create_savepoint")
+    db.info["deferred_after_commit"] = deferred
+    db.info["batch_tables"] = tables
+    try:
+        transaction = await run_in_threadpool(conn.begin)
+        yield db
+        if tables:
+            result = await run_in_threadpool(conn.execute, BUMP_TABLE_VERSIONS_SQL, {"tables": versioned(tables)})
+            db.info["table_versions"] = dict(result.fetchall())
+        await run_in_threadpool(transaction.commit)
+    finally:
+        await run_in_threadpool(db.close)
+        await run_in_threadpool(conn.close)
+
+def depends_on(dependant, call) -> bool:
+    return any(dependency.call is call or depends_on(dependency, call) for dependency in dependant.dependencies)
+
+def streams_response(route: APIRoute, query: dict) -> bool:
+    # Потоковый ответ в пакете не читается, и ресурсы генератора (подписка, курсор) не освобождались бы
+    stream = query.get("stream")
+    return route.endpoint is changes or (
+        depends_on(route.dependant, PageParams) and str(stream).lower() in ("1", "true", "t", "yes", "y", "on"))
+
+def match_route(method: str, path: str, query: Optional[dict] = None):
+    scope = {"type": "http", "method": method, "path": path}
+    for route in router.routes:
+        if isinstance(route, APIRoute) and route.path != "/batch":
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                # У операции пакета есть только JSON-тело, файлы импорта читаются из потока запроса
+                if depends_on(route.dependant, read_import_body) or streams_response(route, query or {}):
+                    raise HTTPException(status_code=400, detail=f"Маршрут не поддерживается в пакете: {method} {path}")
+                if not hasattr(route, "_embed_body_fields"):
+                    raise HTTPException(status_code=501, detail="Пакетные запросы не поддерживаются этой версией FastAPI")
+                return route, child_scope["path_params"]
+    raise HTTPException(status_code=404, detail=f"Маршрут не найден: {method} {path}")
+
+async def run_batch_operation(request: Request, db, operation: BatchOperation, results: list) -> BatchResult:
+    path = resolve_references(operation.path, results)
+    query = {key: resolve_references(value, results) for key, value in operation.query.items()}
+    route, path_params = match_route(operation.method, path, query)
+    # Заголовки пакета (Authorization) передаются каждой операции, кроме описания тела
+    headers = [(key, value) for key, value in request.scope["headers"]
+               if key not in (b"content-length", b"content-type", b"if-none-match")]
+    sub_request = Request({
+        **request.scope, "method": operation.method, "path": path, "raw_path": path.encode(),
+        "query_string": urlencode(query, doseq=True).encode(), "headers": headers,
+        "path_params": path_params, "route": route,
+    })
+
+    async def override_db():
+        return db
+    # Чтения внутри пакета видят его же незафиксированные изменения, реплика здесь не используется
+    overrides = {get_db: override_db, get_read_db: override_db}
+
+    async with AsyncExitStack() as stack:
+        solved = await solve_dependencies(
+            request=sub_request, dependant=route.dependant, body=resolve_references(operation.body, results),
+            dependency_overrides_provider=SimpleNamespace(dependency_overrides=overrides),
+            async_exit_stack=stack, embed_body_fields=route._embed_body_fields,
+        )
+        if solved.errors:
+            raise HTTPException(status_code=422, detail=jsonable_encoder(solved.errors))
+        call = route.dependant.call
+        if inspect.iscoroutinefunction(call):
+            content = await call(**solved.values)
+        else:
+            content = await run_in_threadpool(call, **solved.values)
+    if isinstance(content, StreamingResponse):
+        raise HTTPException(status_code=400, detail="Потоковые ответы в пакете не поддерживаются")
+    if isinstance(content, Response):
+        return BatchResult(status=content.status_code, body=json.loads(content.body) if content.body else None)
+    if route.response_model is not None:
+        adapter = response_adapter(route.response_model)
+        content = adapter.dump_python(adapter.validate_python(content, from_attributes=True), mode="json")
+    else:
+        content = jsonable_encoder(content)
+    return BatchResult(status=solved.response.status_code or route.status_code or 200, body=content)
+
+# Несколько операций за один запрос и в одной транзакции: либо выполняются все, либо ни одна
+@router.post("/batch", response_model=BatchOut)
+async def batch(data: BatchData, request: Request):
+    if not BATCH_SUPPORTED:
+        raise HTTPException(status_code=501, detail="Пакетные запросы не поддерживаются этой версией FastAPI")
+    if len(data.operations) > BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"Не больше {BATCH_MAX_OPERATIONS} операций в пакете")
+    results, bodies, deferred = [], [], []
+    async with batch_session(deferred) as db:
+        for index, operation in enumerate(data.operations):
+            try:
+                result = await run_batch_operation(request, db, operation, bodies)
+            except HTTPException as e:
+                # Исключение выходит из batch_session, и транзакция откатывается
+                raise HTTPException(status_code=e.status_code, detail={"index": index, "detail": e.detail},
+                                    headers=e.headers)
+            except SalesDriftError as e:
+                raise HTTPException(status_code=409, detail={"index": index, "detail": str(e)})
+            results.append(result)
+            bodies.append(result.body)
+    for fn in deferred:
+        fn()
+    return BatchOut(results=results)
+
+CHANGE_TOPICS = ("rooms", "bookings", "cleanings")
+
+def sse_event(event: dict) -> str:
+    return f'id: {event["seq"]}\nevent: {event["topic"]}\ndata: {event["data"]}\n\n'
+
+# Лента изменений (Server-Sent Events) вместо опроса /rooms, /bookings, /cleanings: событие
+# {"seq", "topic", "action", "id"} на каждое создание, изменение и удаление. После обрыва клиент
+# передает последний seq (after= или Last-Event-ID, браузерный EventSource делает это сам) и получает
+# пропущенное; если столько событий воркер уже не хранит — событие reset, и данные нужно перечитать
+@router.get("/changes")
+async def changes(
+    topics: str = Query(",".join(CHANGE_TOPICS)),
+    after: Optional[int] = None,
+    last_event_id: Optional[int] = Header(None),
+):
+    wanted = {topic.strip() for topic in topics.split(",") if topic.strip()}
+    unknown = wanted - set(CHANGE_TOPICS)
+    if unknown or not wanted:
+        raise HTTPException(status_code=400, detail="Неизвестные темы: " + ", ".join(sorted(unknown)))
+    async def stream():
+        # Подписка и отписка — в одном генераторе: если ответ так и не начали отдавать, подписки нет
+        subscriber = ChangeSubscriber(wanted)
+        backlog = change_feed.subscribe(subscriber, after if after is not None else last_event_id)
+        try:
+            yield "retry: 3000\n\n"
+            if backlog is None:
+                yield "event: reset\ndata: {}\n\n"
+            for event in backlog or []:
+                yield sse_event(event)
+            while True:
+                if subscriber.lost:
+                    while not subscriber.queue.empty():
+                        subscriber.queue.get_nowait()
+                    subscriber.lost = False
+                    yield "event: reset\ndata: {}\n\n"
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), CHANGE_FEED_PING)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event is not None:
+                    yield sse_event(event)
+        finally:
+            change_feed.unsubscribe(subscriber)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def sales_drift_handler(request: Request, exc: SalesDriftError):
+    return JSONResponse(status_code=409, content={"detail": str(exc)})
+
+def create_app() -> FastAPI:
+    app = FastAPI(title="Hotel Backend API", lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Next-After", "ETag", "Last-Modified", "Server-Timing"],
+    )
+    if REPLICA_DATABASE_URL is not None:
+        app.add_middleware(PrimaryAfterWriteMiddleware)
+    app.add_middleware(MetricsMiddleware)
+    app.add_exception_handler(SalesDriftError, sales_drift_handler)
+    app.include_router(router)
+    return app
+
+app = create_app()
+
+def post_fork(server, worker):
+    # Соединения, открытые в мастере до fork, не должны делиться между воркерами
+    if get_engine.cache_info().currsize:
+        get_engine().dispose(close=False)
+    if get_async_engine.cache_info().currsize:
+        get_async_engine().sync_engine.dispose(close=False)
+    if get_replica_engine.cache_info().currsize:
+        get_replica_engine().dispose(close=False)
+    if get_async_replica_engine.cache_info().currsize:
+        get_async_replica_engine().sync_engine.dispose(close=False)
+
+def serve(bind: str, workers: int, backlog: int):
+    from gunicorn.app.base import BaseApplication
+
+    # Приложение импортируется один раз в мастере (preload_app) и копируется воркерам при fork;
+    # при импорте нет соединений с БД, потоков и DDL, поэтому это безопасно
+    options = {
+        "bind": [bind, INTERNAL_BIND] if INTERNAL_BIND else bind,
+        "workers": workers,
+        "worker_class": "uvicorn_worker.UvicornWorker",
+        "preload_app": True,
+        "backlog": backlog,
+        "max_requests": MAX_REQUESTS,
+        "max_requests_jitter": MAX_REQUESTS_JITTER,
+        # По SIGTERM воркер перестает принимать соединения и дожидается текущих запросов
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        "timeout": WORKER_TIMEOUT,
+        "keepalive": KEEPALIVE,
+        "post_fork": post_fork,
+    }
+
+    class HotelApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    HotelApplication().run()
 
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run("server:app", host="0.0.0.0", port=8000, reload=True)
+    import argparse
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    serve_parser = commands.add_parser("serve", help="запуск в нескольких процессах (по умолчанию)")
+    serve_parser.add_argument("--bind", default=BIND)
+    serve_parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY)
+    serve_parser.add_argument("--backlog", type=int, default=BACKLOG)
+    commands.add_parser("dev", help="один процесс с перезагрузкой при изменении кода")
+    commands.add_parser("migrate", help="создать таблицы, триггеры и ограничения")
+    backfill = commands.add_parser("backfill-sales", help="пересчитать SalesAnalysis по платежам, услугам и броням")
+    backfill.add_argument("--from", dest="date_from", type=date.fromisoformat)
+    backfill.add_argument("--to", dest="date_to", type=date.fromisoformat)
+    backfill.add_argument("--batch-days", type=int, default=31)
+    dedupe = commands.add_parser("dedupe-sales", help="удалить дубли SalesAnalysis за один день (по умолчанию только показать)")
+    dedupe.add_argument("--apply", action="store_true")
+    args = parser.parse_args()
+    if args.command == "migrate":
+        migrate()
+    elif args.command == "backfill-sales":
+        logging.basicConfig(level=logging.INFO)
+        print(backfill_sales(args.date_from, args.date_to, args.batch_days))
+    elif args.command == "dedupe-sales":
+        logging.basicConfig(level=logging.INFO)
+        print(dedupe_sales(args.apply))
+    elif args.command == "dev":
+        import uvicorn
+        uvicorn.run("server:app", host="0.0.0.0", port=8000, reload=True)
+    elif args.command == "serve":
+        serve(args.bind, args.workers, args.backlog)
+    else:
+        serve(BIND, WEB_CONCURRENCY, BACKLOG)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Модуль server импортируется без подключения к БД: движки создаются при первом запросе
+os.environ.setdefault("TOKEN_SECRET", "test-secret")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+from datetime import date
+
+import numpy as np
+import pytest
+
+from server import aggregate_analytics, analytics_periods
+
+FLOATS = ("stay_rates", "payment_amounts", "usage_amounts")
+
+
+def columns(**values) -> dict:
+    # Столбцы в том виде, в каком их возвращает load_analytics_columns; дни — смещения от date_from
+    result = {key: [] for key in (
+        "room_ids", "categories", "floors", "stay_rooms", "stay_starts", "stay_stops", "stay_rates",
+        "payment_bookings", "payment_days", "payment_amounts", "usage_bookings", "usage_days", "usage_amounts",
+        "link_bookings", "link_rooms")}
+    result.update(values)
+    return {key: np.array(value, dtype=np.float64 if key in FLOATS else np.int64) for key, value in result.items()}
+
+
+@pytest.fixture
+def data():
+    return columns(
+        room_ids=[1, 2], categories=[1, 2], floors=[3, 3],
+        # Бронь номера 1 началась до окна: в окно попадают ночи 0 и 1, день выезда не продан
+        stay_rooms=[1], stay_starts=[-1], stay_stops=[2], stay_rates=[100],
+        # Платеж брони 5 на два номера делится пополам, платеж без брони не относится ни к одному номеру
+        payment_bookings=[5, 0], payment_days=[0, 1], payment_amounts=[50, 10],
+        usage_bookings=[5], usage_days=[3], usage_amounts=[8],
+        link_bookings=[5, 5], link_rooms=[1, 2],
+    )
+
+
+def test_daily_totals(data):
+    rows = aggregate_analytics(data, date(2030, 6, 1), date(2030, 6, 4), "day", None)
+    assert [row["period"] for row in rows] == [date(2030, 6, d) for d in (1, 2, 3, 4)]
+    assert all(row["group"] is None and row["rooms_available"] == 2 for row in rows)
+    assert [row["rooms_sold"] for row in rows] == [1, 1, 0, 0]
+    assert [row["occupancy"] for row in rows] == [0.5, 0.5, 0.0, 0.0]
+    assert [row["room_revenue"] for row in rows] == [100, 100, 0, 0]
+    assert [row["adr"] for row in rows] == [100, 100, 0, 0]
+    assert [row["revpar"] for row in rows] == [50, 50, 0, 0]
+    assert [row["payments"] for row in rows] == [50, 10, 0, 0]
+    assert [row["service_revenue"] for row in rows] == [0, 0, 0, 8]
+
+
+def test_group_by_category(data):
+    rows = aggregate_analytics(data, date(2030, 6, 1), date(2030, 6, 4), "month", "category")
+    by_group = {row["group"]: row for row in rows}
+    assert [row["period"] for row in rows] == [date(2030, 6, 1)] * 3
+    assert by_group[1]["rooms_available"] == 4 and by_group[1]["rooms_sold"] == 2
+    assert by_group[1]["payments"] == 25 and by_group[2]["payments"] == 25
+    assert by_group[1]["service_revenue"] == 4 and by_group[2]["service_revenue"] == 4
+    assert by_group[2]["room_revenue"] == 0 and by_group[2]["occupancy"] == 0
+    # Строка без номера — только платежи и услуги, которые некуда отнести
+    assert by_group[None]["payments"] == 10 and by_group[None]["rooms_available"] == 0
+
+
+def test_unassigned_row_skipped_when_empty(data):
+    rows = aggregate_analytics(data, date(2030, 6, 1), date(2030, 6, 4), "day", "floor")
+    assert [(row["period"].day, row["group"]) for row in rows] == [(1, 3), (2, 3), (2, None), (3, 3), (4, 3)]
+
+
+def test_empty_window():
+    rows = aggregate_analytics(columns(), date(2030, 6, 1), date(2030, 6, 2), "day", None)
+    assert [(row["rooms_available"], row["occupancy"], row["adr"]) for row in rows] == [(0, 0, 0), (0, 0, 0)]
+
+
+def test_periods():
+    periods, index = analytics_periods(date(2030, 5, 30), 6, "week")
+    # 2030-05-30 — четверг, неделя начинается с понедельника
+    assert periods.astype(date).tolist() == [date(2030, 5, 27), date(2030, 6, 3)]
+    assert index.tolist() == [0, 0, 0, 0, 1, 1]
+    periods, index = analytics_periods(date(2030, 5, 30), 4, "month")
+    assert periods.astype(date).tolist() == [date(2030, 5, 1), date(2030, 6, 1)]
+    assert index.tolist() == [0, 0, 1, 1]
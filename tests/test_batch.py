@@ -0,0 +1,59 @@
+import pytest
+from fastapi import HTTPException
+
+from server import BATCH_SUPPORTED, match_route, resolve_references
+
+RESULTS = [{"client_id": 42, "name": "Анна"}, {"booking_id": 7, "room_ids": [1, 2]}, [1, 2]]
+
+
+def test_whole_reference_keeps_type():
+    assert resolve_references("$0.client_id", RESULTS) == 42
+    assert resolve_references("$1.room_ids", RESULTS) == [1, 2]
+
+
+def test_reference_inside_string_is_text():
+    assert resolve_references("/bookings/$1.booking_id/payments", RESULTS) == "/bookings/7/payments"
+    assert resolve_references("$0.name-$1.booking_id", RESULTS) == "Анна-7"
+
+
+def test_nested_values():
+    body = {"client_id": "$0.client_id", "rooms": ["$1.room_ids", 3], "note": None, "total": 10.5}
+    assert resolve_references(body, RESULTS) == {"client_id": 42, "rooms": [[1, 2], 3], "note": None, "total": 10.5}
+    assert resolve_references("цена $5", RESULTS) == "цена $5"
+
+
+@pytest.mark.parametrize("value", ["$3.client_id", "$0.missing", "$2.x", "/rooms/$9.id"])
+def test_bad_reference(value):
+    with pytest.raises(HTTPException) as e:
+        resolve_references(value, RESULTS)
+    assert e.value.status_code == 400
+
+
+def test_match_route():
+    assert BATCH_SUPPORTED
+    route, params = match_route("GET", "/rooms/5")
+    assert route.path == "/rooms/{room_id}" and params == {"room_id": "5"}
+    with pytest.raises(HTTPException) as e:
+        match_route("POST", "/batch")
+    assert e.value.status_code == 404
+
+
+@pytest.mark.parametrize("path", ["/clients/import", "/payments/import", "/service-usage/import"])
+def test_raw_body_routes_rejected(path):
+    # У операции пакета нет потока тела, файлы импорта в пакете не читаются
+    with pytest.raises(HTTPException) as e:
+        match_route("POST", path)
+    assert e.value.status_code == 400
+
+
+@pytest.mark.parametrize("path, query", [
+    ("/changes", {}), ("/rooms", {"stream": "true"}), ("/bookings", {"stream": True}), ("/payments", {"stream": 1})])
+def test_streaming_routes_rejected(path, query):
+    with pytest.raises(HTTPException) as e:
+        match_route("GET", path, query)
+    assert e.value.status_code == 400
+
+
+def test_list_without_stream_allowed():
+    route, _ = match_route("GET", "/rooms", {"stream": "false", "limit": 5})
+    assert route.path == "/rooms"
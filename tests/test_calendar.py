@@ -0,0 +1,65 @@
+from datetime import date, datetime
+from types import SimpleNamespace
+
+import numpy as np
+
+from server import build_calendar, expand_ranges, run_lengths
+
+
+def room(room_id, category_id=1):
+    return SimpleNamespace(room_id=room_id, room_number=str(room_id), category_id=category_id)
+
+
+def cleaning(room_id, when, status):
+    return SimpleNamespace(room_id=room_id, cleaning_date=when, cleaning_status=status)
+
+
+def test_run_lengths():
+    matrix = np.array([[0, 0, 5, 5, 5, 0], [7, 7, 7, 7, 7, 7], [1, 2, 2, 1, 1, 3]])
+    assert run_lengths(matrix) == [
+        [[0, 2], [5, 3], [0, 1]],
+        [[7, 6]],
+        [[1, 1], [2, 2], [1, 2], [3, 1]],
+    ]
+
+
+def test_run_lengths_restore_row():
+    rng = np.random.default_rng(1)
+    matrix = rng.integers(0, 3, size=(5, 40))
+    for row, runs in zip(matrix, run_lengths(matrix)):
+        assert np.repeat(*np.array(runs).T).tolist() == row.tolist()
+
+
+def test_expand_ranges():
+    owners, positions = expand_ranges(np.array([2, 5, 7]), np.array([4, 5, 10]))
+    assert owners.tolist() == [0, 0, 2, 2, 2]
+    assert positions.tolist() == [2, 3, 7, 8, 9]
+
+
+def test_build_calendar():
+    rooms = [room(1), room(2), room(3, category_id=2)]
+    stays = [
+        # Началась до окна и обрезается им
+        (1, 11, date(2030, 5, 30), date(2030, 6, 3)),
+        (1, 12, date(2030, 6, 3), date(2030, 6, 5)),
+        (3, 13, date(2030, 6, 6), date(2030, 6, 12)),
+        # Номер не попал в выборку (фильтр по категории или этажу)
+        (9, 14, date(2030, 6, 1), date(2030, 6, 3)),
+    ]
+    cleanings = [cleaning(2, datetime(2030, 6, 2, 10), "Готово"), cleaning(2, datetime(2030, 6, 4, 9), "Ожидает")]
+    result = build_calendar(rooms, stays, cleanings, date(2030, 6, 1), 7)
+    assert result["cleaning_statuses"] == ["Готово", "Ожидает"]
+    assert [r["bookings"] for r in result["rooms"]] == [
+        [[11, 2], [12, 2], [0, 3]],
+        [[0, 7]],
+        [[0, 5], [13, 2]],
+    ]
+    assert result["rooms"][1]["cleaning"] == [[0, 1], [1, 1], [0, 1], [2, 1], [0, 3]]
+    assert result["occupancy_by_day"] == [0.3333, 0.3333, 0.3333, 0.3333, 0.0, 0.3333, 0.3333]
+    assert result["occupancy_by_category"] == {1: round(4 / 14, 4), 2: round(2 / 7, 4)}
+
+
+def test_build_calendar_without_rooms():
+    result = build_calendar([], [(1, 11, date(2030, 6, 1), date(2030, 6, 3))], [], date(2030, 6, 1), 3)
+    assert result["rooms"] == []
+    assert result["occupancy_by_day"] == [0.0, 0.0, 0.0]
@@ -0,0 +1,41 @@
+import asyncio
+
+import server
+from server import ChangeFeed, changes
+
+
+def subscriber_count(feed: ChangeFeed) -> int:
+    return sum(len(subscribers) for subscribers in feed.subscribers.values())
+
+
+def test_subscription_lives_inside_stream(monkeypatch):
+    feed = ChangeFeed(10)
+    monkeypatch.setattr(server, "change_feed", feed)
+
+    async def scenario():
+        response = await changes(topics="rooms", after=None, last_event_id=None)
+        # Ответ создан, но не отдан (пакет, обрыв до первого байта) — подписки нет
+        assert subscriber_count(feed) == 0
+        body = response.body_iterator
+        assert await body.__anext__() == "retry: 3000\n\n"
+        assert subscriber_count(feed) == 1
+        await body.aclose()
+        assert subscriber_count(feed) == 0
+
+    asyncio.run(scenario())
+
+
+def test_resume_from_buffer(monkeypatch):
+    feed = ChangeFeed(10)
+    monkeypatch.setattr(server, "change_feed", feed)
+    for seq, topic in ((1, "rooms"), (2, "cleanings"), (3, "rooms")):
+        feed.on_notify(f'{{"seq": {seq}, "topic": "{topic}", "action": "created", "id": {seq}}}')
+
+    async def scenario():
+        response = await changes(topics="rooms", after=1, last_event_id=None)
+        body = response.body_iterator
+        chunks = [await body.__anext__() for _ in range(2)]
+        await body.aclose()
+        return chunks
+
+    assert asyncio.run(scenario())[1].startswith("id: 3\nevent: rooms\n")
@@ -0,0 +1,37 @@
+import pytest
+
+from server import client_search_branches, like_prefix
+
+
+def test_single_word():
+    assert client_search_branches("Иванов") == [
+        (1, [("last_name", "иванов")]), (2, [("first_name", "иванов")]), (3, [("email", "иванов")])]
+
+
+def test_two_words_in_any_order():
+    assert client_search_branches("Иванов  Петр") == [
+        (1, [("last_name", "иванов"), ("first_name", "петр")]),
+        (1, [("first_name", "иванов"), ("last_name", "петр")])]
+
+
+def test_email():
+    assert client_search_branches("Ivan@Mail") == [(1, [("email", "ivan@mail")])]
+
+
+@pytest.mark.parametrize("q, branches", [
+    ("999 123", [(1, [("phone", "999123")]), (2, [("phone", "7999123")])]),
+    ("+7 (999) 123-45-67", [(1, [("phone", "79991234567")])]),
+    # Российский номер с 8 приводится к 7, как в индексе
+    ("8 999 123 45 67", [(1, [("phone", "79991234567")])]),
+])
+def test_phone(q, branches):
+    assert client_search_branches(q) == branches
+
+
+def test_short_digits_and_mixed_text_are_names():
+    assert client_search_branches("12")[0] == (1, [("last_name", "12")])
+    assert client_search_branches("a123")[0] == (1, [("last_name", "a123")])
+
+
+def test_like_prefix_escapes_wildcards():
+    assert like_prefix("50%_a\\b") == "50\\%\\_a\\\\b%"
@@ -0,0 +1,24 @@
+import threading
+import time
+
+from server import create_once
+
+
+def test_concurrent_first_calls_create_once():
+    created = []
+
+    @create_once
+    def get_engine():
+        created.append(object())
+        time.sleep(0.05)
+        return created[-1]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(get_engine())) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 1
+    assert all(result is created[0] for result in results)
+    assert get_engine.cache_info().currsize == 1
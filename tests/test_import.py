@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+from server import ClientCreate, parse_import, read_import_body, validate_import
+
+
+def test_parse_csv_skips_empty_values():
+    data = "\ufefffirst_name,last_name,phone\nИван,Петров,\nАнна,,+7999\n".encode()
+    assert list(parse_import("csv", data)) == [
+        (1, {"first_name": "Иван", "last_name": "Петров"}, None),
+        (2, {"first_name": "Анна", "phone": "+7999"}, None),
+    ]
+
+
+def test_parse_ndjson_reports_bad_lines():
+    data = b'{"a": 1}\n\nnot json\n[1, 2]\n{"b": 2}\n'
+    rows = list(parse_import("ndjson", data))
+    assert [row_no for row_no, _, _ in rows] == [1, 3, 4, 5]
+    assert rows[0] == (1, {"a": 1}, None)
+    assert rows[1][1] is None and rows[1][2].startswith("Неверный JSON")
+    assert rows[2] == (4, None, "Строка должна быть JSON-объектом")
+    assert rows[3] == (5, {"b": 2}, None)
+
+
+def test_validate_import_collects_errors():
+    data = (b'{"first_name": "Ivan", "last_name": "Petrov", "phone": "123", "email": "ivan@example.com"}\n'
+            b'{"first_name": "Ivan1", "last_name": "Petrov", "phone": "123", "email": "bad"}\n'
+            b'oops\n')
+    total, rows, errors = validate_import(("ndjson", data), ClientCreate)
+    assert total == 3
+    assert [(row_no, record.email) for row_no, record in rows] == [(1, "ivan@example.com")]
+    assert [error["row"] for error in errors] == [2, 3]
+    assert "first_name" in errors[0]["error"] and "email" in errors[0]["error"]
+
+
+def upload(chunks, headers=()):
+    messages = [{"type": "http.request", "body": chunk, "more_body": True} for chunk in chunks]
+    messages.append({"type": "http.request", "body": b"", "more_body": False})
+
+    async def receive():
+        return messages.pop(0)
+    return Request({"type": "http", "method": "POST", "path": "/clients/import",
+                    "headers": [(key.encode(), value.encode()) for key, value in headers]}, receive)
+
+
+def test_read_import_body_detects_format():
+    body = asyncio.run(read_import_body(upload([b"a,b\n", b"1,2\n"], [("content-type", "text/csv")]), None))
+    assert body == ("csv", b"a,b\n1,2\n")
+    assert asyncio.run(read_import_body(upload([b"{}"]), None)) == ("ndjson", b"{}")
+
+
+def test_read_import_body_limit(monkeypatch):
+    monkeypatch.setattr(server, "IMPORT_MAX_BYTES", 10)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(read_import_body(upload([b"x"], [("content-length", "11")]), None))
+    assert e.value.status_code == 413
+    # Без Content-Length (chunked) предел проверяется по мере чтения
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(read_import_body(upload([b"123456", b"123456"]), None))
+    assert e.value.status_code == 413
+    assert asyncio.run(read_import_body(upload([b"12345", b"12345"]), "ndjson")) == ("ndjson", b"1234512345")
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import pytest
+from starlette.requests import Request
+
+from server import (PRIMARY_COOKIE, MetricsMiddleware, PrimaryAfterWriteMiddleware, ReplicaState,
+                    pinned_to_primary, request_stats)
+
+
+@pytest.fixture
+def state():
+    return ReplicaState(max_lag=5, interval=60)
+
+
+def test_first_read_checks_lag(state):
+    assert state.route() == "check"
+    # До первого успешного измерения реплика не используется
+    assert state.route() == "primary"
+
+
+def test_lag_decides_target(state):
+    state.route()
+    assert state.record(1.5) is True
+    assert state.route() == "replica"
+    assert state.record(5) is True
+    assert state.record(12) is False
+    assert state.route() == "primary"
+    assert state.record(None) is False
+    assert state.route() == "primary"
+
+
+def test_check_repeats_after_interval():
+    state = ReplicaState(max_lag=5, interval=0.01)
+    assert state.route() == "check"
+    state.record(0)
+    assert state.route() == "replica"
+    time.sleep(0.02)
+    assert state.route() == "check"
+
+
+def test_snapshot(state):
+    state.record(2)
+    state.count("replica")
+    state.count("replica")
+    state.count("primary")
+    assert state.snapshot() == {"lag_seconds": 2, "max_lag_seconds": 5, "reads_replica": 2, "reads_primary": 1}
+
+
+@pytest.mark.parametrize("cookie, pinned", [
+    (None, False), (str(time.time() + 30), True), (str(time.time() - 1), False), ("garbage", False)])
+def test_pinned_to_primary(cookie, pinned):
+    headers = [] if cookie is None else [(b"cookie", f"{PRIMARY_COOKIE}={cookie}".encode())]
+    assert pinned_to_primary(Request({"type": "http", "headers": headers})) is pinned
+
+
+def response_cookies(method: str, wrote: bool, status: int = 200) -> list:
+    async def endpoint(scope, receive, send):
+        request_stats.get().wrote = wrote
+        await send({"type": "http.response.start", "status": status, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    app = MetricsMiddleware(PrimaryAfterWriteMiddleware(endpoint))
+    asyncio.run(app({"type": "http", "method": method, "path": "/x", "headers": []}, None, send))
+    return [value for key, value in messages[0]["headers"] if key == b"set-cookie"]
+
+
+def test_cookie_only_after_write():
+    assert len(response_cookies("POST", wrote=True)) == 1
+    assert response_cookies("POST", wrote=True)[0].startswith(PRIMARY_COOKIE.encode())
+    # /login, POST /rooms/available, /batch из одних чтений
+    assert response_cookies("POST", wrote=False) == []
+    assert response_cookies("POST", wrote=True, status=400) == []
+    assert response_cookies("GET", wrote=True) == []
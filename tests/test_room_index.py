@@ -0,0 +1,145 @@
+from datetime import date, timedelta
+
+import pytest
+
+from server import RoomIntervalIndex
+
+D = date(2030, 6, 1)
+
+
+def day(offset: int) -> date:
+    return D + timedelta(days=offset)
+
+
+@pytest.fixture
+def index():
+    index = RoomIntervalIndex(ttl=60, days_back=7)
+    index.horizon = date.today().toordinal() - 7
+    return index
+
+
+def test_empty_room_is_free(index):
+    assert index.free_rooms([1, 2], day(0), day(3)) == [1, 2]
+
+
+def test_overlap_counts_nights(index):
+    # Бронь занимает ночи [заезд, выезд) — как daterange '[)' в booking_rooms_no_overlap
+    index.add(10, [1], day(5), day(7))
+    assert index.free_rooms([1], day(0), day(5)) == [1]
+    assert index.free_rooms([1], day(0), day(6)) == []
+    assert index.free_rooms([1], day(6), day(9)) == []
+    assert index.free_rooms([1], day(7), day(9)) == [1]
+
+
+def test_back_to_back_bookings(index):
+    # Выезд и заезд в один день не пересекаются
+    index.add(10, [1], day(0), day(3))
+    index.add(11, [1], day(5), day(8))
+    assert index.free_rooms([1], day(3), day(5)) == [1]
+    assert index.free_rooms([1], day(2), day(5)) == []
+    assert index.free_rooms([1], day(3), day(6)) == []
+
+
+def test_long_stay_found_behind_short_ones(index):
+    # Длинная бронь начинается раньше коротких: поиск назад ограничен max_len, а не первым интервалом
+    index.add(1, [1], day(0), day(30))
+    index.add(2, [2], day(10), day(11))
+    index.add(3, [1], day(40), day(41))
+    assert index.free_rooms([1, 2], day(20), day(21)) == [2]
+
+
+def test_add_replaces_previous_entry(index):
+    index.add(10, [1, 2], day(0), day(2))
+    index.add(10, [2], day(10), day(12))
+    assert index.free_rooms([1, 2], day(0), day(2)) == [1, 2]
+    assert index.free_rooms([1, 2], day(11), day(12)) == [1]
+
+
+def test_remove_frees_rooms(index):
+    index.add(10, [1, 2], day(0), day(2))
+    index.remove(10)
+    index.remove(10)
+    assert index.free_rooms([1, 2], day(0), day(2)) == [1, 2]
+
+
+def test_remove_room_keeps_other_rooms_of_booking(index):
+    index.add(10, [1, 2], day(0), day(2))
+    index.remove_room(1)
+    assert index.bookings[10][0] == [2]
+    assert index.free_rooms([1, 2], day(0), day(2)) == [1]
+    index.remove(10)
+    assert index.free_rooms([2], day(0), day(2)) == [2]
+
+
+def test_covers_only_dates_after_horizon(index):
+    assert index.covers(date.today())
+    assert not index.covers(date.today() - timedelta(days=8))
+    assert not RoomIntervalIndex(ttl=60, days_back=7).covers(date.today())
+
+
+class FakeSession:
+    def __init__(self):
+        self.loads = 0
+
+    def execute(self, *args):
+        self.loads += 1
+        return self
+
+    def fetchall(self):
+        return []
+
+
+def test_ensure_loaded_reloads_when_versions_change(index, monkeypatch):
+    db, versions = FakeSession(), {"BookingRooms": 1, "Bookings": 1}
+    monkeypatch.setattr(index, "read_versions", lambda db: dict(versions))
+    index.ensure_loaded(db)
+    index.ensure_loaded(db)
+    assert db.loads == 1
+    # Бронь в другом воркере: версии таблиц изменились, индекс перечитывается
+    versions.update(Bookings=2, BookingRooms=2)
+    index.ensure_loaded(db)
+    assert db.loads == 2
+    index.invalidate()
+    index.ensure_loaded(db)
+    assert db.loads == 3
+
+
+def test_local_write_does_not_reload(index, monkeypatch):
+    db, versions = FakeSession(), {"BookingRooms": 1, "Bookings": 1}
+    monkeypatch.setattr(index, "read_versions", lambda db: dict(versions))
+    index.ensure_loaded(db)
+    # Своя запись: commit увеличил версии на 1, изменение внесено в индекс на месте
+    versions.update(Bookings=2, BookingRooms=2)
+    index.apply(lambda: index.add(10, [1], day(0), day(2)), {"BookingRooms": 2, "Bookings": 2, "Payments": 7})
+    index.ensure_loaded(db)
+    assert db.loads == 1
+    assert index.free_rooms([1], day(1), day(2)) == []
+    versions.update(BookingRooms=3)
+    index.apply(lambda: index.remove_room(1), {"BookingRooms": 3, "Rooms": 4})
+    index.ensure_loaded(db)
+    assert db.loads == 1
+
+
+def test_local_write_after_foreign_change_reloads(index, monkeypatch):
+    db, versions = FakeSession(), {"BookingRooms": 1, "Bookings": 1}
+    monkeypatch.setattr(index, "read_versions", lambda db: dict(versions))
+    index.ensure_loaded(db)
+    # Между загрузкой и своей записью таблицу менял другой воркер
+    versions.update(Bookings=3, BookingRooms=3)
+    index.apply(lambda: index.add(10, [1], day(0), day(2)), {"BookingRooms": 3, "Bookings": 3})
+    index.ensure_loaded(db)
+    assert db.loads == 2
+
+
+def test_write_during_load_forces_reload(index, monkeypatch):
+    db = FakeSession()
+    monkeypatch.setattr(index, "read_versions", lambda db: {"BookingRooms": 1, "Bookings": 1})
+    fetchall = db.fetchall
+
+    def racing_fetchall():
+        # add() после commit успевает выполниться, пока load() читает строки, и теряется при замене списков
+        index.apply(lambda: index.add(10, [1], day(0), day(2)), {"BookingRooms": 2, "Bookings": 2})
+        return fetchall()
+    db.fetchall = racing_fetchall
+    index.ensure_loaded(db)
+    assert index.versions is None
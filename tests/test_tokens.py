@@ -0,0 +1,79 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import (RevokedUsers, access_payload, current_user, issue_token, issue_tokens, read_token,
+                    password_fingerprint)
+
+
+@pytest.fixture(autouse=True)
+def revoked(monkeypatch):
+    revoked = RevokedUsers(ttl=60)
+    monkeypatch.setattr(server, "revoked_users", revoked)
+    return revoked
+
+
+def detail(fn, *args) -> str:
+    with pytest.raises(HTTPException) as e:
+        fn(*args)
+    assert e.value.status_code == 401
+    return e.value.detail
+
+
+def test_round_trip():
+    payload = read_token(issue_token(7, "access", 60, x=1), "access")
+    assert payload["sub"] == 7 and payload["x"] == 1
+    assert payload["exp"] - payload["iat"] == 60
+
+
+def test_tampered_token_rejected():
+    token = issue_token(7, "access", 60)
+    body, _, signature = token.partition(".")
+    forged = issue_token(8, "access", 60).partition(".")[0]
+    assert detail(read_token, forged + "." + signature, "access") == "Недействительный токен"
+    assert detail(read_token, body + "." + signature[:-2] + "AA", "access") == "Недействительный токен"
+    assert detail(read_token, body, "access") == "Недействительный токен"
+
+
+def test_kind_and_expiry():
+    assert detail(read_token, issue_token(7, "refresh", 60), "access") == "Недействительный токен"
+    assert detail(read_token, issue_token(7, "access", -1), "access") == "Срок действия токена истек"
+
+
+def test_revoked_before_issue_only(revoked):
+    old = issue_token(7, "access", 60)
+    revoked.revoke(7, time.time())
+    assert detail(read_token, old, "access") == "Токен отозван"
+    time.sleep(0.001)
+    assert read_token(issue_token(7, "access", 60), "access")["sub"] == 7
+    assert read_token(issue_token(8, "access", 60), "access")["sub"] == 8
+
+
+def test_revoked_users_forget_expired():
+    revoked = RevokedUsers(ttl=60)
+    revoked.revoke(1, time.time() - 120)
+    revoked.revoke(2, time.time())
+    assert list(revoked.items) == [2]
+
+
+def test_issue_tokens():
+    user = SimpleNamespace(user_id=3, user_password="$argon2id$hash")
+    tokens = issue_tokens(user)
+    access = read_token(tokens["access_token"], "access")
+    refresh = read_token(tokens["refresh_token"], "refresh")
+    assert "adm" not in access
+    assert refresh["pwd"] == password_fingerprint(user)
+    assert read_token(issue_tokens(user, admin=True)["access_token"], "access")["adm"] is True
+
+
+def test_current_user_header():
+    token = issue_token(5, "access", 60)
+    assert asyncio.run(current_user("Bearer " + token)) == 5
+    assert asyncio.run(current_user("bearer  " + token)) == 5
+    assert detail(access_payload, None) == "Требуется авторизация"
+    assert detail(access_payload, "Basic " + token) == "Требуется авторизация"
+    assert detail(access_payload, "Bearer !!!.x") == "Недействительный токен"